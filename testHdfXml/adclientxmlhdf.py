@@ -2,17 +2,54 @@
 try:
     from pkg_resources import require
     require('cothread')
+    require('numpy')
 except:
     # Some may not use setuptools/require for package management
     # and that is OK too...
     pass
 
-import os
+import os, sys
+import time
 import argparse
+import array
+import numpy
 
-# Import all the relevant Channel Access client stuff
-from cothread import dbr
-from cothread.catools import caget, caput, camonitor
+# Import all the relevant Channel Access client stuff. With ADCLIENT_SIMIOC=1 in
+# the environment the in-process simulated IOC (simioc) is used instead.
+if os.environ.get('ADCLIENT_SIMIOC', '0') not in ['', '0']:
+    import simioc as cothread
+    from simioc import dbr
+    from simioc import caget, caput, camonitor, connect, ca_nothing
+    CA_BACKEND = "simulated IOC (simioc)"
+    # Every process has its own simulated IOC
+    SIMULATED_IOC = True
+else:
+    import cothread
+    from cothread import dbr
+    from cothread.catools import caget, caput, camonitor, connect, ca_nothing
+    CA_BACKEND = "DLS cothread.catools"
+    SIMULATED_IOC = False
+
+import hdf_xml
+import hdf_schema
+import hdf_trace
+
+def _describe_pvs(args, kargs):
+    '''The PV (or the first of a list of PVs) of a Channel Access call, for tracing'''
+    pvs = args[0]
+    if isinstance(pvs, basestring):
+        return {'pv': pvs}
+    pvs = list(pvs)
+    return {'pv': pvs and pvs[0], 'count': len(pvs)}
+
+# Every Channel Access call is traced, at (next to) no cost unless tracing is enabled
+caget = hdf_trace.traced('caget', 'ca', caget, _describe_pvs)
+caput = hdf_trace.traced('caput', 'ca', caput, _describe_pvs)
+camonitor = hdf_trace.traced('camonitor', 'ca', camonitor, _describe_pvs)
+connect = hdf_trace.traced('connect', 'ca', connect, _describe_pvs)
+
+# Seconds without any progress (a monitored PV changing) before a wait gives up
+IDLE_TIMEOUT = 5.0
 
 class StrException(Exception):
     def __init__(self, msg):
@@ -20,6 +57,193 @@ class StrException(Exception):
     def _str_(self):
         return repr(self.msg)
 
+class PvBatch:
+    '''A batch of PV writes which are sent concurrently rather than one by one.
+    The writes are organised in stages: all writes within a stage are independent
+    and are issued together, a stage is only started once all the writes of the
+    previous stage have completed. Use stage() to start a new stage for writes
+    which must happen in order (i.e. disable callbacks, set port, re-enable).
+    
+    After execute() the latency of each stage and of the whole batch is available
+    in the 'latency' and 'elapsed' attributes.
+    '''
+    def __init__(self, name="batch"):
+        self.name = name
+        self.stages = [[]]
+        self.latency = []
+        self.elapsed = None
+        
+    def put(self, pv, value, datatype=None, wait=True):
+        '''Add a PV write to the current stage'''
+        self.stages[-1].append( (pv, value, datatype, wait) )
+        return self
+    
+    def stage(self):
+        '''Start a new stage: the following writes wait for the current stage to complete'''
+        if self.stages[-1]:
+            self.stages.append([])
+        return self
+    
+    def execute(self, timeout=5):
+        '''Send all the writes, stage by stage. Returns self. If any write of a stage
+        fails the first error is raised once the whole stage has completed, and
+        the following stages are not sent.'''
+        with hdf_trace.span(self.name, "batch"):
+            return self._execute(timeout)
+
+    def _execute(self, timeout):
+        self.latency = []
+        start = time.time()
+        for stage in self.stages:
+            if not stage:
+                continue
+            stage_start = time.time()
+            # One caput call per datatype and completion mode, each with a list of PVs.
+            # The calls run concurrently and the stage waits for all of them.
+            groups = dict()
+            for (pv, value, datatype, wait) in stage:
+                pvs, values = groups.setdefault( (datatype, wait), ([], []) )
+                pvs.append(pv)
+                values.append(value)
+            tasks = [cothread.Spawn(caput, pvs, values, datatype=datatype, wait=wait, timeout=timeout,
+                                    raise_on_wait=True)
+                     for ((datatype, wait), (pvs, values)) in groups.iteritems()]
+            error = None
+            for task in tasks:
+                try:
+                    task.Wait()
+                except Exception:
+                    if error is None:
+                        error = sys.exc_info()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            self.latency.append( (len(stage), time.time() - stage_start) )
+        self.elapsed = time.time() - start
+        return self
+    
+    def __str__(self):
+        stages = ", ".join(["%d PVs %.1fms"%(num, latency*1000.) for (num, latency) in self.latency])
+        if self.elapsed is None:
+            return "<PvBatch %s: not executed>"%(self.name)
+        return "<PvBatch %s: %.1fms [%s]>"%(self.name, self.elapsed*1000., stages)
+
+class PvWaiter:
+    '''Wait for a condition on a number of monitored PVs.
+    Rather than a fixed timeout the wait uses a progress based deadline: it only
+    fails when none of the watched PVs has changed for idle_timeout seconds, so a
+    wait takes exactly as long as the underlying operation, however long that is.
+    
+    The latest values are available in the 'values' dictionary (keyed by PV name)
+    which is passed to the condition function.
+    '''
+    def __init__(self):
+        self.values = dict()
+        self.handles = []
+        self.updated = cothread.Event()
+        self.last_progress = time.time()
+        
+    def watch(self, pv, datatype=None):
+        '''Add a PV to monitor. Returns self.'''
+        self.handles.append( camonitor(pv, lambda value, pv=pv: self._update(pv, value), datatype=datatype) )
+        return self
+    
+    def _update(self, pv, value):
+        if pv not in self.values or self.values[pv] != value:
+            self.last_progress = time.time()
+        self.values[pv] = value
+        self.updated.Signal()
+        
+    def wait(self, condition, idle_timeout=IDLE_TIMEOUT):
+        '''Wait until condition(values) is True. Raises cothread.Timedout if no
+        watched PV has changed for idle_timeout seconds.'''
+        with hdf_trace.span("PvWaiter.wait", "ca", pvs=" ".join(sorted(self.values))):
+            self._wait(condition, idle_timeout)
+
+    def _wait(self, condition, idle_timeout):
+        while not condition(self.values):
+            remaining = self.last_progress + idle_timeout - time.time()
+            if remaining <= 0:
+                raise cothread.Timedout("No progress for %.1fs on %s"%(idle_timeout, sorted(self.values)))
+            try:
+                self.updated.Wait(remaining)
+            except cothread.Timedout:
+                pass
+            
+    def close(self):
+        for handle in self.handles:
+            handle.close()
+        self.handles = []
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+class PvPoolEntry:
+    '''The pooled connection state of the PVs below one base PV'''
+    def __init__(self, basepv, pvs, portname):
+        self.basepv = basepv
+        self.pvs = set(pvs)
+        self.portname = portname
+        self.last_used = time.time()
+
+class PvPool:
+    '''Pool of Channel Access connections shared by the driver and plugin objects.
+    On first use of a base PV all its PVs are connected in parallel and the
+    static PortName_RBV is read once; later users of the same base PV get the
+    pooled entry without any network round trip. Entries which have not been used
+    for idle_timeout seconds are evicted.
+    
+    The channels themselves are kept open by the cothread channel cache, which
+    has no public interface to close individual channels: eviction drops the
+    pooled state so the next user reconnects and re-reads the port name.
+    '''
+    def __init__(self, idle_timeout=600.0, timeout=5.0):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def get(self, basepv, pvs):
+        '''Return the PvPoolEntry of basepv, connecting all pvs if needed'''
+        self.evict_idle()
+        entry = self.entries.get(basepv)
+        pvs = list(pvs)
+        if entry is None:
+            self.misses += 1
+            portname_pv = basepv + ":PortName_RBV"
+            connect(pvs + [portname_pv], wait=True, timeout=self.timeout)
+            entry = PvPoolEntry(basepv, pvs, caget(portname_pv))
+            self.entries[basepv] = entry
+        else:
+            self.hits += 1
+            missing = [pv for pv in pvs if pv not in entry.pvs]
+            if missing:
+                connect(missing, wait=True, timeout=self.timeout)
+                entry.pvs.update(missing)
+        entry.last_used = time.time()
+        return entry
+    
+    def evict_idle(self):
+        now = time.time()
+        for basepv, entry in self.entries.items():
+            if now - entry.last_used > self.idle_timeout:
+                del self.entries[basepv]
+                self.evictions += 1
+                
+    def clear(self):
+        self.evictions += len(self.entries)
+        self.entries.clear()
+                
+    def __str__(self):
+        return "<PvPool: %d entries, %d hits, %d misses, %d evictions>"\
+            %(len(self.entries), self.hits, self.misses, self.evictions)
+
+# The pool used by all SimDet and HdfPlugin objects
+pv_pool = PvPool()
+
 class SimDet:
     def __init__(self, pv):
         self.basepv = pv
@@ -28,39 +252,74 @@ class SimDet:
                         'exposure':    pv + 'AcquireTime',
                         'mode':        pv + 'ImageMode',
                         'arrays':      pv + 'ArrayCounter',
+                        'arrays_rbv':  pv + 'ArrayCounter_RBV',
                         'numimages':   pv + 'NumImages',
                         'acquire':     pv + 'Acquire',
                         'acquire_rbv': pv + 'Acquire'})
                         
-        self.portname = caget(pv + "PortName_RBV")
+        self.portname = pv_pool.get(self.basepv, self.pv.values()).portname
         self.mon_handle = None
         self.acquiring = None
+        # The last executed PvBatch (for its latency)
+        self.batch = None
         
     def stop_monitor(self):
         self.mon_handle.close()
         
     def start_monitor(self):
-        self.acquiring = caget( self.pv['acquire_rbv']) is 1
+        self.acquiring = caget( self.pv['acquire_rbv']) == 1
         self.mon_handle = camonitor( self.pv['acquire_rbv'], self.monitor_acquire)
         
     def monitor_acquire(self, acquire):
-        self.acquiring = acquire is 1
+        self.acquiring = acquire == 1
         
     def acquire(self, exposure, num = 1, wait=True):
+        self.prepare(exposure, num)
+        if not wait:
+            self.start()
+            return
+        # Wait for all frames to arrive, allowing a few frame periods without progress
+        idle_timeout = exposure * 3 + IDLE_TIMEOUT
+        with PvWaiter().watch(self.pv['acquire_rbv']).watch(self.pv['arrays_rbv']) as waiter:
+            self.start()
+            waiter.wait(lambda values: values.get(self.pv['arrays_rbv'], 0) >= num
+                                       and values.get(self.pv['acquire_rbv']) == 0,
+                        idle_timeout)
+
+    def prepare(self, exposure, num = 1):
+        '''Write the acquisition settings without starting the acquisition'''
+        batch = PvBatch("%s acquire"%self.basepv)
         # First check if acquisition is running
         if self.acquiring:
-            caput( self.pv['acquire'], 0, wait=True)
+            batch.put( self.pv['acquire'], 0)
+            batch.stage()
         # Clear counter
-        caput( self.pv['arrays'], 0)
+        batch.put( self.pv['arrays'], 0)
         # Set number of images
-        caput( self.pv['mode'], "Multiple")
-        caput( self.pv['numimages'], num)
+        batch.put( self.pv['mode'], "Multiple")
+        batch.put( self.pv['numimages'], num)
         # Set exposure and period
-        caput( self.pv['period'], exposure, wait=True)
-        caput( self.pv['exposure'], exposure, wait = True)
-        # Calculate timeout: period (or exposure) * num * 1.5
-        timeout = exposure * num * 1.5
-        caput( self.pv['acquire'], 1, wait=wait, timeout=timeout)
+        batch.put( self.pv['period'], exposure)
+        batch.put( self.pv['exposure'], exposure)
+        self.batch = batch.execute()
+
+    def start(self):
+        '''Start an acquisition set up by prepare()'''
+        caput( self.pv['acquire'], 1, wait=False)
+
+    def wait_acquire_done(self, num, idle_timeout=IDLE_TIMEOUT):
+        '''Wait for the driver to have produced num frames and stopped acquiring'''
+        with PvWaiter().watch(self.pv['acquire_rbv']).watch(self.pv['arrays_rbv']) as waiter:
+            waiter.wait(lambda values: values.get(self.pv['arrays_rbv'], 0) >= num
+                                       and values.get(self.pv['acquire_rbv']) == 0,
+                        idle_timeout)
+
+    def linear_ramp(self):
+        '''The hdf_frames.LinearRampPattern of the driver's current Gain, GainX and
+        GainY settings (offset None: taken from the first frame of the file)'''
+        import hdf_frames
+        gain, gain_x, gain_y = caget( [self.basepv + ":Gain", self.basepv + ":GainX", self.basepv + ":GainY"])
+        return hdf_frames.LinearRampPattern(float(gain), float(gain_x), float(gain_y))
         
 class HdfPlugin:
     def __init__(self, pv):
@@ -69,22 +328,28 @@ class HdfPlugin:
         self.pv = dict( {'enable':      pv + 'EnableCallbacks',
                          'port':        pv + 'NDArrayPort',
                          'arrays':      pv + 'ArrayCounter',
+                         'arrays_rbv':  pv + 'ArrayCounter_RBV',
                          'dropped':     pv + 'DroppedArrays',
+                         'dropped_rbv': pv + 'DroppedArrays_RBV',
                          'numcapture':  pv + 'NumCapture',
+                         'numcaptured': pv + 'NumCaptured_RBV',
                          'lazyopen':    pv + 'LazyOpen',
                          'capture':     pv + 'Capture',
                          'capture_rbv': pv + 'Capture_RBV',
                          'path':        pv + 'FilePath',
                          'name':        pv + 'FileName',
                          'template':    pv + 'FileTemplate',
+                         'fullname':    pv + 'FullFileName_RBV',
                          'mode':        pv + 'FileWriteMode',
                          'xmlfile':     pv + 'XMLFileName',
                          'xmlvalid':    pv + 'XMLValid_RBV',
                          'xmlerror':    pv + 'XMLErroMsg_RBV'})
                          
-        self.portname = caget(pv + "PortName_RBV")
+        self.portname = pv_pool.get(self.basepv, self.pv.values()).portname
         self.capturing = None
         self.mon_handle = None
+        # The last executed PvBatch (for its latency)
+        self.batch = None
         
     def __enter__(self):
         self.start_monitor()
@@ -92,51 +357,162 @@ class HdfPlugin:
         self.stop_monitor()
         
     def start_monitor(self):
-        self.capturing = caget( self.pv['capture_rbv']) is 1
+        self.capturing = caget( self.pv['capture_rbv']) == 1
         self.mon_handle = camonitor( self.pv['capture_rbv'], self.monitor_capture )
     def stop_monitor(self):
         self.mon_handle.close()
         
     def monitor_capture(self, capture):
-        self.capturing = capture is 1
+        self.capturing = capture == 1
         
     def set_data_source(self, source_driver):
         #print "Setting %s plugin input: %s" %( self.portname, source_driver.portname)
         caput( self.pv['port'], str(source_driver.portname), wait=True)
         
-    def configure_file(self, outputfile, xmldef=None):
+    def configure_file(self, outputfile, xmldef=None, swmr=False, check=True):
+        '''Set the output file and the XML layout, in Stream mode. With swmr the file
+        is written in SWMR mode so it can be read while it is being written (this needs
+        a file writer with SWMR support; otherwise SWMRMode is left alone).
+        check=False skips the schema check of the layout, for callers which have
+        checked it before setting up anything else.'''
         if xmldef:
-            caput( self.pv['xmlfile'], os.path.abspath(xmldef), datatype=dbr.DBR_CHAR_STR, wait=True)
-            validxml = caget( self.pv['xmlvalid'])
-            if validxml is 0:
-                errmsg = caget( self.pv['xmlerror'] )
-                raise StrException(errmsg)
+            self.set_layout(xmldef, check)
             
+        batch = PvBatch("%s configure_file"%self.basepv)
+        batch.put( self.pv['template'], "%s%s", datatype = dbr.DBR_CHAR_STR )
+        self._put_file_name(batch, outputfile)
+        batch.put( self.pv['mode'], "Stream")
+        if swmr:
+            batch.put( self.basepv + ":SWMRMode", 1)
+        self.batch = batch.execute()
+
+    def set_layout(self, xmldef, check=True):
+        '''Have the plugin load the XML layout and check that it found it valid'''
+        if check:
+            # Reject a layout which does not match the schema before writing any PV
+            hdf_schema.check_layout(xmldef)
+        caput( self.pv['xmlfile'], os.path.abspath(xmldef), datatype=dbr.DBR_CHAR_STR, wait=True)
+        validxml = caget( self.pv['xmlvalid'])
+        if validxml == 0:
+            errmsg = caget( self.pv['xmlerror'] )
+            raise StrException(errmsg)
+
+    def _put_file_name(self, batch, outputfile):
         outputfile = os.path.abspath(outputfile)
-        fname = os.path.basename(outputfile)
-        dname = os.path.dirname(outputfile)
-        caput( self.pv['template'], "%s%s", datatype = dbr.DBR_CHAR_STR )
-        caput( self.pv['path'], dname, datatype = dbr.DBR_CHAR_STR)
-        caput( self.pv['name'], fname, datatype = dbr.DBR_CHAR_STR)
-        caput( self.pv['mode'], "Stream", wait=True)
+        batch.put( self.pv['path'], os.path.dirname(outputfile), datatype = dbr.DBR_CHAR_STR)
+        batch.put( self.pv['name'], os.path.basename(outputfile), datatype = dbr.DBR_CHAR_STR)
+
+    def set_file_name(self, outputfile):
+        '''Set the name of the next file (safe once the current file is open: the
+        plugin only reads the name when it opens a file)'''
+        batch = PvBatch("%s set_file_name"%self.basepv)
+        self._put_file_name(batch, outputfile)
+        self.batch = batch.execute()
         
     def capture(self, num = 1):
+        batch = PvBatch("%s capture"%self.basepv)
         # first disable plugin
-        caput( self.pv['enable'], 0, wait = True)
+        batch.put( self.pv['enable'], 0)
+        batch.stage()
         # Stop capturing if we are currently doing so
         if self.capturing:
-            caput( self.pv['capture'], 0, wait=True)
+            batch.put( self.pv['capture'], 0)
         # Clear counters
-        caput( self.pv['arrays'], 0)
-        caput( self.pv['dropped'], 0)
+        batch.put( self.pv['arrays'], 0)
+        batch.put( self.pv['dropped'], 0)
         # Enable lazy open
-        caput( self.pv['lazyopen'], 1)
+        batch.put( self.pv['lazyopen'], 1)
         # Set number of images to capture
-        caput( self.pv['numcapture'], num, wait=True)
+        batch.put( self.pv['numcapture'], num)
+        batch.stage()
         # Start capturing
-        caput( self.pv['capture'], num, wait=False)
+        batch.put( self.pv['capture'], num, wait=False)
+        batch.stage()
         # Re-enable the plugin
-        caput( self.pv['enable'], 1, wait = True)
+        batch.put( self.pv['enable'], 1)
+        self.batch = batch.execute()
+        
+    def restart_capture(self, num = 1):
+        '''Start capturing the next file right after the previous one was closed,
+        when the plugin is still enabled with lazy open from capture(): only the
+        counters and the number of frames need setting.'''
+        batch = PvBatch("%s restart_capture"%self.basepv)
+        batch.put( self.pv['arrays'], 0)
+        batch.put( self.pv['dropped'], 0)
+        batch.put( self.pv['numcapture'], num)
+        batch.stage()
+        batch.put( self.pv['capture'], num, wait=False)
+        self.batch = batch.execute()
+
+    def wait_file_open(self, idle_timeout=IDLE_TIMEOUT):
+        '''Wait for the plugin to have opened the file (written the first frame)
+        or to have stopped capturing'''
+        with PvWaiter().watch(self.pv['numcaptured']).watch(self.pv['capture_rbv']) as waiter:
+            waiter.wait(lambda values: values.get(self.pv['numcaptured'], 0) >= 1
+                                       or values.get(self.pv['capture_rbv']) == 0,
+                        idle_timeout)
+
+    def wait_capture_closed(self, num, idle_timeout=IDLE_TIMEOUT):
+        '''Wait for the plugin to close the file, which it does by itself once num
+        frames are captured. If frames were dropped it never gets there: capturing is
+        then stopped as soon as all num frames are accounted for.
+        Returns (frames captured, frames dropped, full name of the written file).'''
+        with PvWaiter() as waiter:
+            waiter.watch(self.pv['capture_rbv']).watch(self.pv['numcaptured'])
+            waiter.watch(self.pv['arrays_rbv']).watch(self.pv['dropped_rbv'])
+            waiter.watch(self.pv['fullname'], datatype=dbr.DBR_CHAR_STR)
+            def closed(values):
+                return values.get(self.pv['capture_rbv']) == 0 and self.pv['numcaptured'] in values \
+                    and self.pv['fullname'] in values
+            waiter.wait(lambda values: closed(values)
+                                       or (values.get(self.pv['dropped_rbv'], 0) > 0
+                                           and values.get(self.pv['arrays_rbv'], 0)
+                                               + values.get(self.pv['dropped_rbv'], 0) >= num),
+                        idle_timeout)
+            if not closed(waiter.values):
+                caput( self.pv['capture'], 0, wait=True)
+                waiter.wait(closed, idle_timeout)
+            return (waiter.values[self.pv['numcaptured']], waiter.values.get(self.pv['dropped_rbv'], 0),
+                    waiter.values[self.pv['fullname']])
+
+    def wait_capture_started(self, idle_timeout=IDLE_TIMEOUT):
+        '''Wait for the plugin to report that capturing has started'''
+        with PvWaiter().watch(self.pv['capture_rbv']) as waiter:
+            waiter.wait(lambda values: values.get(self.pv['capture_rbv']) == 1, idle_timeout)
+        self.capturing = True
+            
+    def wait_capture_done(self, num, idle_timeout=IDLE_TIMEOUT):
+        '''Wait for num frames to be captured and the file to be closed.
+        Returns the full name of the written file.'''
+        with PvWaiter() as waiter:
+            waiter.watch(self.pv['capture_rbv']).watch(self.pv['numcaptured']).watch(self.pv['arrays_rbv'])
+            waiter.watch(self.pv['fullname'], datatype=dbr.DBR_CHAR_STR)
+            waiter.wait(lambda values: values.get(self.pv['capture_rbv']) == 0
+                                       and values.get(self.pv['numcaptured'], 0) >= num
+                                       and self.pv['fullname'] in values,
+                        idle_timeout)
+            return waiter.values[self.pv['fullname']]
+            
+    def finish_capture(self, num, idle_timeout=IDLE_TIMEOUT):
+        '''Wait until all num frames have been written or dropped, then stop capturing
+        (which closes the file if the plugin has not done so already). Unlike
+        wait_capture_done() this also returns when frames were dropped.
+        Returns (frames captured, frames dropped, full name of the written file).'''
+        with PvWaiter() as waiter:
+            waiter.watch(self.pv['arrays_rbv']).watch(self.pv['dropped_rbv'])
+            waiter.wait(lambda values: values.get(self.pv['arrays_rbv'], 0)
+                                       + values.get(self.pv['dropped_rbv'], 0) >= num,
+                        idle_timeout)
+            dropped = waiter.values.get(self.pv['dropped_rbv'], 0)
+        caput( self.pv['capture'], 0, wait=True)
+        with PvWaiter() as waiter:
+            waiter.watch(self.pv['capture_rbv']).watch(self.pv['numcaptured'])
+            waiter.watch(self.pv['fullname'], datatype=dbr.DBR_CHAR_STR)
+            waiter.wait(lambda values: values.get(self.pv['capture_rbv']) == 0
+                                       and self.pv['numcaptured'] in values
+                                       and self.pv['fullname'] in values,
+                        idle_timeout)
+            return waiter.values[self.pv['numcaptured']], dropped, waiter.values[self.pv['fullname']]
         
 class AreaDetector:
     def __init__(self, drivers, plugins):
@@ -151,17 +527,370 @@ class AreaDetector:
         for plugin in self.plugins + self.drivers:
             plugin.stop_monitor()
 
+class ScanFile:
+    '''One file of a ScanSequence and, once it has been written, how that went.
+
+    Attributes:
+        hdf_file: Name of the HDF5 file to write
+        nimages:  Number of frames
+        exposure: Exposure time (and period) in seconds
+        xml_file: XML layout of the file (or None for the plugin's current layout)
+        captured, dropped, fullname: Frames captured and dropped and the name the
+                  plugin wrote the file under
+        started:  time.time() the acquisition was started
+        closed:   time.time() the plugin reported the file closed
+        gap:      Seconds from the previous file being closed to the acquisition of
+                  this one starting: the dead time between the files (None for the first)
+    '''
+    def __init__(self, hdf_file, nimages, exposure, xml_file=None):
+        self.hdf_file = hdf_file
+        self.nimages = nimages
+        self.exposure = exposure
+        self.xml_file = xml_file
+        self.captured = None
+        self.dropped = None
+        self.fullname = None
+        self.started = None
+        self.closed = None
+        self.gap = None
+
+    @property
+    def idle_timeout(self):
+        return self.exposure * 3 + IDLE_TIMEOUT
+
+    def __str__(self):
+        s = "%s: %s frames (%s dropped)"%(self.fullname or self.hdf_file, self.captured, self.dropped)
+        if self.started is not None and self.closed is not None:
+            s += " in %.3fs"%(self.closed - self.started)
+        if self.gap is not None:
+            s += ", gap %.1fms"%(self.gap * 1000.)
+        return s
+
+class ScanSequence:
+    '''Write a sequence of ScanFiles back to back with one driver and one file
+    writer plugin, as in a fly scan of many short files.
+
+    Run in strict order (pipelined=False) each file gets the full setup of
+    run_xml_hdf_writer(): data source, layout round trip, file name, capture and
+    acquisition settings, all after the previous file has been closed.
+    Pipelined, the next file is prepared while the current one is written: its
+    layout is checked against the schema as soon as the current acquisition has
+    started, its file name is set as soon as the current file is open (the plugin
+    only reads the name when opening a file) and the driver is set up as soon as it
+    has produced the last frame of the current file. When Capture_RBV drops only the
+    capture and acquisition are restarted. A layout which differs from the current
+    file's still needs its round trip to the IOC after the close, as the plugin uses
+    the layout until then.
+    '''
+    def __init__(self, sim, hdf, pipelined=True):
+        self.sim = sim
+        self.hdf = hdf
+        self.pipelined = pipelined
+        self.files = []
+        self.elapsed = None
+
+    def run(self, files):
+        '''Write all the files. Returns the ScanFiles, with their results filled in.'''
+        self.files = files
+        start = time.time()
+        previous = None
+        with AreaDetector([self.sim], [self.hdf]):
+            for i, scan_file in enumerate(files):
+                if previous is None or not self.pipelined:
+                    self._setup(scan_file)
+                else:
+                    self._switch(previous, scan_file)
+                with hdf_trace.span("acquire", "phase", frames=scan_file.nimages):
+                    self.sim.start()
+                    scan_file.started = time.time()
+                    if previous is not None:
+                        scan_file.gap = scan_file.started - previous.closed
+                    task = None
+                    if self.pipelined and i + 1 < len(files):
+                        task = cothread.Spawn(self._prepare, scan_file, files[i+1], raise_on_wait=True)
+                    try:
+                        scan_file.captured, scan_file.dropped, scan_file.fullname = \
+                            self.hdf.wait_capture_closed(scan_file.nimages, scan_file.idle_timeout)
+                        scan_file.closed = time.time()
+                    finally:
+                        if task is not None:
+                            task.Wait()
+                previous = scan_file
+        self.elapsed = time.time() - start
+        return files
+
+    def _setup(self, scan_file):
+        with hdf_trace.span("setup", "phase"):
+            if scan_file.xml_file:
+                # Reject a bad layout before any PV is written
+                hdf_schema.check_layout(scan_file.xml_file)
+            self.hdf.set_data_source(self.sim)
+            self.hdf.configure_file(scan_file.hdf_file, scan_file.xml_file, check=False)
+            self.hdf.capture(scan_file.nimages)
+            self.hdf.wait_capture_started()
+            self.sim.prepare(scan_file.exposure, scan_file.nimages)
+
+    def _prepare(self, current, following):
+        '''Prepare the following file while the current one is being written'''
+        with hdf_trace.span("prepare", "phase"):
+            if following.xml_file:
+                hdf_schema.check_layout(following.xml_file)
+            self.hdf.wait_file_open(current.idle_timeout)
+            self.hdf.set_file_name(following.hdf_file)
+            self.sim.wait_acquire_done(current.nimages, current.idle_timeout)
+            self.sim.prepare(following.exposure, following.nimages)
+
+    def _switch(self, previous, scan_file):
+        '''Start capturing the next file, prepared by _prepare()'''
+        with hdf_trace.span("switch", "phase"):
+            if scan_file.xml_file and scan_file.xml_file != previous.xml_file:
+                self.hdf.set_layout(scan_file.xml_file, check=False)
+            self.hdf.restart_capture(scan_file.nimages)
+            self.hdf.wait_capture_started()
+
+    def gaps(self):
+        return [scan_file.gap for scan_file in self.files if scan_file.gap is not None]
+
+    def summary(self):
+        lines = [str(scan_file) for scan_file in self.files]
+        gaps = self.gaps()
+        if gaps:
+            dead_time = sum(gaps)
+            lines.append("%d files in %.3fs (%s): gap between files mean %.1fms, max %.1fms; "
+                         "dead time %.3fs (%.1f%%)"
+                         %(len(self.files), self.elapsed, "pipelined" if self.pipelined else "in order",
+                           1000. * dead_time / len(gaps), 1000. * max(gaps), dead_time,
+                           100. * dead_time / self.elapsed))
+        return "\n".join(lines)
+
+# PVs recorded by the HealthSampler for the drivers and the plugins
+HEALTH_DRIVER_FIELDS = ['ArrayCounter_RBV', 'PoolUsedMem']
+HEALTH_PLUGIN_FIELDS = ['ArrayCounter_RBV', 'DroppedArrays_RBV', 'QueueSize', 'QueueFree', 'PoolUsedMem']
+
+class TimeSeries:
+    '''The (time, value) samples of one PV, stored compactly as arrays of doubles'''
+    def __init__(self, name):
+        self.name = name
+        self.times = array.array('d')
+        self.values = array.array('d')
+
+    def append(self, t, value):
+        self.times.append(t)
+        self.values.append(value)
+
+    def __len__(self):
+        return len(self.times)
+
+    def last(self, default=None):
+        if not self.values:
+            return default
+        return self.values[-1]
+
+class HealthSampler:
+    '''Record the health of all drivers and plugins of an AreaDetector while it runs.
+    Every update of ArrayCounter_RBV and PoolUsedMem (and, for plugins, DroppedArrays_RBV,
+    QueueSize and QueueFree) is recorded through a monitor with its time since start().
+    
+    A plugin is flagged as falling behind ('events') when it drops arrays or its queue
+    fills beyond queue_high (a fraction of QueueSize). The frame rates and a summary
+    are derived from the series; save() writes them to a compressed .npz file.
+    '''
+    def __init__(self, area_detector, queue_high=0.75):
+        self.area_detector = area_detector
+        self.queue_high = queue_high
+        self.series = dict()
+        # (time, base PV, description) of the moments a plugin fell behind
+        self.events = []
+        self.handles = []
+        self.start_time = None
+        self._queue_full = dict()
+        self._dropped = dict()
+        self._dropped_event = dict()
+
+    def start(self):
+        self.start_time = time.time()
+        for device in self.area_detector.drivers:
+            self._watch(device.basepv, HEALTH_DRIVER_FIELDS)
+        for device in self.area_detector.plugins:
+            self._watch(device.basepv, HEALTH_PLUGIN_FIELDS)
+        return self
+
+    def _watch(self, basepv, fields):
+        for field in fields:
+            name = "%s:%s"%(basepv, field)
+            self.series[name] = TimeSeries(name)
+        for field in fields:
+            name = "%s:%s"%(basepv, field)
+            self.handles.append( camonitor(name, lambda value, basepv=basepv, field=field:
+                                                      self._update(basepv, field, value)) )
+
+    def _update(self, basepv, field, value):
+        now = time.time() - self.start_time
+        series = self.series["%s:%s"%(basepv, field)]
+        previous = series.last()
+        series.append(now, value)
+        if field == 'DroppedArrays_RBV' and previous is not None and value > previous:
+            # Consecutive drops are reported as one event with the total number dropped
+            dropped = value - previous
+            first = now
+            if self.events and self.events[-1][1] == basepv and self._dropped_event.get(basepv) == len(self.events):
+                dropped += self._dropped.pop(basepv)
+                first = self.events.pop()[0]
+            self.events.append( (first, basepv, "dropped %d arrays"%(dropped)) )
+            self._dropped[basepv] = dropped
+            self._dropped_event[basepv] = len(self.events)
+        elif field in ['QueueFree', 'QueueSize']:
+            size = self.series[basepv + ":QueueSize"].last(0)
+            free = self.series[basepv + ":QueueFree"].last(size)
+            used = size - free
+            # With some hysteresis so a queue hovering around the limit is reported once
+            if size > 0 and used >= self.queue_high * size and not self._queue_full.get(basepv):
+                self.events.append( (now, basepv, "queue %d/%d full"%(used, size)) )
+                self._queue_full[basepv] = True
+            elif used < self.queue_high * size / 2:
+                self._queue_full[basepv] = False
+
+    def stop(self):
+        for handle in self.handles:
+            handle.close()
+        self.handles = []
+
+    def __enter__(self):
+        return self.start()
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def frame_rates(self, basepv):
+        '''Return (times, frames/s) of the instantaneous frame rate of a device'''
+        series = self.series[basepv + ":ArrayCounter_RBV"]
+        times = numpy.frombuffer(series.times, dtype=numpy.float64)
+        counts = numpy.frombuffer(series.values, dtype=numpy.float64)
+        if times.size < 2:
+            return numpy.zeros(0), numpy.zeros(0)
+        dt = numpy.diff(times)
+        steps = numpy.diff(counts)
+        valid = (dt > 0) & (steps >= 0)
+        return times[1:][valid], steps[valid] / dt[valid]
+
+    def average_rate(self, basepv):
+        '''Average frame rate of a device from its first to its last counter update'''
+        series = self.series[basepv + ":ArrayCounter_RBV"]
+        if len(series) < 2 or series.times[-1] <= series.times[0]:
+            return 0.0
+        return (series.values[-1] - series.values[0]) / (series.times[-1] - series.times[0])
+
+    def summary(self, max_events=10):
+        '''A text summary: frames and rates per device and the first max_events falling behind events'''
+        lines = []
+        devices = [(device, False) for device in self.area_detector.drivers]
+        devices += [(device, True) for device in self.area_detector.plugins]
+        for device, is_plugin in devices:
+            times, rates = self.frame_rates(device.basepv)
+            peak_rate = 0.0
+            if rates.size:
+                peak_rate = rates.max()
+            line = "%s: %d frames, %.1f frames/s average, %.1f frames/s peak, %.1fMB peak pool"\
+                %(device.basepv, self.series[device.basepv + ":ArrayCounter_RBV"].last(0),
+                  self.average_rate(device.basepv), peak_rate,
+                  max(self.series[device.basepv + ":PoolUsedMem"].values or [0]))
+            if is_plugin:
+                size = self.series[device.basepv + ":QueueSize"].last(0)
+                free = self.series[device.basepv + ":QueueFree"].values or [size]
+                line += ", %d dropped, queue peak %d/%d"\
+                    %(self.series[device.basepv + ":DroppedArrays_RBV"].last(0), size - min(free), size)
+            lines.append(line)
+        for (t, basepv, description) in self.events[:max_events]:
+            lines.append("%8.3fs %s falling behind: %s"%(t, basepv, description))
+        if len(self.events) > max_events:
+            lines.append("... and %d more falling behind events"%(len(self.events) - max_events))
+        return "\n".join(lines)
+
+    def save(self, fname):
+        '''Save all series to a compressed numpy .npz file, see load_health()'''
+        names = sorted(self.series)
+        arrays = dict()
+        for i, name in enumerate(names):
+            arrays['t%d'%i] = numpy.frombuffer(self.series[name].times, dtype=numpy.float64)
+            arrays['v%d'%i] = numpy.frombuffer(self.series[name].values, dtype=numpy.float64)
+        numpy.savez_compressed(fname, names=numpy.array(names), start=self.start_time, **arrays)
+
+def load_health(fname):
+    '''Load a file saved by HealthSampler.save(): returns {PV: (times, values)}'''
+    data = numpy.load(fname)
+    return dict([(str(name), (data['t%d'%i], data['v%d'%i])) for i, name in enumerate(data['names'])])
+
+def tail_capture(sim, hdf, xml_file, hdf_file, exposure, nimages):
+    '''Start the acquisition and follow the file with a hdf_tail.TailValidator
+    until the plugin stops capturing. The latency to disk is measured against the
+    driver's ArrayCounter_RBV.'''
+    # h5py is only needed to follow the file
+    import hdf_tail
+    clock = hdf_tail.FrameClock()
+    handle = camonitor( sim.pv['arrays_rbv'], clock.update)
+    try:
+        started = time.time()
+        sim.acquire(exposure, nimages, wait=False)
+        validator = hdf_tail.TailValidator(hdf_xml.load_definition(xml_file), hdf_file, clock=clock,
+                                           newer_than=started)
+        result = validator.run(done=lambda: not hdf.capturing, sleep=cothread.Sleep,
+                               idle_timeout=exposure * 3 + IDLE_TIMEOUT)
+        print result
+        if result.structure:
+            # Don't waste the rest of the scan on a broken file
+            caput( sim.pv['acquire'], 0, wait=True)
+            caput( hdf.pv['capture'], 0, wait=True)
+            raise hdf_tail.StructureError(result)
+    finally:
+        handle.close()
+
 def run_xml_hdf_writer(xml_file, hdf_file, exposure=1.0, nimages=1,
                        simpv = 'TESTSIMDETECTOR:CAM',
-                       hdfpv = 'TESTSIMDETECTOR:HDF'):
-    '''Convenience function to capture a number of simulated images into an HDF5 file'''
+                       hdfpv = 'TESTSIMDETECTOR:HDF',
+                       health_file = None, tail = False, check = True):
+    '''Convenience function to capture a number of simulated images into an HDF5 file.
+    If health_file is given the driver and plugin health is sampled during the capture,
+    saved to that file and summarised.
+    With tail the file is written in SWMR mode and validated while it is written
+    (see hdf_tail). If its structure is wrong the acquisition is stopped straight
+    away and hdf_tail.StructureError raised.
+    Frames dropped by the plugin are reported rather than waited for.
+    check=False skips the schema check of the layout (for layouts which are known
+    not to match the schema but which the writer accepts).
+    Returns (frames captured, frames dropped, full name of the written file).'''
+    if xml_file and check:
+        # Reject a bad layout before any PV is written
+        hdf_schema.check_layout(xml_file)
     sim = SimDet(simpv)
     hdf = HdfPlugin(hdfpv)
-    with AreaDetector([sim], [hdf]) as ad:
-        hdf.set_data_source(sim)
-        hdf.configure_file(hdf_file, xml_file)
-        hdf.capture(nimages)
-        sim.acquire(exposure, nimages)
+    ad = AreaDetector([sim], [hdf])
+    sampler = None
+    with ad:
+        with hdf_trace.span("setup", "phase"):
+            hdf.set_data_source(sim)
+            hdf.configure_file(hdf_file, xml_file, swmr=tail, check=False)
+            hdf.capture(nimages)
+            hdf.wait_capture_started()
+        if health_file:
+            sampler = HealthSampler(ad).start()
+        try:
+            with hdf_trace.span("acquire", "phase", frames=nimages):
+                if tail:
+                    tail_capture(sim, hdf, xml_file, hdf_file, exposure, nimages)
+                else:
+                    sim.acquire(exposure, nimages)
+                captured, dropped, fullname = hdf.finish_capture(nimages, idle_timeout=exposure * 3 + IDLE_TIMEOUT)
+            if dropped:
+                print "%s dropped %d of %d frames (DroppedArrays): %d frames captured to %s"\
+                    %(hdf.basepv, dropped, nimages, captured, fullname)
+            return captured, dropped, fullname
+        finally:
+            # Don't leave the plugin capturing with the file open if anything went wrong
+            if hdf.capturing:
+                caput( hdf.pv['capture'], 0, wait=True)
+            if sampler is not None:
+                sampler.stop()
+                sampler.save(health_file)
+                print sampler.summary()
 
             
 def main():
@@ -182,11 +911,24 @@ def main():
                         help='Base PV of the simulated camera driver')
     parser.add_argument('--hdfpv', dest='hdfpv', action='store', default = "TESTSIMDETECTOR:HDF",
                         help='Base PV of the HDF5 file writer plugin')
+    parser.add_argument('--health', metavar='FILE', dest='health', action='store', default = None,
+                        help='Sample the driver and plugin health during the capture and save it to FILE (.npz)')
+    parser.add_argument('--tail', dest='tail', action='store_true', default = False,
+                        help='Write the file in SWMR mode and validate it while it is written')
+    parser.add_argument('--trace', metavar='FILE', dest='trace', action='store', default = None,
+                        help='Trace the Channel Access calls and phases to FILE (Chrome trace JSON) and summarise them')
     
     args = parser.parse_args()
     args = vars(args)
-    run_xml_hdf_writer(args['xmlfilename'], args['hdf5filename'], args['exposure'], args['numimages'],
-                       simpv=args['simpv'], hdfpv=args['hdfpv'])
+    if args['trace']:
+        hdf_trace.enable()
+    try:
+        run_xml_hdf_writer(args['xmlfilename'], args['hdf5filename'], args['exposure'], args['numimages'],
+                           simpv=args['simpv'], hdfpv=args['hdfpv'], health_file=args['health'],
+                           tail=args['tail'])
+    finally:
+        if args['trace']:
+            hdf_trace.finish(args['trace'])
     
 if __name__=="__main__":
     main()
@@ -0,0 +1,266 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('cothread')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, sys, time, argparse
+import itertools
+import csv, json
+
+from adclientxmlhdf import SimDet, HdfPlugin, AreaDetector, PvBatch, caget
+import hdf_schema
+
+# The HDF5 file writer settings swept by the benchmark: (PV field, option name, type)
+SETTINGS = [('NumRowChunks',      'row_chunks',         int),
+            ('NumColChunks',      'col_chunks',         int),
+            ('NumFramesChunks',   'frames_chunks',      int),
+            ('BoundaryAlign',     'boundary_align',     int),
+            ('BoundaryThreshold', 'boundary_threshold', int),
+            ('NumFramesFlush',    'frames_flush',       int),
+            ('Compression',       'compression',        str)]
+
+# Columns of the result files, after the frame size and settings
+RESULT_FIELDS = ['captured', 'dropped', 'elapsed', 'frames_per_s', 'mb_per_s', 'file_size']
+
+class BenchmarkPoint:
+    '''One point of the benchmark matrix: a frame size and the file writer settings'''
+    def __init__(self, xsize, ysize, settings):
+        self.xsize = xsize
+        self.ysize = ysize
+        # Dictionary {PV field: value}
+        self.settings = settings
+
+    @property
+    def key(self):
+        '''Identifies the point when comparing against a baseline'''
+        return " ".join(["%dx%d"%(self.xsize, self.ysize)] +
+                        ["%s=%s"%(field, self.settings[field]) for (field, option, type_) in SETTINGS])
+    def __repr__(self):
+        return "<BenchmarkPoint: %s>"%(self.key)
+
+class BenchmarkResult:
+    '''Throughput of the file writer at one BenchmarkPoint'''
+    def __init__(self, point, captured, dropped, elapsed, nbytes, file_size):
+        self.point = point
+        self.captured = captured
+        self.dropped = dropped
+        self.elapsed = elapsed
+        self.nbytes = nbytes
+        self.file_size = file_size
+
+    @property
+    def frames_per_s(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.captured / self.elapsed
+    @property
+    def mb_per_s(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.nbytes / self.elapsed / (1024.*1024.)
+
+    def as_dict(self):
+        row = {'key': self.point.key, 'xsize': self.point.xsize, 'ysize': self.point.ysize}
+        row.update(self.point.settings)
+        for field in RESULT_FIELDS:
+            row[field] = getattr(self, field)
+        return row
+
+    def __str__(self):
+        size = "-"
+        if self.file_size is not None:
+            size = "%.1fMB"%(self.file_size/(1024.*1024.))
+        return "%s: %d frames (%d dropped) in %.3fs, %.1f frames/s, %.1f MB/s, file %s"\
+            %(self.point.key, self.captured, self.dropped, self.elapsed, self.frames_per_s, self.mb_per_s, size)
+
+def matrix(sizes, values):
+    '''Return the list of BenchmarkPoint for all combinations of the frame sizes
+    [(xsize, ysize), ...] and the setting values {PV field: [value, ...]}'''
+    fields = [field for (field, option, type_) in SETTINGS]
+    points = []
+    for (xsize, ysize) in sizes:
+        for combination in itertools.product(*[values[field] for field in fields]):
+            points.append( BenchmarkPoint(xsize, ysize, dict(zip(fields, combination))) )
+    return points
+
+class WriterBenchmark:
+    '''Run BenchmarkPoints through a simDetector driver and HDF5 file writer plugin.
+    Each point acquires num frames in Stream mode as fast as the driver allows and
+    measures the time from the start of the acquisition until the file is closed.
+    Frames the writer could not keep up with are counted as dropped, not waited for.
+    The frame size and file writer settings are put back as they were after the run.'''
+    def __init__(self, simpv, hdfpv, directory, xml_file=None, num=100, exposure=0.0, keep=False):
+        self.sim = SimDet(simpv)
+        self.hdf = HdfPlugin(hdfpv)
+        self.directory = directory
+        self.xml_file = xml_file
+        self.num = num
+        self.exposure = exposure
+        self.keep = keep
+        # [(PV, value)] of the settings before the run, see setup()
+        self.saved = None
+
+    def setting_pvs(self):
+        '''The PVs written by run_point()'''
+        return [self.sim.basepv + ":SizeX", self.sim.basepv + ":SizeY"] + \
+            [self.hdf.basepv + ":" + field for (field, option, type_) in SETTINGS]
+
+    def setup(self):
+        '''Save the current values of the settings the benchmark points write'''
+        pvs = self.setting_pvs()
+        self.saved = zip(pvs, caget(pvs))
+
+    def teardown(self):
+        '''Restore the settings saved by setup()'''
+        if self.saved is None:
+            return
+        batch = PvBatch("benchmark restore settings")
+        for pv, value in self.saved:
+            batch.put(pv, value)
+        batch.execute()
+        self.saved = None
+
+    def run(self, points):
+        '''Run all points and return the list of BenchmarkResult'''
+        results = []
+        if self.xml_file:
+            # Reject a bad layout before any PV is written
+            hdf_schema.check_layout(self.xml_file)
+        with AreaDetector([self.sim], [self.hdf]):
+            self.setup()
+            try:
+                self.hdf.set_data_source(self.sim)
+                for i, point in enumerate(points):
+                    result = self.run_point(point, os.path.join(self.directory, "benchmark_%d.h5"%(i)))
+                    print result
+                    results.append(result)
+            finally:
+                self.teardown()
+        return results
+
+    def run_point(self, point, hdf_file):
+        batch = PvBatch("benchmark settings")
+        batch.put( self.sim.basepv + ":SizeX", point.xsize)
+        batch.put( self.sim.basepv + ":SizeY", point.ysize)
+        for field, value in point.settings.iteritems():
+            batch.put( self.hdf.basepv + ":" + field, value)
+        batch.execute()
+        self.hdf.configure_file(hdf_file, self.xml_file, check=False)
+        self.hdf.capture(self.num)
+        self.hdf.wait_capture_started()
+        start = time.time()
+        self.sim.acquire(self.exposure, self.num)
+        captured, dropped, fullname = self.hdf.finish_capture(self.num)
+        elapsed = time.time() - start
+        nbytes = captured * caget( self.sim.basepv + ":ArraySize_RBV")
+        # The file can only be measured if the IOC writes to a file system visible here
+        file_size = None
+        if os.path.exists(fullname):
+            file_size = os.path.getsize(fullname)
+            if not self.keep:
+                os.remove(fullname)
+        return BenchmarkResult(point, captured, dropped, elapsed, nbytes, file_size)
+
+def write_csv(results, fname):
+    columns = ['xsize', 'ysize'] + [field for (field, option, type_) in SETTINGS] + RESULT_FIELDS
+    with open(fname, 'wb') as f:
+        writer = csv.DictWriter(f, columns, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result.as_dict())
+
+def write_json(results, fname):
+    with open(fname, 'w') as f:
+        json.dump([result.as_dict() for result in results], f, indent=1, sort_keys=True)
+
+def load_baseline(fname):
+    '''Load the results of an earlier run (as written by write_json) keyed by point'''
+    with open(fname) as f:
+        return dict([(row['key'], row) for row in json.load(f)])
+
+def compare_baseline(results, baseline, tolerance=0.1):
+    '''Compare results against a baseline. A point regresses if its frame rate dropped
+    by more than the tolerance (a fraction) or it dropped more frames than before.
+    Returns a list of (result, baseline row, description) of the regressions.'''
+    regressions = []
+    for result in results:
+        row = baseline.get(result.point.key)
+        if row is None:
+            continue
+        if result.frames_per_s < row['frames_per_s'] * (1.0 - tolerance):
+            regressions.append( (result, row, "%.1f frames/s, baseline %.1f frames/s (%+.0f%%)"
+                                 %(result.frames_per_s, row['frames_per_s'],
+                                   100.0*(result.frames_per_s/row['frames_per_s'] - 1.0))) )
+        elif result.dropped > row['dropped']:
+            regressions.append( (result, row, "%d dropped frames, baseline %d"%(result.dropped, row['dropped'])) )
+    return regressions
+
+def main():
+    def size_list(value):
+        return [tuple([int(n) for n in size.lower().split('x')]) for size in value.split(',')]
+    parser = argparse.ArgumentParser(description="Benchmark the throughput of the HDF5 file writer plugin over "
+                                     "a matrix of frame sizes and chunking, flushing and compression settings. "
+                                     "Each setting option takes a comma separated list of values.")
+    parser.add_argument('--sizes', metavar='XxY[,XxY]', dest='sizes', type=size_list, default=[(1024, 1024)],
+                        help='Frame sizes in pixels')
+    for field, option, type_ in SETTINGS:
+        parser.add_argument('--' + option.replace('_', '-'), metavar='VALUES', dest=option, default=None,
+                            help='Values of %s'%(field))
+    parser.add_argument('--num', '-n', metavar='N', dest='numimages', action='store', type=int, default=100,
+                        help='Number of frames per point')
+    parser.add_argument('--exposure', '-e', metavar='T', dest='exposure', action='store', type=float, default=0.0,
+                        help='Camera exposure time (and period) in seconds')
+    parser.add_argument('--xml', metavar='XMLFILE', dest='xmlfile', action='store', default=None,
+                        help='XML layout file for the file writer')
+    parser.add_argument('--dir', '-d', metavar='DIR', dest='directory', action='store', default='/tmp',
+                        help='Directory the file writer writes the benchmark files to')
+    parser.add_argument('--keep', dest='keep', action='store_true', default=False,
+                        help='Keep the benchmark files')
+    parser.add_argument('--csv', metavar='FILE', dest='csv', action='store', default=None,
+                        help='Write the results to a CSV file')
+    parser.add_argument('--json', metavar='FILE', dest='json', action='store', default=None,
+                        help='Write the results to a JSON file (which can serve as a baseline)')
+    parser.add_argument('--baseline', metavar='FILE', dest='baseline', action='store', default=None,
+                        help='Compare against the JSON results of an earlier run')
+    parser.add_argument('--tolerance', metavar='FRACTION', dest='tolerance', action='store', type=float, default=0.1,
+                        help='Frame rate drop relative to the baseline which counts as a regression')
+    parser.add_argument('--simpv', dest='simpv', action='store', default = "TESTSIMDETECTOR:CAM",
+                        help='Base PV of the simulated camera driver')
+    parser.add_argument('--hdfpv', dest='hdfpv', action='store', default = "TESTSIMDETECTOR:HDF",
+                        help='Base PV of the HDF5 file writer plugin')
+    args = parser.parse_args()
+
+    defaults = {'NumRowChunks': 0, 'NumColChunks': 0, 'NumFramesChunks': 1, 'BoundaryAlign': 0,
+                'BoundaryThreshold': 65536, 'NumFramesFlush': 1, 'Compression': 'None'}
+    values = dict()
+    for field, option, type_ in SETTINGS:
+        if getattr(args, option) is None:
+            values[field] = [defaults[field]]
+        else:
+            values[field] = [type_(value) for value in getattr(args, option).split(',')]
+    points = matrix(args.sizes, values)
+    print "Running %d benchmark points of %d frames"%(len(points), args.numimages)
+
+    xml_file = None
+    if args.xmlfile:
+        xml_file = os.path.abspath(args.xmlfile)
+    benchmark = WriterBenchmark(args.simpv, args.hdfpv, os.path.abspath(args.directory), xml_file,
+                                args.numimages, args.exposure, args.keep)
+    results = benchmark.run(points)
+    if args.csv:
+        write_csv(results, args.csv)
+    if args.json:
+        write_json(results, args.json)
+    if args.baseline:
+        regressions = compare_baseline(results, load_baseline(args.baseline), args.tolerance)
+        for result, row, description in regressions:
+            print "REGRESSION %s: %s"%(result.point.key, description)
+        if regressions:
+            sys.exit(1)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,20 @@
+#!/bin/env dls-python
+import os
+
+# The tools keep their per-user caches (compiled XML layouts, HDF5 indexes) below
+# this directory. What is read back from a cache is unpickled or unmarshalled, so
+# a cache directory is only used if nobody but the current user can write to it.
+CACHE_ROOT = os.path.join(os.path.expanduser('~'), '.cache')
+
+def cache_dir(name, env):
+    '''The cache directory of one tool: the value of the environment variable env
+    if it is set, or else ~/.cache/name'''
+    return os.environ.get(env, os.path.join(CACHE_ROOT, name))
+
+def private_dir(directory):
+    '''Create directory readable by the current user only. Return False if it
+    exists but another user owns it or can write to it, so it must not be used.'''
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    stat = os.stat(directory)
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0022
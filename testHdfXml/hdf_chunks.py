@@ -0,0 +1,639 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, sys, time, argparse
+import tempfile, shutil
+import json
+import numpy
+import h5py
+
+import hdf_xml
+import hdf_index
+import hdf_ndattr
+
+DETECTOR = hdf_xml.DETECTOR
+NDATTRIBUTE = hdf_xml.NDATTRIBUTE
+
+# The read patterns of the analysis jobs benchmarked on the detector datasets
+PATTERNS = ['frame', 'roi', 'pixel']
+PATTERN_DESCRIPTIONS = {'frame': 'whole frames',
+                        'roi':   'region of interest over time',
+                        'pixel': 'single pixel time series'}
+
+# The HDF5 file writer PVs setting the chunks of the detector datasets: the same
+# NumRowChunks, NumColChunks and NumFramesChunks records as setup_hdf_writer_plugin()
+# in test_hdf_heap_corruption_bug.py writes
+WRITER_FIELDS = ['NumRowChunks', 'NumColChunks', 'NumFramesChunks']
+
+# The default size of the HDF5 chunk cache of each open dataset
+CHUNK_CACHE_BYTES = 1024*1024
+# Chunks smaller than this make reading dominated by the per-chunk overhead
+SMALL_CHUNK_BYTES = 16*1024
+# File system block size the chunks should be aligned to
+FS_BLOCK_BYTES = 4096
+
+class DatasetLayout:
+    '''How a detector or NDAttribute dataset is stored in the file.
+
+    Attributes:
+        name, role:   Full name of the dataset and DETECTOR or NDATTRIBUTE
+        shape, dtype: As in the file
+        chunks:       Chunk shape or None for a contiguous dataset
+        filters:      List of the names of the filters of the dataset (compression, shuffle..)
+        storage_size: Bytes the dataset takes in the file
+        alignment:    Largest power of two (up to 1MB) all chunks start at a multiple of,
+                      or None where the chunk offsets cannot be read
+        read_time:    Seconds to read the whole dataset (NDAttribute datasets) or None
+        issues:       List of descriptions of the problems found
+    '''
+    def __init__(self, name, role, shape, dtype, chunks, filters, storage_size, alignment):
+        self.name = name
+        self.role = role
+        self.shape = shape
+        self.dtype = dtype
+        self.chunks = chunks
+        self.filters = filters
+        self.storage_size = storage_size
+        self.alignment = alignment
+        self.read_time = None
+        self.issues = []
+
+    @property
+    def nbytes(self):
+        return int(numpy.prod(self.shape)) * self.dtype.itemsize
+    @property
+    def chunk_bytes(self):
+        if self.chunks is None:
+            return None
+        return int(numpy.prod(self.chunks)) * self.dtype.itemsize
+    @property
+    def num_chunks(self):
+        if self.chunks is None:
+            return None
+        return int(numpy.prod([-(-size // chunk) for (size, chunk) in zip(self.shape, self.chunks)]))
+    @property
+    def compression_ratio(self):
+        if not self.storage_size:
+            return None
+        return float(self.nbytes) / self.storage_size
+
+    def as_dict(self):
+        return {'name': self.name, 'role': self.role, 'shape': list(self.shape), 'dtype': str(self.dtype),
+                'chunks': self.chunks and list(self.chunks), 'filters': self.filters,
+                'storage_size': self.storage_size, 'alignment': self.alignment, 'read_time': self.read_time,
+                'issues': self.issues}
+
+    def __str__(self):
+        s = "%s (%s): %s %s"%(self.name, self.role, self.shape, self.dtype)
+        if self.chunks is None:
+            s += ", contiguous"
+        else:
+            s += ", chunks %s (%.1fkB, %d chunks)"%(self.chunks, self.chunk_bytes/1024., self.num_chunks)
+        s += ", %s"%(", ".join(self.filters) or "no filters")
+        if self.compression_ratio is not None and self.filters:
+            s += ", compression %.2f"%(self.compression_ratio)
+        if self.alignment is not None:
+            s += ", aligned to %d bytes"%(self.alignment)
+        if self.read_time is not None:
+            s += ", read in %.2fms"%(self.read_time*1000.)
+        return "\n".join([s] + ["  - " + issue for issue in self.issues])
+
+def _filters(dset):
+    plist = dset.id.get_create_plist()
+    names = []
+    for i in range(plist.get_nfilters()):
+        code, flags, values, name = plist.get_filter(i)
+        names.append(name or "filter %d"%(code))
+    return names
+
+def _alignment(offsets, limit=1024*1024):
+    alignment = limit
+    for offset in offsets:
+        while alignment > 1 and offset % alignment:
+            alignment //= 2
+    return alignment
+
+def chunk_offsets(dset, limit=64):
+    '''File offsets of the data of (at most the first limit chunks of) dset, or None
+    where the HDF5 library cannot tell (chunk offsets need HDF5 1.10.5)'''
+    if dset.chunks is None:
+        offset = dset.id.get_offset()
+        if offset is None:
+            return None
+        return [offset]
+    if not hasattr(dset.id, 'get_chunk_info'):
+        return None
+    return [dset.id.get_chunk_info(i).byte_offset for i in range(min(limit, dset.id.get_num_chunks()))]
+
+def inspect_dataset(dset, role, cache_bytes=CHUNK_CACHE_BYTES):
+    '''Return the DatasetLayout of an open dataset, with the problems of its chunking'''
+    offsets = chunk_offsets(dset)
+    alignment = None
+    if offsets:
+        alignment = _alignment(offsets)
+    layout = DatasetLayout(dset.name, role, dset.shape, dset.dtype, dset.chunks, _filters(dset),
+                           dset.id.get_storage_size(), alignment)
+    if role == DETECTOR and len(dset.shape) >= 3:
+        _detector_issues(layout, cache_bytes)
+    elif role == NDATTRIBUTE and dset.shape:
+        if layout.chunks is not None and layout.chunk_bytes < SMALL_CHUNK_BYTES and layout.num_chunks > 1:
+            layout.issues.append("%d chunks of %d bytes: reading the whole series reads %d chunks"
+                                 %(layout.num_chunks, layout.chunk_bytes, layout.num_chunks))
+    return layout
+
+def _detector_issues(layout, cache_bytes):
+    if layout.chunks is None:
+        layout.issues.append("contiguous: cannot be compressed and frames cannot be appended")
+        return
+    frame_shape = layout.shape[1:]
+    chunk_frame = layout.chunks[1:]
+    waste = float(numpy.prod([-(-size // chunk) * chunk for (size, chunk) in zip(frame_shape, chunk_frame)]))
+    waste = waste / numpy.prod(frame_shape) - 1.0
+    if waste > 0.01:
+        layout.issues.append("chunk %s does not divide the frame %s: the edge chunks are %.0f%% padding"
+                             %(chunk_frame, frame_shape, 100.*waste))
+    if layout.chunk_bytes < SMALL_CHUNK_BYTES:
+        layout.issues.append("chunks of %d bytes: reads are dominated by the per-chunk overhead"%(layout.chunk_bytes))
+    if layout.chunk_bytes > cache_bytes:
+        layout.issues.append("chunks of %.1fMB do not fit the %.1fMB chunk cache: reads of part of a chunk "
+                             "(regions, pixels) decompress the whole chunk every time"
+                             %(layout.chunk_bytes/(1024.*1024.), cache_bytes/(1024.*1024.)))
+    if layout.chunks[0] > 1 and layout.chunks[0] > layout.shape[0]:
+        layout.issues.append("%d frames per chunk but only %d frames in the file"%(layout.chunks[0], layout.shape[0]))
+    if layout.alignment is not None and layout.alignment < FS_BLOCK_BYTES and layout.chunk_bytes >= 16 * FS_BLOCK_BYTES:
+        layout.issues.append("chunks are only aligned to %d bytes: set BoundaryAlign (and BoundaryThreshold) "
+                             "to the file system block size"%(layout.alignment))
+
+def find_datasets(hdf, xml_file=None):
+    '''Return [(full name, role)] of the detector and NDAttribute datasets of an open
+    file. They are found through the XML layout if one is given; otherwise every
+    dataset of 3 or more dimensions is taken for a detector dataset, and every other
+    non-scalar dataset with one entry per detector frame for an NDAttribute dataset.'''
+    index = hdf_index.HdfIndex().build(hdf)
+    if xml_file:
+        xml_def = hdf_xml.load_definition(xml_file)
+        detectors = [name for name, (source, ndattribute, attributes) in xml_def.datasets.iteritems()
+                     if source == DETECTOR and name in index and index[name].is_dataset()]
+        ndattributes = hdf_ndattr.ndattribute_datasets(xml_def, index)
+    else:
+        detectors = [name for name in index.datasets if len(index[name].shape or ()) >= 3]
+        frames = set([index[name].shape[0] for name in detectors])
+        ndattributes = [name for name in index.datasets if name not in detectors and index[name].shape
+                        and (not frames or index[name].shape[0] in frames)]
+    return [(name, DETECTOR) for name in sorted(detectors)] + [(name, NDATTRIBUTE) for name in sorted(ndattributes)]
+
+class ReadPatterns:
+    '''The read patterns benchmarked on a detector dataset of shape (frames, y, x),
+    over the first nframes frames. The frames, the region and the pixels are drawn
+    once (from seed) so every layout of the data is read in exactly the same way.
+
+        frame: num_reads single frames in random order
+        roi:   a roi_shape region at a random position, through all the frames in one read
+        pixel: the time series of num_reads random pixels, one read each
+    '''
+    def __init__(self, shape, nframes, num_reads=16, roi_shape=(64, 64), seed=0):
+        random = numpy.random.RandomState(seed)
+        ysize, xsize = shape[1:3]
+        self.nframes = nframes
+        self.frames = random.randint(0, nframes, num_reads)
+        self.roi_shape = (min(roi_shape[0], ysize), min(roi_shape[1], xsize))
+        y0 = random.randint(0, ysize - self.roi_shape[0] + 1)
+        x0 = random.randint(0, xsize - self.roi_shape[1] + 1)
+        self.roi = (slice(0, nframes), slice(y0, y0 + self.roi_shape[0]), slice(x0, x0 + self.roi_shape[1]))
+        self.pixels = zip(random.randint(0, ysize, num_reads), random.randint(0, xsize, num_reads))
+
+    def selections(self, pattern):
+        '''The list of selections read by a pattern'''
+        if pattern == 'frame':
+            return [frame for frame in self.frames]
+        if pattern == 'roi':
+            return [self.roi]
+        if pattern == 'pixel':
+            return [(slice(0, self.nframes), y, x) for (y, x) in self.pixels]
+        raise ValueError("Unknown read pattern \'%s\'"%(pattern))
+
+    def read(self, dset, pattern):
+        '''Read the pattern from dset, returning the number of bytes read'''
+        nbytes = 0
+        for selection in self.selections(pattern):
+            nbytes += dset[selection].nbytes
+        return nbytes
+
+    def chunks_read(self, shape, chunks, pattern):
+        '''Number of chunks of the given shape a pattern touches (as if there
+        were no chunk cache)'''
+        if chunks is None:
+            return None
+        def spanned(start, stop, chunk):
+            return (stop - 1) // chunk - start // chunk + 1
+        frame_chunks = spanned(0, self.nframes, chunks[0])
+        if pattern == 'frame':
+            return len(self.frames) * spanned(0, shape[1], chunks[1]) * spanned(0, shape[2], chunks[2])
+        if pattern == 'roi':
+            return (frame_chunks * spanned(self.roi[1].start, self.roi[1].stop, chunks[1])
+                    * spanned(self.roi[2].start, self.roi[2].stop, chunks[2]))
+        return frame_chunks * len(self.pixels)
+
+class PatternResult:
+    '''Time of the best of a number of runs of one read pattern'''
+    def __init__(self, pattern, nbytes, elapsed, chunks_read=None, chunk_bytes=None):
+        self.pattern = pattern
+        self.nbytes = nbytes
+        self.elapsed = elapsed
+        self.chunks_read = chunks_read
+        self.chunk_bytes = chunk_bytes
+
+    @property
+    def mb_per_s(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.nbytes / self.elapsed / (1024.*1024.)
+    @property
+    def amplification(self):
+        '''Bytes of chunks decompressed per byte of data wanted'''
+        if self.chunks_read is None or not self.nbytes:
+            return None
+        return float(self.chunks_read * self.chunk_bytes) / self.nbytes
+
+    def as_dict(self):
+        return {'pattern': self.pattern, 'nbytes': self.nbytes, 'elapsed': self.elapsed,
+                'mb_per_s': self.mb_per_s, 'amplification': self.amplification}
+
+    def __str__(self):
+        s = "%-6s %8.2fms %9.1f MB/s"%(self.pattern, self.elapsed*1000., self.mb_per_s)
+        if self.amplification is not None:
+            s += ", read amplification %.1f"%(self.amplification)
+        return s
+
+def benchmark(hdf_file, dset_name, patterns, reads, repeat=3, cache_bytes=None):
+    '''Run each read pattern on a dataset repeat times, each time on a freshly opened
+    file (so with an empty chunk cache). Returns {pattern: PatternResult} of the best runs.'''
+    results = dict()
+    for pattern in patterns:
+        best = None
+        for i in range(repeat):
+            kargs = dict()
+            if cache_bytes is not None:
+                kargs['rdcc_nbytes'] = cache_bytes
+            with h5py.File(hdf_file, 'r', **kargs) as hdf:
+                dset = hdf[dset_name]
+                start = time.time()
+                nbytes = reads.read(dset, pattern)
+                elapsed = time.time() - start
+                chunks, chunk_bytes = dset.chunks, None
+                if chunks is not None:
+                    chunk_bytes = int(numpy.prod(chunks)) * dset.dtype.itemsize
+                if best is None or elapsed < best.elapsed:
+                    best = PatternResult(pattern, nbytes, elapsed, reads.chunks_read(dset.shape, chunks, pattern),
+                                         chunk_bytes)
+        results[pattern] = best
+    return results
+
+def writer_settings(chunks):
+    '''The HDF5 file writer PVs which give a detector dataset these (frames, y, x) chunks,
+    as {field: value}. Prefix each field with the base PV of the plugin, as
+    setup_hdf_writer_plugin() in test_hdf_heap_corruption_bug.py does.'''
+    return {'NumFramesChunks': chunks[0], 'NumRowChunks': chunks[1], 'NumColChunks': chunks[2]}
+
+def candidate_chunks(shape, itemsize, current=None, target_bytes=CHUNK_CACHE_BYTES, max_bytes=16*1024*1024):
+    '''Chunk shapes worth trying for a detector dataset of shape (frames, y, x):
+    whole frames, 1 to 64 at a time, and tiles of 1/2 to 1/8 of the frame in each
+    direction with as many frames as make up about target_bytes. The current
+    chunking comes first (clipped to the shape; None for a contiguous dataset).'''
+    nframes, ysize, xsize = shape
+    candidates = []
+    def add(chunks):
+        if chunks is None:
+            candidates.append(None)
+            return
+        chunks = tuple([max(1, min(int(chunk), size)) for (chunk, size) in zip(chunks, shape)])
+        if chunks not in candidates:
+            candidates.append(chunks)
+    add(current)
+    for frames in [1, 4, 16, 64]:
+        if frames == 1 or frames * ysize * xsize * itemsize <= max_bytes:
+            add( (frames, ysize, xsize) )
+    for fraction in [2, 4, 8]:
+        tile = (-(-ysize // fraction), -(-xsize // fraction))
+        add( (max(1, target_bytes // (tile[0] * tile[1] * itemsize)), tile[0], tile[1]) )
+    return candidates
+
+def _dataset_create_plist(dset, chunks):
+    '''A copy of the creation properties of dset (so the same filters with the same
+    settings, including dynamically loaded ones) with other chunks (None: contiguous)'''
+    plist = dset.id.get_create_plist()
+    if plist.get_layout() not in [h5py.h5d.CONTIGUOUS, h5py.h5d.CHUNKED, h5py.h5d.COMPACT]:
+        plist = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    else:
+        plist = plist.copy()
+    if chunks is None:
+        plist.set_layout(h5py.h5d.CONTIGUOUS)
+    else:
+        plist.set_chunk(chunks)
+    return plist
+
+def _speedup_text(speedup):
+    if speedup is None:
+        return "%12s"%("n/a")
+    return "%11.2fx"%(speedup)
+
+def _chunks_text(chunks):
+    if chunks is None:
+        return "contiguous"
+    return "chunks %s"%(chunks,)
+
+class CandidateResult:
+    '''The read patterns of one candidate chunking and their speedup over the current one'''
+    def __init__(self, chunks, results, storage_size):
+        self.chunks = chunks
+        self.results = results
+        self.storage_size = storage_size
+        self.speedups = dict()
+
+    def compare(self, baseline):
+        for pattern, result in self.results.iteritems():
+            reference = baseline.results.get(pattern)
+            # Patterns too fast to time on either layout have no speedup
+            if result.elapsed > 0.0 and reference is not None and reference.elapsed > 0.0:
+                self.speedups[pattern] = reference.elapsed / result.elapsed
+
+    def score(self, patterns):
+        '''Geometric mean of the speedups of the patterns'''
+        speedups = [self.speedups[pattern] for pattern in patterns if pattern in self.speedups]
+        if not speedups:
+            return None
+        return float(numpy.exp(numpy.mean(numpy.log(speedups))))
+
+    def as_dict(self):
+        return {'chunks': self.chunks and list(self.chunks), 'settings': self.chunks and writer_settings(self.chunks),
+                'storage_size': self.storage_size, 'speedups': self.speedups,
+                'results': [self.results[pattern].as_dict() for pattern in sorted(self.results)]}
+
+class ChunkAdvice:
+    '''The chunk layout analysis of one detector dataset. The recommended chunking
+    is the candidate with the best score which is at least min_speedup faster than
+    the current one and slows none of the patterns down by more than max_slowdown,
+    or the current one if no candidate is: smaller differences are timing noise, not
+    worth rewriting the writer settings for. Candidates without a speedup for all
+    the patterns (not timed, or too fast to time) are not recommended.'''
+    def __init__(self, layout, current, sample_frames, patterns, max_slowdown=2.0, min_speedup=1.1):
+        self.layout = layout
+        # {pattern: PatternResult} of the dataset as it is in the file
+        self.current = current
+        self.sample_frames = sample_frames
+        self.patterns = patterns
+        self.max_slowdown = max_slowdown
+        self.min_speedup = min_speedup
+        # CandidateResults, the rewritten sample with the current chunking first
+        self.candidates = []
+        self.notes = []
+
+    @property
+    def best(self):
+        if not self.candidates:
+            return None
+        best, best_score = self.candidates[0], self.min_speedup
+        for candidate in self.candidates[1:]:
+            if [pattern for pattern in self.patterns if pattern not in candidate.speedups]:
+                continue
+            if min([candidate.speedups[pattern] for pattern in self.patterns]) < 1.0 / self.max_slowdown:
+                continue
+            score = candidate.score(self.patterns)
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+    def best_for(self, pattern):
+        '''The fastest candidate for one pattern, or None if none is min_speedup faster than the current one'''
+        if len(self.candidates) < 2:
+            return None
+        best = max(self.candidates[1:], key=lambda candidate: candidate.speedups.get(pattern, 0.0))
+        if best.speedups.get(pattern, 0.0) < self.min_speedup:
+            return None
+        return best
+
+    def as_dict(self):
+        best = self.best
+        return {'layout': self.layout.as_dict(),
+                'current': [self.current[pattern].as_dict() for pattern in self.patterns],
+                'sample_frames': self.sample_frames, 'notes': self.notes,
+                'candidates': [candidate.as_dict() for candidate in self.candidates],
+                'recommended': best and best.as_dict()}
+
+    def summary(self):
+        lines = ["Read patterns as produced:"]
+        lines += ["  %s"%(self.current[pattern]) for pattern in self.patterns]
+        if self.candidates:
+            lines.append("Candidate chunkings, first %d frames rewritten with the same filters:"%(self.sample_frames))
+            lines.append("  %-22s %10s  %s"%("chunks", "size MB", "  ".join(["%12s"%(pattern + " speedup")
+                                                                             for pattern in self.patterns])))
+            for candidate in self.candidates:
+                lines.append("  %-22s %10.2f  %s"%(candidate.chunks or "contiguous", candidate.storage_size/(1024.*1024.),
+                                                   "  ".join([_speedup_text(candidate.speedups.get(pattern))
+                                                              for pattern in self.patterns])))
+        best = self.best
+        if best is not None and best is self.candidates[0]:
+            lines.append("Recommended: keep the current layout, %s (no candidate is %.2fx faster)"
+                         %(_chunks_text(best.chunks), self.min_speedup))
+        elif best is not None:
+            settings = writer_settings(best.chunks)
+            lines.append("Recommended: %s (expected speedup %.2fx over %s)"
+                         %(" ".join(["%s=%d"%(field, settings[field]) for field in WRITER_FIELDS]),
+                           best.score(self.patterns), ", ".join(self.patterns)))
+            for pattern in self.patterns:
+                other = self.best_for(pattern)
+                if other is not None and other is not best:
+                    lines.append("  for %s only: chunks %s, %.2fx"
+                                 %(PATTERN_DESCRIPTIONS[pattern], other.chunks, other.speedups[pattern]))
+        lines += ["Note: " + note for note in self.notes]
+        return "\n".join(lines)
+
+class ChunkAdvisor:
+    '''Benchmark the read patterns on the detector datasets of a produced file and
+    find the chunking which reads them fastest.
+
+    The first frames of the dataset (up to sample_bytes) are rewritten to temporary
+    files, once with the current chunks and once for each candidate chunking, with
+    the same filters and so the real compressibility of the data. The same reads
+    are timed on all of them; the speedups are relative to the current chunking.
+    The files are read back from the page cache, so the timings show the chunk
+    overhead and the decompression work, not the storage latency: on a network
+    file system the read amplification (bytes of chunks decompressed per byte
+    wanted) tells how much more data each read pulls from the storage.'''
+    def __init__(self, patterns=PATTERNS, sample_bytes=256*1024*1024, num_reads=16, roi_shape=(64, 64),
+                 repeat=3, cache_bytes=None, seed=0, directory=None, max_slowdown=2.0, min_speedup=1.1):
+        self.patterns = patterns
+        self.max_slowdown = max_slowdown
+        self.min_speedup = min_speedup
+        self.sample_bytes = sample_bytes
+        self.num_reads = num_reads
+        self.roi_shape = roi_shape
+        self.repeat = repeat
+        self.cache_bytes = cache_bytes
+        self.seed = seed
+        self.directory = directory
+
+    def advise(self, hdf_file, dset_name, layout):
+        shape = layout.shape
+        frame_bytes = int(numpy.prod(shape[1:])) * layout.dtype.itemsize
+        sample_frames = max(1, min(shape[0], self.sample_bytes // max(1, frame_bytes)))
+        reads = ReadPatterns(shape, sample_frames, self.num_reads, self.roi_shape, self.seed)
+        current = benchmark(hdf_file, dset_name, self.patterns, reads, self.repeat, self.cache_bytes)
+        advice = ChunkAdvice(layout, current, sample_frames, self.patterns, self.max_slowdown, self.min_speedup)
+        if len(shape) != 3:
+            advice.notes.append("chunk candidates are only tried for datasets of (frames, y, x), not %s"%(shape,))
+            return advice
+        if sample_frames < shape[0]:
+            advice.notes.append("only the first %d of %d frames are rewritten (--sample-mb)"%(sample_frames, shape[0]))
+        sample_shape = (sample_frames,) + tuple(shape[1:])
+        candidates = candidate_chunks(sample_shape, layout.dtype.itemsize, layout.chunks)
+        directory = tempfile.mkdtemp(prefix="hdf_chunks_", dir=self.directory)
+        try:
+            with h5py.File(hdf_file, 'r') as hdf:
+                dset = hdf[dset_name]
+                data = dset[:sample_frames]
+                for i, chunks in enumerate(candidates):
+                    fname = os.path.join(directory, "candidate_%d.h5"%(i))
+                    try:
+                        storage_size = self._rewrite(dset, data, fname, chunks)
+                    except Exception, e:
+                        advice.notes.append("cannot write %s: %s"%(_chunks_text(chunks), e))
+                        if not advice.candidates:
+                            # Without the current chunking there is nothing to compare against
+                            break
+                        continue
+                    results = benchmark(fname, "data", self.patterns, reads, self.repeat, self.cache_bytes)
+                    candidate = CandidateResult(chunks, results, storage_size)
+                    candidate.compare((advice.candidates or [candidate])[0])
+                    advice.candidates.append(candidate)
+                    os.remove(fname)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        return advice
+
+    def _rewrite(self, dset, data, fname, chunks):
+        with h5py.File(fname, 'w') as hdf:
+            plist = _dataset_create_plist(dset, chunks)
+            space = h5py.h5s.create_simple(data.shape)
+            copy = h5py.Dataset(h5py.h5d.create(hdf.id, "data", dset.id.get_type(), space, dcpl=plist))
+            copy[...] = data
+            hdf.flush()
+            return copy.id.get_storage_size()
+
+class FileReport:
+    '''The DatasetLayouts of the datasets of a file and the ChunkAdvice of its
+    detector datasets'''
+    def __init__(self, hdf_file):
+        self.hdf_file = hdf_file
+        self.layouts = []
+        self.advice = []
+        self.notes = []
+
+    def as_dict(self):
+        return {'file': self.hdf_file, 'datasets': [layout.as_dict() for layout in self.layouts],
+                'advice': [advice.as_dict() for advice in self.advice], 'notes': self.notes}
+
+    def summary(self):
+        lines = ["%s:"%(self.hdf_file)]
+        lines += [str(layout) for layout in self.layouts]
+        lines += ["Note: " + note for note in self.notes]
+        for advice in self.advice:
+            lines.append("")
+            lines.append("%s:"%(advice.layout.name))
+            lines.append(advice.summary())
+        return "\n".join(lines)
+
+def analyse(hdf_file, advisor, xml_file=None, datasets=None):
+    '''Inspect the detector and NDAttribute datasets of a file and run the advisor
+    on its detector datasets (or on the named datasets). Returns a FileReport.'''
+    report = FileReport(hdf_file)
+    with h5py.File(hdf_file, 'r') as hdf:
+        found = find_datasets(hdf, xml_file)
+        if datasets:
+            roles = dict(found)
+            found = [(name, roles.get(name, DETECTOR)) for name in datasets]
+        for name, role in found:
+            dset = hdf[name]
+            layout = inspect_dataset(dset, role, advisor.cache_bytes or CHUNK_CACHE_BYTES)
+            if role == NDATTRIBUTE:
+                start = time.time()
+                dset[...]
+                layout.read_time = time.time() - start
+            report.layouts.append(layout)
+    unknown = [layout.name for layout in report.layouts if layout.chunks is not None and layout.alignment is None]
+    if unknown:
+        report.notes.append("alignment of the chunks of %s cannot be determined: chunk offsets need HDF5 1.10.5 "
+                            "or later (this is HDF5 %s)"%(", ".join(unknown), h5py.version.hdf5_version))
+    for layout in report.layouts:
+        if layout.role == DETECTOR and len(layout.shape) >= 3:
+            report.advice.append(advisor.advise(hdf_file, layout.name, layout))
+    return report
+
+def main():
+    def size(value):
+        return tuple([int(n) for n in value.lower().split('x')])
+    parser = argparse.ArgumentParser(description="Inspect the chunking of the detector and NDAttribute datasets "
+                                     "of HDF5 files written by the file writer, benchmark whole frame, region of "
+                                     "interest and pixel time series reads and recommend the chunk settings")
+    parser.add_argument('hdf5files', metavar='HDF5FILE', type=str, nargs='+',
+                        help='HDF5 file to analyse')
+    parser.add_argument('--xml', metavar='XMLFILE', dest='xmlfile', action='store', default=None,
+                        help='XML layout the file was written with (to find the detector and NDAttribute datasets)')
+    parser.add_argument('--dataset', metavar='DATASET', dest='datasets', action='append', default=[],
+                        help='Full name of a detector dataset to analyse (repeat for more; default: all)')
+    parser.add_argument('--patterns', metavar='PATTERN[,PATTERN]', dest='patterns', action='store',
+                        default=",".join(PATTERNS), help='Read patterns to benchmark and optimise for (%s)'
+                        %(", ".join(["%s: %s"%(pattern, PATTERN_DESCRIPTIONS[pattern]) for pattern in PATTERNS])))
+    parser.add_argument('--reads', metavar='N', dest='reads', action='store', type=int, default=16,
+                        help='Number of frames and of pixels read')
+    parser.add_argument('--roi', metavar='YxX', dest='roi', action='store', type=size, default=(64, 64),
+                        help='Size of the region of interest')
+    parser.add_argument('--sample-mb', metavar='MB', dest='sample_mb', action='store', type=float, default=256,
+                        help='Amount of data rewritten for each candidate chunking')
+    parser.add_argument('--repeat', metavar='N', dest='repeat', action='store', type=int, default=3,
+                        help='Time the best of N runs of each read pattern')
+    parser.add_argument('--chunk-cache-mb', metavar='MB', dest='cache_mb', action='store', type=float, default=None,
+                        help='HDF5 chunk cache size of the reads (default: the HDF5 default of 1MB)')
+    parser.add_argument('--max-slowdown', metavar='FACTOR', dest='max_slowdown', action='store', type=float,
+                        default=2.0, help='Do not recommend chunks which slow any read pattern down more than this')
+    parser.add_argument('--min-speedup', metavar='FACTOR', dest='min_speedup', action='store', type=float,
+                        default=1.1, help='Only recommend chunks which are at least this much faster than the '
+                        'current ones')
+    parser.add_argument('--seed', metavar='N', dest='seed', action='store', type=int, default=0,
+                        help='Seed of the random frames, region and pixels read')
+    parser.add_argument('--tmpdir', metavar='DIR', dest='tmpdir', action='store', default=None,
+                        help='Directory for the rewritten samples (ideally on the file system analysed)')
+    parser.add_argument('--json', metavar='FILE', dest='json', action='store', default=None,
+                        help='Write the analysis of all files to a JSON file')
+    args = parser.parse_args()
+
+    patterns = args.patterns.split(',')
+    for pattern in patterns:
+        if pattern not in PATTERNS:
+            parser.error("unknown read pattern \'%s\'"%(pattern))
+    cache_bytes = None
+    if args.cache_mb is not None:
+        cache_bytes = int(args.cache_mb * 1024 * 1024)
+    xml_file = None
+    if args.xmlfile:
+        xml_file = os.path.abspath(args.xmlfile)
+    advisor = ChunkAdvisor(patterns, int(args.sample_mb * 1024 * 1024), args.reads, args.roi, args.repeat,
+                           cache_bytes, args.seed, args.tmpdir, args.max_slowdown, args.min_speedup)
+    reports = []
+    for hdf_file in args.hdf5files:
+        report = analyse(hdf_file, advisor, xml_file, args.datasets)
+        print report.summary()
+        reports.append(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([report.as_dict() for report in reports], f, indent=1, sort_keys=True)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import numpy
+
+import hdf_xml
+import hdf_index
+
+STRING = 'string'
+
+MISSING = 'missing'
+MISMATCH = 'mismatch'
+SHAPE = 'shape'
+TYPE = 'type'
+
+class AttributeMismatch:
+    '''A single difference between an XML defined attribute and the HDF5 file'''
+    def __init__(self, kind, path, name, reason, expected=None, actual=None):
+        self.kind = kind
+        self.path = path
+        self.name = name
+        self.reason = reason
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        if self.reason == MISSING:
+            return "%s \'%s\' should contain attribute \'%s\'"%(self.kind.capitalize(), self.path, self.name)
+        return "%s \'%s:%s\' constant value %s: expected %s, got %s"\
+            %(self.kind.capitalize(), self.path, self.name, self.reason, self.expected, self.actual)
+    def __repr__(self):
+        return "<AttributeMismatch: %s>"%(str(self))
+
+class AttributeComparison:
+    '''Compare all attributes of a HdfXmlDefinition against a HdfIndex in one go.
+    The expected attributes are collected once from the XML definition into
+    batches by type (int, float and string constants) so each batch can be
+    compared with a handful of NumPy array operations. Every mismatch is reported
+    rather than stopping at the first one.
+
+    Only objects which are both defined in the XML and present in the HDF5 file
+    (with the same kind) are checked. Float constants are compared with
+    numpy.isclose using the rtol and atol tolerances; the default is exact equality.
+    '''
+    def __init__(self, xml_def, rtol=0.0, atol=0.0):
+        self.rtol = rtol
+        self.atol = atol
+        # (kind, path, name) of every defined attribute
+        self.presence = []
+        # Constant attributes per type: (kind, path, name, value)
+        self.batches = {hdf_xml.INT: [], hdf_xml.FLOAT: [], STRING: []}
+        for path, (ndattr_default, attributes) in xml_def.groups.iteritems():
+            self._collect(hdf_index.GROUP, path, attributes)
+        for path, (source, ndattribute, attributes) in xml_def.datasets.iteritems():
+            self._collect(hdf_index.DATASET, path, attributes)
+
+    def _collect(self, kind, path, attributes):
+        for attribute in attributes.itervalues():
+            self.presence.append( (kind, path, attribute.name) )
+            if attribute.is_constant():
+                attr_type = attribute.type
+                if attr_type not in [hdf_xml.INT, hdf_xml.FLOAT]:
+                    attr_type = STRING
+                self.batches[attr_type].append( (kind, path, attribute.name, attribute.value) )
+
+    def compare(self, index, kind=None):
+        '''Compare against the HdfIndex and return a list of AttributeMismatch.
+        If kind is given (hdf_index.GROUP or DATASET) only that kind is checked.'''
+        def lookup(obj_kind, path):
+            if kind is not None and obj_kind != kind:
+                return None
+            info = index.objects.get(path)
+            if info is None or info.kind != obj_kind:
+                return None
+            return info.attrs
+
+        mismatches = []
+        for (obj_kind, path, name) in self.presence:
+            attrs = lookup(obj_kind, path)
+            if attrs is not None and name not in attrs:
+                mismatches.append( AttributeMismatch(obj_kind, path, name, MISSING) )
+
+        # Pair up the expected constants with the values found in the file
+        present = {}
+        for attr_type, batch in self.batches.iteritems():
+            present[attr_type] = []
+            for (obj_kind, path, name, value) in batch:
+                attrs = lookup(obj_kind, path)
+                if attrs is None or name not in attrs:
+                    continue
+                present[attr_type].append( (obj_kind, path, name, value, attrs[name]) )
+
+        mismatches += self._compare_numeric(present[hdf_xml.INT], numpy.int64)
+        mismatches += self._compare_numeric(present[hdf_xml.FLOAT], numpy.float64)
+        mismatches += self._compare_strings(present[STRING])
+        return mismatches
+
+    def _compare_numeric(self, rows, dtype):
+        mismatches = []
+        checked = []
+        expected = []
+        actual = []
+        for (obj_kind, path, name, value, hdf_value) in rows:
+            exp = numpy.asarray(value, dtype=dtype).ravel()
+            act = numpy.asarray(hdf_value).ravel()
+            if act.dtype.kind not in 'biuf':
+                mismatches.append( AttributeMismatch(obj_kind, path, name, TYPE, value, hdf_value) )
+            elif act.size != exp.size:
+                mismatches.append( AttributeMismatch(obj_kind, path, name, SHAPE, value, hdf_value) )
+            else:
+                checked.append( (obj_kind, path, name, value, hdf_value) )
+                expected.append(exp)
+                actual.append(act)
+        if not checked:
+            return mismatches
+
+        # One element-wise comparison over all values, reduced per attribute
+        sizes = numpy.array([exp.size for exp in expected])
+        starts = numpy.concatenate( ([0], numpy.cumsum(sizes)[:-1]) )
+        expected = numpy.concatenate(expected)
+        actual = numpy.concatenate(actual)
+        if dtype == numpy.float64:
+            equal = numpy.isclose(actual, expected, rtol=self.rtol, atol=self.atol)
+        else:
+            equal = (actual == expected)
+        equal = numpy.logical_and.reduceat(equal, starts)
+        for i in numpy.flatnonzero(~equal):
+            (obj_kind, path, name, value, hdf_value) = checked[i]
+            mismatches.append( AttributeMismatch(obj_kind, path, name, MISMATCH, value, hdf_value) )
+        return mismatches
+
+    def _compare_strings(self, rows):
+        mismatches = []
+        checked = []
+        for (obj_kind, path, name, value, hdf_value) in rows:
+            act = hdf_value
+            if isinstance(act, numpy.ndarray):
+                if act.size != 1:
+                    mismatches.append( AttributeMismatch(obj_kind, path, name, SHAPE, value, hdf_value) )
+                    continue
+                act = act.item()
+            checked.append( (obj_kind, path, name, value, hdf_value, act) )
+        if not checked:
+            return mismatches
+
+        expected = numpy.empty(len(checked), dtype=object)
+        expected[:] = [row[3] for row in checked]
+        actual = numpy.empty(len(checked), dtype=object)
+        actual[:] = [row[5] for row in checked]
+        equal = (actual == expected)
+        for i in numpy.flatnonzero(~equal.astype(bool)):
+            (obj_kind, path, name, value, hdf_value, act) = checked[i]
+            mismatches.append( AttributeMismatch(obj_kind, path, name, MISMATCH, value, hdf_value) )
+        return mismatches
@@ -0,0 +1,258 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import time, argparse
+import hashlib
+import collections
+from multiprocessing.pool import ThreadPool
+import numpy
+import h5py
+
+# Upper limit of the size of a block of frames read from the file at a time
+MAX_BLOCK_BYTES = 16*1024*1024
+
+def frame_checksum(frame):
+    '''SHA1 hex digest of the raw content of a single frame'''
+    return hashlib.sha1(numpy.ascontiguousarray(frame).tobytes()).hexdigest()
+
+class LinearRampPattern:
+    '''The deterministic image generated by the simDetector in LinearRamp mode from
+    its Gain, GainX and GainY settings (see SimDet.linear_ramp() to read them from
+    the driver). When the image is reset the driver computes pixel (y, x) as
+    Gain*(GainX*x + GainY*y) in the data type of the frames; every following frame
+    adds Gain to all pixels, wrapping around. The image is reset by the Reset PV and
+    whenever a setting such as the gains or the frame size changes, so frame n of a
+    file holds offset + Gain*(GainX*x + GainY*y + n): offset depends on the frames
+    acquired since the last reset. With offset None it is taken from the first
+    frame checked.'''
+    def __init__(self, gain, gain_x, gain_y, offset=None):
+        self.gain = gain
+        self.gain_x = gain_x
+        self.gain_y = gain_y
+        self.offset = offset
+
+    def _increment(self, dtype):
+        if numpy.dtype(dtype).kind in 'iu':
+            # The driver adds the gain converted to the pixel type
+            return int(self.gain)
+        return self.gain
+
+    def calibrate(self, frame, index=0):
+        '''Set the offset from frame index of the file (a single frame)'''
+        value = frame[(0,) * frame.ndim]
+        if numpy.dtype(frame.dtype).kind in 'iu':
+            value = int(value)
+        self.offset = value - self._increment(frame.dtype) * index
+        return self
+
+    def expected(self, start, count, shape, dtype):
+        '''Return the expected frames start..start+count-1 of the given (y, x) shape'''
+        ysize, xsize = shape
+        increment = self._increment(dtype)
+        ramp = increment * (self.gain_y * numpy.arange(ysize, dtype=numpy.float64)[:, None]
+                            + self.gain_x * numpy.arange(xsize, dtype=numpy.float64)[None, :])
+        offset = self.offset or 0
+        if numpy.dtype(dtype).kind in 'iu':
+            # Integer pixels wrap around: compute them exactly in 64 bit before converting
+            ramp = numpy.trunc(ramp).astype(numpy.int64)
+            frames = offset + increment * numpy.arange(start, start+count, dtype=numpy.int64)
+        else:
+            frames = offset + increment * numpy.arange(start, start+count, dtype=numpy.float64)
+        return (frames[:, None, None] + ramp[None, :, :]).astype(dtype)
+
+    def check_block(self, start, block):
+        '''Return a list of (frame, problem) for the frames in block'''
+        if block.ndim != 3:
+            return [(start, "LinearRamp pattern needs 2D frames, got shape %s"%(block.shape[1:],))]
+        if self.offset is None:
+            self.calibrate(block[0], start)
+        expected = self.expected(start, block.shape[0], block.shape[1:], block.dtype)
+        bad = numpy.flatnonzero( (block != expected).reshape(block.shape[0], -1).any(axis=1) )
+        return [(start + i, "does not match the LinearRamp pattern") for i in bad]
+
+class ChecksumManifest:
+    '''Per-frame checksums of a known good detector dataset.
+    The manifest file has one line per frame: <frame index> <sha1 hex digest>'''
+    def __init__(self, checksums=None):
+        self._set_checksums(checksums or [])
+
+    def _set_checksums(self, checksums):
+        # The map from checksum to frame is complete before it is published, as it is
+        # read by the worker threads of stream_frames()
+        frames_by_checksum = dict()
+        for frame, known in enumerate(checksums):
+            frames_by_checksum.setdefault(known, frame)
+        self.checksums = checksums
+        self._frames_by_checksum = frames_by_checksum
+
+    def load(self, fname):
+        checksums = dict()
+        with open(fname) as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                frame, checksum = line.split()
+                checksums[int(frame)] = checksum
+        self._set_checksums([checksums[frame] for frame in sorted(checksums)])
+        return self
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            for frame, checksum in enumerate(self.checksums):
+                f.write("%d %s\n"%(frame, checksum))
+
+    def check_block(self, start, block):
+        '''Return a list of (frame, problem) for the frames in block'''
+        problems = []
+        for i in range(block.shape[0]):
+            frame = start + i
+            checksum = frame_checksum(block[i])
+            if frame >= len(self.checksums):
+                problems.append( (frame, "is not in the manifest") )
+            elif checksum != self.checksums[frame]:
+                problems.append( (frame, self._describe(checksum)) )
+        return problems
+
+    def _describe(self, checksum):
+        # Tell reordered frames apart from corrupted ones
+        if checksum in self._frames_by_checksum:
+            return "holds the content of frame %d"%(self._frames_by_checksum[checksum])
+        return "checksum does not match the manifest"
+
+class _ChecksumCollector:
+    '''Reference which records the checksums instead of checking them'''
+    def check_block(self, start, block):
+        return [(start + i, frame_checksum(block[i])) for i in range(block.shape[0])]
+
+class FrameCheckResult:
+    '''Outcome of a streamed frame data check'''
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.frames = 0
+        self.nbytes = 0
+        self.elapsed = 0.0
+        self.problems = []
+
+    @property
+    def mb_per_s(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.nbytes / self.elapsed / (1024.*1024.)
+
+    def __str__(self):
+        return "%s: %d frames, %d problems, %.1f MB in %.3fs (%.1f MB/s)"\
+            %(self.dataset, self.frames, len(self.problems), self.nbytes/(1024.*1024.), self.elapsed, self.mb_per_s)
+
+def block_frames(dset, max_block_bytes=MAX_BLOCK_BYTES):
+    '''Number of frames to read at a time: a whole number of chunks along the frame
+    axis, as many as fit into max_block_bytes (but at least one chunk).'''
+    frame_bytes = max(1, dset.dtype.itemsize * int(numpy.prod(dset.shape[1:])))
+    chunk_frames = 1
+    if dset.chunks:
+        chunk_frames = dset.chunks[0]
+    return chunk_frames * max(1, max_block_bytes // (frame_bytes * chunk_frames))
+
+def stream_frames(dset, reference, workers=4, max_block_bytes=MAX_BLOCK_BYTES):
+    '''Read the frames of dset in chunk aligned blocks and run reference.check_block
+    on them in a pool of worker threads. At most 2*workers blocks are in flight at
+    any time, so memory use is bounded by the block size regardless of file size.
+    Returns a FrameCheckResult with the (frame, problem) tuples sorted by frame.'''
+    result = FrameCheckResult(dset.name)
+    if not dset.shape:
+        result.problems.append( (0, "is a scalar, not a stack of frames") )
+        return result
+    nframes = dset.shape[0]
+    if isinstance(reference, LinearRampPattern) and reference.offset is None and nframes:
+        # Calibrate before the blocks are checked in parallel, in whatever order
+        reference.calibrate(dset[0])
+    step = block_frames(dset, max_block_bytes)
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    start_time = time.time()
+    try:
+        for start in xrange(0, nframes, step):
+            # The HDF5 library serialises reads (and decompression), so the blocks are
+            # read here while the checks of earlier blocks run in the thread pool.
+            block = dset[start:start+step]
+            result.nbytes += block.nbytes
+            pending.append( pool.apply_async(reference.check_block, (start, block)) )
+            while len(pending) >= 2*workers:
+                result.problems += pending.popleft().get()
+        while pending:
+            result.problems += pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+    result.elapsed = time.time() - start_time
+    result.frames = nframes
+    result.problems.sort()
+    return result
+
+def check_frames(hdf_file, dset_name, reference, workers=4, max_block_bytes=MAX_BLOCK_BYTES):
+    '''Check the frames of a detector dataset against a reference (a LinearRampPattern
+    or a ChecksumManifest). Returns a FrameCheckResult.'''
+    with h5py.File(hdf_file, 'r') as hdf:
+        return stream_frames(hdf[dset_name], reference, workers, max_block_bytes)
+
+def create_manifest(hdf_file, dset_name, workers=4, max_block_bytes=MAX_BLOCK_BYTES):
+    '''Create a ChecksumManifest from the frames of a known good dataset'''
+    with h5py.File(hdf_file, 'r') as hdf:
+        result = stream_frames(hdf[dset_name], _ChecksumCollector(), workers, max_block_bytes)
+    return ChecksumManifest([checksum for (frame, checksum) in result.problems])
+
+def add_ramp_arguments(parser):
+    '''Add the options setting up a LinearRampPattern to an argparse parser'''
+    parser.add_argument('--gain', metavar='G', dest='gain', action='store', type=float, default=None,
+                        help='LinearRamp pattern: the Gain of the simDetector')
+    parser.add_argument('--gain-x', metavar='GX', dest='gain_x', action='store', type=float, default=None,
+                        help='LinearRamp pattern: the GainX of the simDetector')
+    parser.add_argument('--gain-y', metavar='GY', dest='gain_y', action='store', type=float, default=None,
+                        help='LinearRamp pattern: the GainY of the simDetector')
+    parser.add_argument('--ramp-offset', metavar='V', dest='ramp_offset', action='store', type=float, default=None,
+                        help='LinearRamp pattern: pixel (0, 0) of the first frame (default: as found in the file)')
+
+def ramp_from_arguments(parser, args):
+    '''The LinearRampPattern of the options added by add_ramp_arguments()'''
+    if None in [args.gain, args.gain_x, args.gain_y]:
+        parser.error("the LinearRamp pattern needs the --gain, --gain-x and --gain-y of the simDetector")
+    return LinearRampPattern(args.gain, args.gain_x, args.gain_y, args.ramp_offset)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the frames of a detector dataset against "
+                                     "the simDetector LinearRamp pattern or a checksum manifest")
+    parser.add_argument('hdf5filename', metavar='HDF5FILE', type=str,
+                        help='HDF5 file to check')
+    parser.add_argument('dataset', metavar='DATASET', type=str,
+                        help='Full name of the detector dataset')
+    parser.add_argument('--manifest', '-m', metavar='FILE', dest='manifest', action='store', default=None,
+                        help='Check against this checksum manifest instead of the LinearRamp pattern')
+    parser.add_argument('--write-manifest', metavar='FILE', dest='write_manifest', action='store', default=None,
+                        help='Write a checksum manifest of the dataset instead of checking it')
+    parser.add_argument('--workers', '-w', metavar='N', dest='workers', action='store', type=int, default=4,
+                        help='Number of worker threads')
+    add_ramp_arguments(parser)
+    args = parser.parse_args()
+
+    if args.write_manifest:
+        manifest = create_manifest(args.hdf5filename, args.dataset, args.workers)
+        manifest.save(args.write_manifest)
+        print "Wrote %d checksums to %s"%(len(manifest.checksums), args.write_manifest)
+        return
+    if args.manifest:
+        reference = ChecksumManifest().load(args.manifest)
+    else:
+        reference = ramp_from_arguments(parser, args)
+    result = check_frames(args.hdf5filename, args.dataset, reference, args.workers)
+    for frame, problem in result.problems:
+        print "Frame %d %s"%(frame, problem)
+    print result
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, argparse
+import gzip
+import hashlib
+import tempfile
+import cPickle as pickle
+import h5py
+
+import hdf_cache
+import hdf_trace
+
+GROUP = 'group'
+DATASET = 'dataset'
+
+# Bump this whenever the layout of the pickled index changes so old cached
+# indexes are rebuilt rather than misread.
+INDEX_VERSION = 1
+
+# Private per-user directory of saved indexes. Never next to the data files:
+# unpickling a file anyone with write access to the data directory could have
+# put there would run their code.
+CACHE_DIR = hdf_cache.cache_dir('hdf_index', 'HDF_INDEX_CACHE_DIR')
+
+class HdfObjectInfo:
+    '''Metadata of a single group or dataset in a HDF5 file.
+
+    Attributes:
+        name:        Full name of the object
+        kind:        GROUP or DATASET
+        attrs:       Dictionary of the HDF5 attributes {Name: value}
+        shape:       Dataset shape (None for groups)
+        dtype:       Dataset numpy dtype (None for groups)
+        chunks:      Dataset chunk shape or None if not chunked
+        compression: Dataset compression filter name or None
+        compression_opts: Options of the compression filter or None
+    '''
+    def __init__(self, name, kind, attrs):
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs
+        self.shape = None
+        self.dtype = None
+        self.chunks = None
+        self.compression = None
+        self.compression_opts = None
+
+    def is_group(self):
+        return self.kind == GROUP
+    def is_dataset(self):
+        return self.kind == DATASET
+    def __repr__(self):
+        s = "<HdfObjectInfo: %s %s"%(self.kind, self.name)
+        if self.is_dataset():
+            s += " %s %s"%(self.shape, self.dtype)
+        s += ">"
+        return s
+
+class HdfIndex:
+    '''In-memory index of the groups and datasets of a HDF5 file and their attributes.
+    The index is built in a single pass over the file so checks can be run against
+    it without any further access to the file. It can be saved to (and loaded from)
+    a gzipped file in the private index cache directory.
+
+    Attributes:
+        filename: Name of the indexed HDF5 file
+        stat:     (size, mtime) of the HDF5 file when it was indexed
+        objects:  Dictionary of HdfObjectInfo with full names as keys
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.stat = None
+        self.objects = dict()
+
+    def __contains__(self, name):
+        return name in self.objects
+    def __getitem__(self, name):
+        return self.objects[name]
+    def __len__(self):
+        return len(self.objects)
+
+    @property
+    def groups(self):
+        '''Sorted list of the full names of all groups'''
+        return sorted([name for (name, info) in self.objects.iteritems() if info.is_group()])
+    @property
+    def datasets(self):
+        '''Sorted list of the full names of all datasets'''
+        return sorted([name for (name, info) in self.objects.iteritems() if info.is_dataset()])
+
+    def build(self, hdf):
+        '''Index all objects of an open h5py.File'''
+        self.filename = hdf.filename
+        self.stat = _file_stat(hdf.filename)
+        self.objects = dict()
+        self._add("/", hdf)
+        hdf.visititems(lambda name, obj: self._add("/"+name, obj))
+        return self
+
+    def _add(self, name, obj):
+        if isinstance(obj, h5py.Dataset):
+            info = HdfObjectInfo(name, DATASET, dict(obj.attrs.items()))
+            info.shape = obj.shape
+            info.dtype = obj.dtype
+            info.chunks = obj.chunks
+            info.compression = obj.compression
+            info.compression_opts = obj.compression_opts
+        elif isinstance(obj, h5py.Group):
+            info = HdfObjectInfo(name, GROUP, dict(obj.attrs.items()))
+        else:
+            return
+        self.objects[name] = info
+
+    def is_current(self):
+        '''Check whether the indexed file is unchanged since it was indexed'''
+        return self.stat is not None and self.stat == _file_stat(self.filename)
+
+    def save(self, index_file):
+        with gzip.open(index_file, 'wb') as f:
+            pickle.dump( (INDEX_VERSION, self.filename, self.stat, self.objects), f, pickle.HIGHEST_PROTOCOL)
+
+    def load(self, index_file):
+        with gzip.open(index_file, 'rb') as f:
+            version, filename, stat, objects = pickle.load(f)
+        if version != INDEX_VERSION:
+            raise ValueError("Saved index \'%s\' has version %s (expected %s)"%(index_file, version, INDEX_VERSION))
+        self.filename, self.stat, self.objects = filename, stat, objects
+        return self
+
+def _file_stat(filename):
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime)
+
+def cache_name(hdf_file, cache_dir=None):
+    '''The name of the cached index of hdf_file in its current state: keyed by the
+    absolute path, size and mtime, so a changed file never finds a stale entry.'''
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    key = "%s:%d:%r"%((os.path.abspath(hdf_file),) + _file_stat(hdf_file))
+    return os.path.join(cache_dir, "%s-v%d.index"%(hashlib.sha1(key).hexdigest(), INDEX_VERSION))
+
+def index_file(hdf_file, cache=False, cache_dir=None):
+    '''Return the HdfIndex of hdf_file.
+    If cache is True an index saved in the private cache directory (CACHE_DIR
+    unless cache_dir is given) is used as long as the file has not changed since,
+    and a new index is saved there.'''
+    if cache:
+        try:
+            name = cache_name(hdf_file, cache_dir)
+            if os.path.exists(name) and hdf_cache.private_dir(os.path.dirname(name)):
+                index = HdfIndex().load(name)
+                if index.is_current() and os.path.abspath(index.filename) == os.path.abspath(hdf_file):
+                    return index
+        except Exception:
+            # A damaged or unreadable saved index is rebuilt
+            pass
+    with hdf_trace.span("HdfIndex.build", "index", file=hdf_file):
+        with h5py.File(hdf_file, 'r') as hdf:
+            index = HdfIndex().build(hdf)
+    if cache:
+        try:
+            name = cache_name(hdf_file, cache_dir)
+            if hdf_cache.private_dir(os.path.dirname(name)):
+                # Write to a temporary file first so a concurrent reader never sees half an index
+                fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(name), suffix='.tmp')
+                os.close(fd)
+                index.save(tmpname)
+                os.rename(tmpname, name)
+        except (IOError, OSError):
+            # A read-only or full disk just means we don't get a persistent cache
+            pass
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description="Build (or refresh) the cached metadata index of HDF5 files")
+    parser.add_argument('hdf5files', metavar='HDF5FILE', type=str, nargs='+',
+                        help='HDF5 file to index')
+    args = parser.parse_args()
+    for hdf_file in args.hdf5files:
+        index = index_file(hdf_file, cache=True)
+        print "%s: %d groups, %d datasets -> %s"%(hdf_file, len(index.groups), len(index.datasets), cache_name(hdf_file))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('cothread')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, sys, time, argparse
+
+from adclientxmlhdf import SimDet, HdfPlugin, AreaDetector, HealthSampler, IDLE_TIMEOUT, cothread, caget, caput
+import hdf_schema
+
+class CaptureResult:
+    '''Throughput of one driver/plugin pair of a multi-detector capture'''
+    def __init__(self, simpv, hdfpv, fullname, captured, dropped, elapsed, nbytes):
+        self.simpv = simpv
+        self.hdfpv = hdfpv
+        self.fullname = fullname
+        self.captured = captured
+        self.dropped = dropped
+        self.elapsed = elapsed
+        self.nbytes = nbytes
+
+    @property
+    def frames_per_s(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.captured / self.elapsed
+    @property
+    def mb_per_s(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.nbytes / self.elapsed / (1024.*1024.)
+
+    def __str__(self):
+        return "%s -> %s: %d frames (%d dropped) in %.3fs, %.1f frames/s, %.1f MB/s"\
+            %(self.simpv, self.hdfpv, self.captured, self.dropped, self.elapsed, self.frames_per_s, self.mb_per_s)
+
+class MultiCaptureReport:
+    '''The CaptureResults of all pairs and the total throughput. The total rates are
+    over the wall clock time from the common start until the last file was closed.'''
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def captured(self):
+        return sum([result.captured for result in self.results])
+    @property
+    def dropped(self):
+        return sum([result.dropped for result in self.results])
+    @property
+    def nbytes(self):
+        return sum([result.nbytes for result in self.results])
+    @property
+    def frames_per_s(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.captured / self.elapsed
+    @property
+    def mb_per_s(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.nbytes / self.elapsed / (1024.*1024.)
+
+    def __str__(self):
+        return "\n".join([str(result) for result in self.results] +
+                         ["Total %d detectors: %d frames (%d dropped) in %.3fs, %.1f frames/s, %.1f MB/s"
+                          %(len(self.results), self.captured, self.dropped, self.elapsed,
+                            self.frames_per_s, self.mb_per_s)])
+
+def run_all(function, arguments):
+    '''Run function(*args) for all args in arguments concurrently (as cothread tasks)
+    and wait for all of them. Returns the list of results; the first exception of
+    any of them is raised once all have finished.'''
+    tasks = [cothread.Spawn(function, *args, raise_on_wait=True) for args in arguments]
+    results = []
+    error = None
+    for task in tasks:
+        try:
+            results.append(task.Wait())
+        except Exception:
+            if error is None:
+                error = sys.exc_info()
+    if error is not None:
+        raise error[0], error[1], error[2]
+    return results
+
+class MultiDetector:
+    '''Capture from N simDetector driver / HDF5 file writer plugin pairs at the same time.
+    The pairs can be on one or several IOCs. All pairs (plugins and drivers) are set up
+    concurrently, then the acquisitions are started together with nothing but the
+    Acquire writes in one call, and all captures are waited for together, so the IOC
+    hosts and the file system see the combined load of all detectors.
+    Each plugin writes <directory>/<plugin base PV>.h5 (with ':' replaced by '_').'''
+    def __init__(self, pairs, directory, xml_file=None):
+        # Connecting goes through the shared PV pool: create the objects up front
+        self.sims = [SimDet(simpv) for (simpv, hdfpv) in pairs]
+        self.hdfs = [HdfPlugin(hdfpv) for (simpv, hdfpv) in pairs]
+        self.directory = directory
+        self.xml_file = xml_file
+        self.area_detector = AreaDetector(self.sims, self.hdfs)
+
+    def hdf_file(self, hdf):
+        return os.path.join(self.directory, hdf.basepv.replace(':', '_') + ".h5")
+
+    def _setup(self, sim, hdf, exposure, nimages):
+        hdf.set_data_source(sim)
+        hdf.configure_file(self.hdf_file(hdf), self.xml_file, check=False)
+        hdf.capture(nimages)
+        hdf.wait_capture_started()
+        sim.prepare(exposure, nimages)
+
+    def _start(self):
+        '''Start the acquisition of all (prepared) drivers, in one caput'''
+        caput( [sim.pv['acquire'] for sim in self.sims], 1, repeat_value=True, wait=False)
+
+    def _run(self, sim, hdf, exposure, nimages, start):
+        captured, dropped, fullname = hdf.finish_capture(nimages, idle_timeout=exposure * 3 + IDLE_TIMEOUT)
+        elapsed = time.time() - start
+        nbytes = captured * caget( sim.basepv + ":ArraySize_RBV")
+        return CaptureResult(sim.basepv, hdf.basepv, fullname, captured, dropped, elapsed, nbytes)
+
+    def run(self, exposure, nimages, health_file=None):
+        '''Capture nimages on every pair. Returns a MultiCaptureReport. If health_file
+        is given the health of all drivers and plugins is sampled and saved to it.'''
+        pairs = zip(self.sims, self.hdfs)
+        sampler = None
+        if self.xml_file:
+            # Reject a bad layout before any PV of any pair is written
+            hdf_schema.check_layout(self.xml_file)
+        with self.area_detector:
+            run_all(self._setup, [(sim, hdf, exposure, nimages) for (sim, hdf) in pairs])
+            if health_file:
+                sampler = HealthSampler(self.area_detector).start()
+            try:
+                start = time.time()
+                self._start()
+                results = run_all(self._run, [(sim, hdf, exposure, nimages, start) for (sim, hdf) in pairs])
+                elapsed = time.time() - start
+            finally:
+                if sampler is not None:
+                    sampler.stop()
+                    sampler.save(health_file)
+                    print sampler.summary()
+        return MultiCaptureReport(results, elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture from several simDetector / HDF5 file writer pairs "
+                                     "at the same time and report the per-detector and total throughput")
+    parser.add_argument('--detector', metavar=('SIMPV', 'HDFPV'), dest='detectors', action='append', nargs=2,
+                        default=[], help='Base PVs of a driver and its file writer plugin (repeat for more pairs)')
+    parser.add_argument('--prefix', metavar='PREFIX', dest='prefixes', action='append', default=[],
+                        help='Shorthand for --detector PREFIX:CAM PREFIX:HDF (repeat for more pairs)')
+    parser.add_argument('--num', '-n', metavar='N', dest='numimages', action='store', type=int, default=100,
+                        help='Number of images to record per detector')
+    parser.add_argument('--exposure', '-e', metavar='T', dest='exposure', action='store', type=float, default=0.01,
+                        help='Camera exposure time (and period) in seconds')
+    parser.add_argument('--xml', metavar='XMLFILE', dest='xmlfile', action='store', default=None,
+                        help='XML layout file for the file writers')
+    parser.add_argument('--dir', '-d', metavar='DIR', dest='directory', action='store', default='/tmp',
+                        help='Directory the file writers write to')
+    parser.add_argument('--health', metavar='FILE', dest='health', action='store', default=None,
+                        help='Sample the health of all drivers and plugins and save it to FILE (.npz)')
+    args = parser.parse_args()
+
+    pairs = [tuple(detector) for detector in args.detectors]
+    pairs += [(prefix + ":CAM", prefix + ":HDF") for prefix in args.prefixes]
+    if not pairs:
+        parser.error("no detectors given: use --detector or --prefix")
+    xml_file = None
+    if args.xmlfile:
+        xml_file = os.path.abspath(args.xmlfile)
+    multi = MultiDetector(pairs, os.path.abspath(args.directory), xml_file)
+    print multi.run(args.exposure, args.numimages, args.health)
+
+if __name__=="__main__":
+    main()
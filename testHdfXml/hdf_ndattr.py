@@ -0,0 +1,167 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import posixpath
+import numpy
+import h5py
+
+import hdf_xml
+
+ON_FILE_OPEN = 'OnFileOpen'
+ON_FILE_CLOSE = 'OnFileClose'
+
+# NDAttributes which count frames and must increase by exactly one per frame
+COUNTER_NDATTRIBUTES = ['ArrayCounter', 'NDArrayUniqueId']
+# NDAttributes which hold a time stamp and must never decrease
+TIMESTAMP_NDATTRIBUTES = ['NDArrayTimeStamp', 'NDArrayEpicsTSSec', 'TimeStamp']
+
+# Number of frames read from a dataset at a time
+CHUNK_SIZE = 1024*1024
+
+def ndattribute_datasets(xml_def, index):
+    '''Return a dictionary {full name: NDAttribute name} of the per-frame NDAttribute
+    datasets present in the indexed file. These are the datasets defined with
+    source="ndattribute" in the XML, plus the datasets placed in the group marked
+    as ndattr_default (which are named after their NDAttribute).'''
+    datasets = dict()
+    for name, (source, ndattribute, attributes) in xml_def.datasets.iteritems():
+        if source == hdf_xml.NDATTRIBUTE and name in index and index[name].is_dataset():
+            datasets[name] = ndattribute
+    default_groups = [name for name, (ndattr_default, attributes) in xml_def.groups.iteritems()
+                      if ndattr_default]
+    for name in index.datasets:
+        if name in xml_def.datasets or name in datasets:
+            continue
+        if posixpath.dirname(name) in default_groups:
+            datasets[name] = posixpath.basename(name)
+    return datasets
+
+def detector_frames(xml_def, index):
+    '''Return the number of frames in the detector datasets of the indexed file
+    (the largest first dimension of all detector datasets) or None if there are none.'''
+    frames = [index[name].shape[0] for name, (source, ndattribute, attributes) in xml_def.datasets.iteritems()
+              if source == hdf_xml.DETECTOR and name in index and index[name].is_dataset() and index[name].shape]
+    if not frames:
+        return None
+    return max(frames)
+
+def iter_chunks(dset, chunk_size=CHUNK_SIZE):
+    '''Yield (start, block) for consecutive blocks of at most chunk_size frames of dset'''
+    for start in xrange(0, dset.shape[0], chunk_size):
+        yield start, dset[start:start+chunk_size]
+
+def frame_rows(block, dtype):
+    '''Return a block of frames as a 2-D (frames x values per frame) array so the
+    first axis stays the frame axis whatever the rank of the dataset.'''
+    return numpy.asarray(block, dtype=dtype).reshape(block.shape[0], -1)
+
+def row_text(row):
+    '''Format one frame's values for a problem description'''
+    if row.size == 1:
+        return str(row[0])
+    return str(row.tolist())
+
+def check_counter(name, dset, chunk_size=CHUNK_SIZE):
+    '''Check that a frame counter dataset increases by exactly one from frame to frame.
+    Returns a list of problem descriptions.'''
+    gaps = 0
+    first_gap = None
+    previous = None
+    for start, block in iter_chunks(dset, chunk_size):
+        block = frame_rows(block, numpy.int64)
+        if previous is not None:
+            block = numpy.concatenate((previous, block))
+            start -= 1
+        steps = numpy.flatnonzero((numpy.diff(block, axis=0) != 1).any(axis=1))
+        if steps.size:
+            gaps += steps.size
+            if first_gap is None:
+                first_gap = (start + steps[0] + 1, row_text(block[steps[0]]), row_text(block[steps[0]+1]))
+        previous = block[-1:]
+    if gaps:
+        return ["NDAttribute dataset \'%s\' counter has %d gaps; first at frame %d: %s -> %s"
+                %((name, gaps) + first_gap)]
+    return []
+
+def check_monotonic(name, dset, chunk_size=CHUNK_SIZE):
+    '''Check that a time stamp dataset never decreases from frame to frame.
+    Returns a list of problem descriptions.'''
+    steps_back = 0
+    first = None
+    previous = None
+    for start, block in iter_chunks(dset, chunk_size):
+        block = frame_rows(block, numpy.float64)
+        if previous is not None:
+            block = numpy.concatenate((previous, block))
+            start -= 1
+        back = numpy.flatnonzero((numpy.diff(block, axis=0) < 0).any(axis=1))
+        if back.size:
+            steps_back += back.size
+            if first is None:
+                first = (start + back[0] + 1, row_text(block[back[0]]), row_text(block[back[0]+1]))
+        previous = block[-1:]
+    if steps_back:
+        return ["NDAttribute dataset \'%s\' time stamp decreases %d times; first at frame %d: %s -> %s"
+                %((name, steps_back) + first)]
+    return []
+
+def check_when_scalars(xml_def, index):
+    '''Check that all NDAttribute sourced HDF5 attributes which are written once
+    (when="OnFileOpen" or "OnFileClose") hold a single value.
+    Returns a list of problem descriptions.'''
+    problems = []
+    for attribute in xml_def.attributes:
+        if not attribute.is_ndattribute() or attribute.when not in [ON_FILE_OPEN, ON_FILE_CLOSE]:
+            continue
+        if attribute.parent not in index or attribute.name not in index[attribute.parent].attrs:
+            continue
+        value = index[attribute.parent].attrs[attribute.name]
+        if numpy.asarray(value).size != 1:
+            problems.append("Attribute \'%s:%s\' (%s) should be a scalar, got shape %s"
+                            %(attribute.parent, attribute.name, attribute.when, numpy.asarray(value).shape))
+    return problems
+
+class NDAttributeCheck:
+    '''Validate the per-frame NDAttribute datasets of a HDF5 file.
+    Every NDAttribute dataset must have exactly one entry per frame. Frame counters
+    (ArrayCounter) must increase by one without gaps, so dropped frames are caught,
+    and time stamps must be monotonic. The datasets are read in blocks of at most
+    chunk_size frames so memory use does not depend on the number of frames.
+    '''
+    def __init__(self, xml_def, index, chunk_size=CHUNK_SIZE):
+        self.xml_def = xml_def
+        self.index = index
+        self.chunk_size = chunk_size
+        self.datasets = ndattribute_datasets(xml_def, index)
+
+    def check_frame_count(self, num_frames):
+        '''Check the number of entries of all NDAttribute datasets against the index'''
+        problems = []
+        for name in sorted(self.datasets):
+            shape = self.index[name].shape
+            if not shape or shape[0] != num_frames:
+                problems.append("NDAttribute dataset \'%s\' should have %d entries, has shape %s"
+                                %(name, num_frames, shape))
+        return problems
+
+    def check_values(self, hdf_file):
+        '''Read the counter and time stamp datasets and check their values'''
+        problems = []
+        with h5py.File(hdf_file, 'r') as hdf:
+            for name in sorted(self.datasets):
+                ndattribute = self.datasets[name]
+                if not hdf[name].shape:
+                    # Scalars are reported by check_frame_count()
+                    continue
+                if ndattribute in COUNTER_NDATTRIBUTES:
+                    problems += check_counter(name, hdf[name], self.chunk_size)
+                elif ndattribute in TIMESTAMP_NDATTRIBUTES:
+                    problems += check_monotonic(name, hdf[name], self.chunk_size)
+        return problems
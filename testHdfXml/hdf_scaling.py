@@ -0,0 +1,294 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, sys, time, argparse
+import gc
+import resource
+import multiprocessing
+import csv, json
+import numpy
+import h5py
+
+import hdf_xml
+import hdf_index
+import hdf_compare
+import hdf_ndattr
+import hdf_schema
+import hdf_synth
+
+# The phases timed at each size: validating the layout against the XSD schema,
+# parsing it into a HdfXmlDefinition, indexing the HDF5 file and checking all
+# XML defined attributes against the index
+PHASES = ['schema', 'parse', 'index', 'attributes']
+
+# Columns of the result files
+RESULT_FIELDS = ['elements', 'phase', 'seconds', 'peak_mb', 'us_per_element', 'repeats']
+
+class ScalingResult:
+    '''Time and peak memory of one phase at one layout size. seconds is the best of
+    the repeats; peak_mb is the growth of the resident memory during the phase.'''
+    def __init__(self, elements, phase, seconds, peak_mb, repeats):
+        self.elements = elements
+        self.phase = phase
+        self.seconds = seconds
+        self.peak_mb = peak_mb
+        self.repeats = repeats
+
+    @property
+    def key(self):
+        '''Identifies the result when comparing against a baseline'''
+        return "%d %s"%(self.elements, self.phase)
+    @property
+    def us_per_element(self):
+        return self.seconds * 1e6 / self.elements
+
+    def as_dict(self):
+        row = {'key': self.key}
+        for field in RESULT_FIELDS:
+            row[field] = getattr(self, field)
+        return row
+
+    def __str__(self):
+        return "%8d elements %-10s: %9.4fs %8.1fMB %7.2fus/element"\
+            %(self.elements, self.phase, self.seconds, self.peak_mb, self.us_per_element)
+
+def _status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return None
+
+class PeakMemory:
+    '''Measure the peak resident memory of a stretch of code. On Linux the peak
+    (VmHWM) is reset at start() so only the code in between counts. Elsewhere the
+    peak of the process lifetime is used, which is still right as long as each
+    measurement runs in a fresh process doing little else.'''
+    def start(self):
+        self.reset = False
+        self.base = None
+        try:
+            with open("/proc/self/clear_refs", 'w') as f:
+                f.write("5")
+            self.reset = True
+            self.base = _status_kb("VmRSS")
+        except (IOError, OSError):
+            pass
+        if self.base is None:
+            self.base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return self
+
+    def peak_mb(self):
+        if self.reset:
+            peak = _status_kb("VmHWM")
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max(0, peak - self.base) / 1024.
+
+def _phase_function(phase, xml_file, hdf_file):
+    '''Do the setup a phase needs and return the function running the phase itself'''
+    if phase == 'schema':
+        validator = hdf_schema.SchemaValidator()
+        validator.schema()
+        return lambda: validator.validate(xml_file)
+    if phase == 'parse':
+        # Straight to the parser: the layout cache would make this a cache load
+        return lambda: hdf_xml.HdfXmlDefinition().populate(xml_file)
+    if phase == 'index':
+        def index():
+            with h5py.File(hdf_file, 'r') as hdf:
+                return hdf_index.HdfIndex().build(hdf)
+        return index
+    if phase == 'attributes':
+        xml_def = hdf_xml.HdfXmlDefinition()
+        xml_def.populate(xml_file)
+        index = hdf_index.index_file(hdf_file)
+        def attributes():
+            problems = hdf_compare.AttributeComparison(xml_def).compare(index)
+            problems += hdf_ndattr.check_when_scalars(xml_def, index)
+            if problems:
+                raise ValueError("%s does not match its layout: %s"%(hdf_file, problems[0]))
+        return attributes
+    raise ValueError("Unknown phase \'%s\'"%(phase))
+
+def _measure(phase, xml_file, hdf_file, repeats, min_time):
+    '''Run a phase at least once and up to repeats times, until min_time has passed.
+    Returns (best time, peak memory in MB, number of runs).'''
+    function = _phase_function(phase, xml_file, hdf_file)
+    gc.collect()
+    memory = PeakMemory().start()
+    best = None
+    runs = 0
+    total = 0.0
+    while runs < repeats and (runs == 0 or total < min_time):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        del result
+        best = elapsed if best is None else min(best, elapsed)
+        total += elapsed
+        runs += 1
+    return best, memory.peak_mb(), runs
+
+def _in_process(function, args):
+    '''Run function(*args) in a fresh worker process and return its result'''
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def run_scaling(sizes, directory, phases=PHASES, repeats=3, min_time=0.5, callback=None, **spec_options):
+    '''Generate (or reuse) a synthetic layout and HDF5 file of about each number of
+    elements in sizes and measure each phase on it. Every measurement runs in a
+    fresh process so the memory use of one does not hide that of the next. The
+    generation runs in a process of its own too, else the measurements would find
+    memory left free by it and depend on whether the files had to be generated.
+    callback(result) is called as each result comes in. Returns the list of ScalingResult.'''
+    results = []
+    for elements in sizes:
+        spec = hdf_synth.spec_for_elements(elements, **spec_options)
+        xml_file, hdf_file = _in_process(hdf_synth.generate, (spec, directory))
+        for phase in phases:
+            seconds, peak_mb, runs = _in_process(_measure, (phase, xml_file, hdf_file, repeats, min_time))
+            result = ScalingResult(spec.elements, phase, seconds, peak_mb, runs)
+            if callback is not None:
+                callback(result)
+            results.append(result)
+    return results
+
+def scaling_exponents(rows, min_elements=1000):
+    '''Fit seconds = c * elements**k per phase over the sizes of at least min_elements
+    (smaller ones are dominated by fixed costs). rows are ScalingResult or their
+    dictionaries. Returns {phase: k} for the phases with at least two sizes.'''
+    points = dict()
+    for row in rows:
+        if not isinstance(row, dict):
+            row = row.as_dict()
+        if row['elements'] >= min_elements and row['seconds'] > 0.0:
+            points.setdefault(row['phase'], []).append( (row['elements'], row['seconds']) )
+    exponents = dict()
+    for phase, values in points.iteritems():
+        if len(values) < 2:
+            continue
+        elements, seconds = zip(*values)
+        exponents[phase] = numpy.polyfit(numpy.log(elements), numpy.log(seconds), 1)[0]
+    return exponents
+
+def write_csv(results, fname):
+    with open(fname, 'wb') as f:
+        writer = csv.DictWriter(f, RESULT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result.as_dict())
+
+def write_json(results, fname):
+    with open(fname, 'w') as f:
+        json.dump([result.as_dict() for result in results], f, indent=1, sort_keys=True)
+
+def load_baseline(fname):
+    '''Load the results of an earlier run (as written by write_json) keyed by size and phase'''
+    with open(fname) as f:
+        return dict([(row['key'], row) for row in json.load(f)])
+
+def compare_baseline(results, baseline, tolerance=0.25, memory_tolerance=0.25, exponent_tolerance=0.15,
+                     min_elements=1000):
+    '''Compare results against a baseline. A size regresses if a phase got slower
+    by more than the tolerance (a fraction), or needs more than memory_tolerance
+    more memory; tiny absolute differences (under 10ms and 1MB) are noise. A phase
+    regresses if its scaling exponent grew by more than exponent_tolerance: that
+    catches a linear phase turning quadratic even on a faster machine.
+    Returns a list of (key, description) of the regressions.'''
+    regressions = []
+    for result in results:
+        row = baseline.get(result.key)
+        if row is None:
+            continue
+        if result.seconds > row['seconds'] * (1.0 + tolerance) and result.seconds - row['seconds'] > 0.01:
+            regressions.append( (result.key, "%.4fs, baseline %.4fs (%+.0f%%)"
+                                 %(result.seconds, row['seconds'], 100.0*(result.seconds/row['seconds'] - 1.0))) )
+        if result.peak_mb > row['peak_mb'] * (1.0 + memory_tolerance) and result.peak_mb - row['peak_mb'] > 1.0:
+            regressions.append( (result.key, "peak memory %.1fMB, baseline %.1fMB"%(result.peak_mb, row['peak_mb'])) )
+    # Only the sizes measured in both runs make up a fair comparison of the exponents
+    common = [result for result in results if result.key in baseline]
+    exponents = scaling_exponents(common, min_elements)
+    baseline_exponents = scaling_exponents([baseline[result.key] for result in common], min_elements)
+    for phase in sorted(exponents):
+        if phase in baseline_exponents and exponents[phase] > baseline_exponents[phase] + exponent_tolerance:
+            regressions.append( (phase, "scales as elements^%.2f, baseline elements^%.2f"
+                                 %(exponents[phase], baseline_exponents[phase])) )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how the time and peak memory of the layout schema "
+                                     "validation, the layout parser, the HDF5 index and the attribute checks "
+                                     "scale with the size of synthetic layouts")
+    parser.add_argument('--sizes', metavar='N[,N]', dest='sizes', action='store',
+                        default='10,100,1000,10000,100000,1000000',
+                        help='Comma separated layout sizes in XML elements')
+    parser.add_argument('--phases', metavar='PHASE[,PHASE]', dest='phases', action='store', default=None,
+                        help='Comma separated phases out of %s (default all; schema needs lxml)'%(",".join(PHASES)))
+    parser.add_argument('--depth', metavar='N', dest='depth', action='store', type=int, default=3,
+                        help='Number of levels of groups of the layouts')
+    parser.add_argument('--datasets', metavar='N', dest='datasets', action='store', type=int, default=2,
+                        help='Number of NDAttribute datasets in each group')
+    parser.add_argument('--attributes', metavar='N', dest='attributes', action='store', type=int, default=4,
+                        help='Number of attributes of each group and dataset')
+    parser.add_argument('--ndattribute-fraction', metavar='F', dest='ndattribute_fraction', action='store',
+                        type=float, default=0.25, help='Fraction of NDAttribute (rather than constant) attributes')
+    parser.add_argument('--repeat', '-r', metavar='N', dest='repeats', action='store', type=int, default=3,
+                        help='Maximum number of runs of each phase (the best time counts)')
+    parser.add_argument('--dir', '-d', metavar='DIR', dest='directory', action='store', default='/tmp',
+                        help='Directory for the generated layouts and HDF5 files (reused between runs)')
+    parser.add_argument('--csv', metavar='FILE', dest='csv', action='store', default=None,
+                        help='Write the results to a CSV file')
+    parser.add_argument('--json', metavar='FILE', dest='json', action='store', default=None,
+                        help='Write the results to a JSON file (which can serve as a baseline)')
+    parser.add_argument('--baseline', metavar='FILE', dest='baseline', action='store', default=None,
+                        help='Compare against the JSON results of an earlier run')
+    parser.add_argument('--tolerance', metavar='FRACTION', dest='tolerance', action='store', type=float, default=0.25,
+                        help='Slow down relative to the baseline which counts as a regression')
+    parser.add_argument('--memory-tolerance', metavar='FRACTION', dest='memory_tolerance', action='store',
+                        type=float, default=0.25,
+                        help='Growth of the peak memory relative to the baseline which counts as a regression')
+    parser.add_argument('--exponent-tolerance', metavar='K', dest='exponent_tolerance', action='store',
+                        type=float, default=0.15,
+                        help='Growth of the scaling exponent relative to the baseline which counts as a regression')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    phases = PHASES
+    if args.phases:
+        phases = args.phases.split(',')
+    if 'schema' in phases and not hdf_schema.HAVE_LXML:
+        print "No lxml: leaving out the schema phase"
+        phases = [phase for phase in phases if phase != 'schema']
+    def show(result):
+        print result
+    results = run_scaling(sizes, os.path.abspath(args.directory), phases, args.repeats, callback=show,
+                          depth=args.depth, datasets=args.datasets, attributes=args.attributes,
+                          ndattribute_fraction=args.ndattribute_fraction)
+    for phase, exponent in sorted(scaling_exponents(results).iteritems()):
+        print "%-10s scales as elements^%.2f"%(phase, exponent)
+    if args.csv:
+        write_csv(results, args.csv)
+    if args.json:
+        write_json(results, args.json)
+    if args.baseline:
+        regressions = compare_baseline(results, load_baseline(args.baseline), args.tolerance,
+                                       args.memory_tolerance, args.exponent_tolerance)
+        for key, description in regressions:
+            print "REGRESSION %s: %s"%(key, description)
+        if regressions:
+            sys.exit(1)
+
+if __name__=="__main__":
+    main()
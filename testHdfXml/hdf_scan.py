@@ -0,0 +1,73 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('cothread')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, argparse
+
+from adclientxmlhdf import SimDet, HdfPlugin, ScanFile, ScanSequence
+
+def scan_files(directory, name, nfiles, nimages, exposure, xml_file=None):
+    '''ScanFiles <directory>/<name>_<n>.h5 of nimages frames each'''
+    return [ScanFile(os.path.join(directory, "%s_%05d.h5"%(name, n)), nimages, exposure, xml_file)
+            for n in range(nfiles)]
+
+def run_scan(sim, hdf, files, pipelined):
+    sequence = ScanSequence(sim, hdf, pipelined)
+    sequence.run(files)
+    print sequence.summary()
+    return sequence
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a sequence of short HDF5 files back to back, as a fly "
+                                     "scan does, and report the dead time between the files")
+    parser.add_argument('xmlfile', metavar='XMLFILE', type=str, nargs='?', default=None,
+                        help='XML layout file for the file writer (default: the plugin\'s current layout)')
+    parser.add_argument('--files', '-f', metavar='N', dest='numfiles', action='store', type=int, default=10,
+                        help='Number of files to write')
+    parser.add_argument('--num', '-n', metavar='N', dest='numimages', action='store', type=int, default=10,
+                        help='Number of images per file')
+    parser.add_argument('--exposure', '-e', metavar='T', dest='exposure', action='store', type=float, default=0.01,
+                        help='Camera exposure time (and period) in seconds')
+    parser.add_argument('--dir', '-d', metavar='DIR', dest='directory', action='store', default='/tmp',
+                        help='Directory the file writer writes to')
+    parser.add_argument('--name', metavar='NAME', dest='name', action='store', default='scan',
+                        help='Files are named NAME_<n>.h5')
+    parser.add_argument('--sequential', dest='sequential', action='store_true', default=False,
+                        help='Set up every file after the previous one has closed (as adclientxmlhdf.py does)')
+    parser.add_argument('--compare', dest='compare', action='store_true', default=False,
+                        help='Run the sequence in order and then pipelined, and report the difference')
+    parser.add_argument('--simpv', metavar='PV', dest='simpv', action='store', default='TESTSIMDETECTOR:CAM',
+                        help='Base PV of the simDetector driver')
+    parser.add_argument('--hdfpv', metavar='PV', dest='hdfpv', action='store', default='TESTSIMDETECTOR:HDF',
+                        help='Base PV of the HDF5 file writer plugin')
+    args = parser.parse_args()
+
+    xml_file = None
+    if args.xmlfile:
+        xml_file = os.path.abspath(args.xmlfile)
+    directory = os.path.abspath(args.directory)
+    sim = SimDet(args.simpv)
+    hdf = HdfPlugin(args.hdfpv)
+
+    if not args.compare:
+        files = scan_files(directory, args.name, args.numfiles, args.numimages, args.exposure, xml_file)
+        run_scan(sim, hdf, files, not args.sequential)
+        return
+
+    results = []
+    for pipelined in [False, True]:
+        name = "%s_%s"%(args.name, "pipelined" if pipelined else "sequential")
+        files = scan_files(directory, name, args.numfiles, args.numimages, args.exposure, xml_file)
+        results.append(run_scan(sim, hdf, files, pipelined))
+    sequential, pipelined = [sum(sequence.gaps()) for sequence in results]
+    if sequential > 0.0:
+        print "Pipelining cut the dead time from %.3fs to %.3fs (%.0f%% less)"\
+            %(sequential, pipelined, 100. * (sequential - pipelined) / sequential)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('lxml')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, sys, time, argparse
+import glob
+import warnings
+
+import hdf_trace
+
+# lxml is optional: without it layouts are not validated against the schema
+# here and only the IOC will find out about invalid layouts.
+try:
+    from lxml import etree
+    HAVE_LXML = True
+except ImportError:
+    HAVE_LXML = False
+
+# The XSD schema of the XML layout files, in the top directory of this repository
+SCHEMA_FILE = os.environ.get('HDF_XML_SCHEMA',
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                          'hdf5_xml_layout_schema.xsd'))
+
+class LayoutError:
+    '''A single syntax or schema error in an XML layout file'''
+    def __init__(self, filename, line, column, message):
+        self.filename = filename
+        self.line = line
+        self.column = column
+        self.message = message
+
+    def __str__(self):
+        return "%s:%d:%d: %s"%(self.filename, self.line, self.column, self.message)
+    def __repr__(self):
+        return "<LayoutError: %s>"%(str(self))
+
+class LayoutValidation:
+    '''The outcome of validating one XML layout file: all errors found and the time it took'''
+    def __init__(self, filename, errors, elapsed):
+        self.filename = filename
+        self.errors = errors
+        self.elapsed = elapsed
+
+    @property
+    def valid(self):
+        return not self.errors
+
+    def __str__(self):
+        if self.valid:
+            return "%s: valid (%.1fms)"%(self.filename, self.elapsed*1000.)
+        return "%s: %d errors (%.1fms)\n%s"%(self.filename, len(self.errors), self.elapsed*1000.,
+                                            "\n".join(["  " + str(error) for error in self.errors]))
+
+class InvalidLayout(Exception):
+    '''Raised for an XML layout file which does not validate against the schema'''
+    def __init__(self, validation):
+        Exception.__init__(self, str(validation))
+        self.validation = validation
+
+class SchemaValidator:
+    '''Validate XML layout files against the XSD schema using lxml.
+    The schema is compiled on first use and kept, so validating many layouts (or
+    the same layout many times) only pays for parsing the layouts themselves. The
+    schema is recompiled if the schema file changes.
+    '''
+    def __init__(self, xsd_file=SCHEMA_FILE):
+        if not HAVE_LXML:
+            raise ImportError("XML layout validation needs the lxml module")
+        self.xsd_file = xsd_file
+        self._schema = None
+        self._schema_stat = None
+
+    def schema(self):
+        '''Return the compiled schema, compiling it if needed'''
+        stat = os.stat(self.xsd_file)
+        stat = (stat.st_size, stat.st_mtime)
+        if self._schema is None or stat != self._schema_stat:
+            self._schema = etree.XMLSchema(etree.parse(self.xsd_file))
+            self._schema_stat = stat
+        return self._schema
+
+    def validate(self, xmlfile):
+        '''Validate one layout file. Returns a LayoutValidation with all the errors.'''
+        start = time.time()
+        schema = self.schema()
+        # A parser per file so the syntax errors reported are only those of this file
+        parser = etree.XMLParser()
+        try:
+            doc = etree.parse(xmlfile, parser)
+        except etree.XMLSyntaxError, e:
+            errors = [LayoutError(xmlfile, entry.line, entry.column, entry.message) for entry in parser.error_log]
+            if not errors:
+                errors = [LayoutError(xmlfile, e.position[0], e.position[1], str(e))]
+            return LayoutValidation(xmlfile, errors, time.time() - start)
+        except (IOError, OSError), e:
+            return LayoutValidation(xmlfile, [LayoutError(xmlfile, 0, 0, str(e))], time.time() - start)
+        errors = []
+        if not schema.validate(doc):
+            errors = [LayoutError(xmlfile, entry.line, entry.column, entry.message) for entry in schema.error_log]
+        return LayoutValidation(xmlfile, errors, time.time() - start)
+
+    def validate_directory(self, directory, pattern='*.xml'):
+        '''Validate all layout files in a directory. Returns a list of LayoutValidation.'''
+        return [self.validate(xmlfile) for xmlfile in sorted(glob.glob(os.path.join(directory, pattern)))]
+
+# The validator used by check_layout(), created on first use
+_validator = None
+
+def check_layout(xmlfile, required=False):
+    '''Raise InvalidLayout if xmlfile does not validate against the schema.
+    Without lxml the layout cannot be validated: with required ImportError is raised,
+    otherwise a RuntimeWarning is issued and None returned.
+    Returns the LayoutValidation, or None if lxml is not available.'''
+    global _validator
+    if not HAVE_LXML:
+        if required:
+            raise ImportError("XML layout validation needs the lxml module")
+        warnings.warn("lxml is not available: %s is not validated against the schema, "
+                      "only the IOC will find out if it is invalid"%(xmlfile), RuntimeWarning)
+        return None
+    if _validator is None:
+        _validator = SchemaValidator()
+    with hdf_trace.span("check_layout", "validate", file=xmlfile):
+        validation = _validator.validate(xmlfile)
+    if not validation.valid:
+        raise InvalidLayout(validation)
+    return validation
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate XML layout files for the HDF5 file writer against the XSD schema")
+    parser.add_argument('paths', metavar='PATH', type=str, nargs='+',
+                        help='XML layout file, or directory of layout files')
+    parser.add_argument('--schema', '-s', metavar='XSD', dest='schema', action='store', default=SCHEMA_FILE,
+                        help='XSD schema file')
+    parser.add_argument('--pattern', '-p', metavar='GLOB', dest='pattern', action='store', default='*.xml',
+                        help='File name pattern of the layout files in directories')
+    args = parser.parse_args()
+
+    validator = SchemaValidator(args.schema)
+    results = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            results += validator.validate_directory(path, args.pattern)
+        else:
+            results.append(validator.validate(path))
+    for result in results:
+        print result
+    invalid = len([result for result in results if not result.valid])
+    print "%d layouts, %d invalid"%(len(results), invalid)
+    if invalid:
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
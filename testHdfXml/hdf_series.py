@@ -0,0 +1,312 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, sys, time, argparse
+import glob
+import json
+import multiprocessing
+
+import hdf_xml
+import hdf_index
+import hdf_compare
+import hdf_ndattr
+
+# Bump this whenever the layout of the manifest changes so old manifests are
+# discarded rather than misread.
+MANIFEST_VERSION = 2
+
+class FileResult:
+    '''The outcome of checking one HDF5 file of a series against the XML definition.
+
+    Attributes:
+        path:     Full name of the HDF5 file
+        stat:     (size, mtime) of the file when it was checked, or None if it
+                  could not be read
+        problems: List of problem descriptions; empty if the file is valid
+        elapsed:  Seconds spent checking the file
+        cached:   True if the result was taken from the manifest
+    '''
+    def __init__(self, path, stat, problems, elapsed=0.0, cached=False):
+        self.path = path
+        self.stat = stat
+        self.problems = problems
+        self.elapsed = elapsed
+        self.cached = cached
+
+    @property
+    def valid(self):
+        return not self.problems
+
+    def __str__(self):
+        if self.valid:
+            return "%s: OK"%(self.path)
+        return "%s: %d problems\n%s"%(self.path, len(self.problems),
+                                      "\n".join(["  " + problem for problem in self.problems]))
+
+class SeriesChecker:
+    '''Check HDF5 files against one HdfXmlDefinition.
+    The expected attributes are collected from the definition once, so checking
+    each file only costs indexing it and comparing against the index. The checks
+    are those of test_hdf_xml.py, less the ones which need to know how many frames
+    were acquired: all XML defined groups and detector datasets exist, all defined
+    attributes are present with their constant values, NDAttribute datasets have
+    one entry per detector frame with valid counters and time stamps, and
+    OnFileOpen/OnFileClose NDAttribute attributes are scalars.
+    '''
+    def __init__(self, xml_def, rtol=0.0, atol=0.0):
+        self.xml_def = xml_def
+        self.comparison = hdf_compare.AttributeComparison(xml_def, rtol, atol)
+
+    def check(self, hdf_file):
+        '''Check one file and return a FileResult'''
+        start = time.time()
+        stat = None
+        try:
+            stat = _file_stat(hdf_file)
+            problems = self._check(hdf_file)
+        except (IOError, OSError), e:
+            # Typically a file which is still being written, or was deleted after
+            # the series was listed
+            problems = ["Cannot read file: %s"%(str(e))]
+        except Exception, e:
+            # A corrupt or unexpected file (h5py raises KeyError, RuntimeError,
+            # ValueError...) fails on its own rather than ending the whole series
+            problems = ["Cannot check file: %s: %s"%(type(e).__name__, str(e))]
+        return FileResult(hdf_file, stat, problems, time.time() - start)
+
+    def _check(self, hdf_file):
+        index = hdf_index.index_file(hdf_file)
+        problems = []
+        for group in self.xml_def.groups:
+            if group not in index:
+                problems.append("Group \'%s\' should exist in the HDF file"%(group))
+        for name, (source, ndattribute, attributes) in self.xml_def.datasets.iteritems():
+            if source == hdf_xml.DETECTOR and name not in index:
+                problems.append("Detector dataset \'%s\' should exist in HDF5"%(name))
+        problems += [str(mismatch) for mismatch in self.comparison.compare(index)]
+        ndattr_check = hdf_ndattr.NDAttributeCheck(self.xml_def, index)
+        num_frames = hdf_ndattr.detector_frames(self.xml_def, index)
+        if num_frames is not None:
+            problems += ndattr_check.check_frame_count(num_frames)
+        problems += ndattr_check.check_values(hdf_file)
+        problems += hdf_ndattr.check_when_scalars(self.xml_def, index)
+        return problems
+
+class Manifest:
+    '''The results of earlier runs: {path: (size, mtime, problems)}.
+    A file is only checked again if its size or modification time changed. The
+    manifest belongs to one XML definition file and one pair of float tolerances;
+    if either changes all the recorded results are discarded.'''
+    def __init__(self, xml_file, rtol=0.0, atol=0.0):
+        self.xml_file = os.path.abspath(xml_file)
+        self.xml_stat = _file_stat(self.xml_file)
+        self.rtol = rtol
+        self.atol = atol
+        self.files = dict()
+
+    def load(self, fname):
+        '''Load a manifest saved by save(), if it exists and matches the XML definition'''
+        try:
+            with open(fname) as f:
+                content = json.load(f)
+        except (IOError, OSError, ValueError):
+            return self
+        if content.get('version') != MANIFEST_VERSION or content.get('xml_file') != self.xml_file \
+                or tuple(content.get('xml_stat', ())) != self.xml_stat \
+                or (content.get('float_rtol'), content.get('float_atol')) != (self.rtol, self.atol):
+            return self
+        self.files = dict([(path, (size, mtime, problems))
+                           for (path, (size, mtime, problems)) in content['files'].iteritems()])
+        return self
+
+    def save(self, fname):
+        '''Save the manifest. It is written to a temporary file first so an
+        interrupted run never leaves a truncated manifest behind.'''
+        content = {'version': MANIFEST_VERSION, 'xml_file': self.xml_file, 'xml_stat': self.xml_stat,
+                   'float_rtol': self.rtol, 'float_atol': self.atol, 'files': self.files}
+        tmp = fname + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(content, f)
+        os.rename(tmp, fname)
+
+    def lookup(self, path, stat):
+        '''Return the recorded FileResult of path if the file is unchanged, else None'''
+        entry = self.files.get(path)
+        if entry is None or (entry[0], entry[1]) != stat:
+            return None
+        return FileResult(path, stat, entry[2], cached=True)
+
+    def record(self, result):
+        if result.stat is None:
+            # Nothing to tell a later run whether the file changed
+            return
+        self.files[result.path] = (result.stat[0], result.stat[1], result.problems)
+
+    def prune(self, paths):
+        '''Forget files which are no longer part of the series'''
+        paths = set(paths)
+        for path in self.files.keys():
+            if path not in paths:
+                del self.files[path]
+
+class SeriesReport:
+    '''Summary of a series validation run'''
+    def __init__(self, results, checked, elapsed):
+        self.results = results
+        self.checked = checked
+        self.elapsed = elapsed
+
+    @property
+    def invalid(self):
+        return [result for result in self.results if not result.valid]
+
+    @property
+    def files_per_s(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.checked / self.elapsed
+
+    def __str__(self):
+        return "%d files, %d checked (%d unchanged), %d invalid in %.3fs, %.1f files/s"\
+            %(len(self.results), self.checked, len(self.results) - self.checked, len(self.invalid),
+              self.elapsed, self.files_per_s)
+
+def _file_stat(filename):
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime)
+
+def series_files(paths, pattern='*.h5', settle=0.0):
+    '''Return the sorted list of HDF5 files named by paths: files, glob patterns or
+    directories (searched for pattern). Files modified less than settle seconds ago
+    are left out, as they may still be being written.'''
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, pattern)))
+        elif os.path.exists(path):
+            files.add(path)
+        else:
+            files.update(glob.glob(path))
+    now = time.time()
+    files = [os.path.abspath(fname) for fname in files]
+    if settle > 0.0:
+        settled = []
+        for fname in files:
+            try:
+                if now - os.path.getmtime(fname) >= settle:
+                    settled.append(fname)
+            except OSError:
+                # Deleted since it was listed
+                pass
+        files = settled
+    return sorted(files)
+
+# The SeriesChecker of a worker process
+_checker = None
+
+def _init_worker(xml_file, rtol, atol):
+    global _checker
+    _checker = SeriesChecker(hdf_xml.load_definition(xml_file), rtol, atol)
+
+def _check_file(hdf_file):
+    return _checker.check(hdf_file)
+
+def validate_series(xml_file, files, manifest=None, jobs=1, rtol=0.0, atol=0.0, callback=None):
+    '''Check the HDF5 files against the XML definition in a pool of jobs worker
+    processes. Files recorded as unchanged in the manifest are not checked again;
+    the manifest is updated with the new results. callback(result) is called for
+    each file as its result comes in. Returns a SeriesReport.'''
+    start = time.time()
+    results = []
+    todo = []
+    for hdf_file in files:
+        result = None
+        if manifest is not None:
+            try:
+                result = manifest.lookup(hdf_file, _file_stat(hdf_file))
+            except OSError:
+                # Deleted since the series was listed: the check reports it
+                pass
+        if result is None:
+            todo.append(hdf_file)
+        else:
+            results.append(result)
+
+    def collect(result):
+        results.append(result)
+        if manifest is not None:
+            manifest.record(result)
+        if callback is not None:
+            callback(result)
+
+    if jobs > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (os.path.abspath(xml_file), rtol, atol))
+        try:
+            # Small files: hand them out in batches to keep the IPC overhead down
+            chunksize = max(1, min(64, len(todo) / (4 * jobs)))
+            for result in pool.imap_unordered(_check_file, todo, chunksize):
+                collect(result)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        checker = SeriesChecker(hdf_xml.load_definition(xml_file), rtol, atol)
+        for hdf_file in todo:
+            collect(checker.check(hdf_file))
+
+    if manifest is not None:
+        manifest.prune(files)
+    results.sort(key=lambda result: result.path)
+    return SeriesReport(results, len(todo), time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate a series of HDF5 files (for example written in Single mode "
+                                     "with AutoIncrement) against one XML layout definition")
+    parser.add_argument('xmlfile', metavar='XMLFILE', type=str,
+                        help='XML file describing the layout of the HDF5 files')
+    parser.add_argument('paths', metavar='PATH', type=str, nargs='+',
+                        help='HDF5 file, glob pattern or directory of HDF5 files')
+    parser.add_argument('--pattern', '-p', metavar='GLOB', dest='pattern', action='store', default='*.h5',
+                        help='File name pattern of the HDF5 files in directories')
+    parser.add_argument('--jobs', '-j', metavar='N', dest='jobs', action='store', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of worker processes')
+    parser.add_argument('--manifest', '-m', metavar='FILE', dest='manifest', action='store', default=None,
+                        help='Manifest of earlier results: only new or changed files are checked')
+    parser.add_argument('--settle', metavar='T', dest='settle', action='store', type=float, default=0.0,
+                        help='Skip files modified less than T seconds ago (still being written)')
+    parser.add_argument('--float-rtol', dest='rtol', action='store', type=float, default=0.0,
+                        help='Relative tolerance of float constant attributes')
+    parser.add_argument('--float-atol', dest='atol', action='store', type=float, default=0.0,
+                        help='Absolute tolerance of float constant attributes')
+    parser.add_argument('--quiet', '-q', dest='quiet', action='store_true', default=False,
+                        help='Only report invalid files')
+    args = parser.parse_args()
+
+    files = series_files(args.paths, args.pattern, args.settle)
+    manifest = None
+    if args.manifest:
+        manifest = Manifest(args.xmlfile, args.rtol, args.atol).load(args.manifest)
+    def show(result):
+        if not (args.quiet and result.valid):
+            print result
+    report = validate_series(args.xmlfile, files, manifest, args.jobs, args.rtol, args.atol, callback=show)
+    if manifest is not None:
+        manifest.save(args.manifest)
+        # Files recorded as invalid in earlier runs are still invalid
+        for result in report.results:
+            if not result.valid and result.cached:
+                print "%s (unchanged)"%(result)
+    print report
+    if report.invalid:
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,435 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, sys, time, argparse
+import errno
+import itertools
+import tempfile
+import socket
+import SocketServer
+import threading
+import Queue
+import collections
+import multiprocessing
+import signal
+import json
+import numpy
+
+import hdf_xml
+import hdf_schema
+import hdf_series
+import hdf_cache
+
+# The socket of the service, unless given on the command line. It lives in a directory
+# only the user can write to (the session's runtime directory if there is one), so
+# nobody else can put a socket of their own in its place.
+SOCKET_FILE = os.environ.get('HDF_SERVICE_SOCKET', os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or os.path.join(tempfile.gettempdir(), 'hdf_service-%d'%(os.getuid())),
+    'hdf_service.sock'))
+
+# Seconds a validation request may take before it is answered with an error
+REQUEST_TIMEOUT = 300.0
+
+# Number of recent requests the latency statistics are taken over
+STATS_WINDOW = 1000
+
+class ServiceError(Exception):
+    '''Raised by the client for a request the service could not carry out'''
+    pass
+
+def _check_socket_dir(socket_file):
+    '''Raise ServiceError unless the directory of the socket is private to the user'''
+    directory = os.path.dirname(os.path.abspath(socket_file))
+    if not hdf_cache.private_dir(directory):
+        raise ServiceError("Other users can write to %s, so they could replace the socket"%(directory))
+
+# The SeriesChecker of every layout seen so far: {(XML file, rtol, atol): (file stat, checker)}.
+# Layouts given at start up are loaded before the workers are forked, so they start warm.
+_checkers = dict()
+
+def _checker(xml_file, rtol, atol):
+    '''Return the SeriesChecker of a layout, rebuilding it if the XML file changed'''
+    stat = hdf_series._file_stat(xml_file)
+    entry = _checkers.get((xml_file, rtol, atol))
+    if entry is None or entry[0] != stat:
+        entry = (stat, hdf_series.SeriesChecker(hdf_xml.load_definition(xml_file), rtol, atol))
+        _checkers[(xml_file, rtol, atol)] = entry
+    return entry[1]
+
+def _init_worker():
+    # Ctrl-C is for the service to handle: it stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _validate(request):
+    '''Carry out one validation request in a worker process. Never raises: errors
+    are returned as the response, as the pool has no way to hand back an exception.'''
+    start = time.time()
+    try:
+        xml_file = os.path.abspath(request['xml'])
+        hdf_file = os.path.abspath(request['hdf'])
+        problems = []
+        if request.get('schema'):
+            try:
+                hdf_schema.check_layout(xml_file, required=True)
+            except hdf_schema.InvalidLayout, e:
+                problems += [str(error) for error in e.validation.errors]
+        if not problems:
+            result = _checker(xml_file, request.get('rtol', 0.0), request.get('atol', 0.0)).check(hdf_file)
+            problems = result.problems
+        response = {'ok': True, 'file': hdf_file, 'valid': not problems, 'problems': problems}
+    except Exception, e:
+        response = {'ok': False, 'error': "%s: %s"%(e.__class__.__name__, e)}
+    response['id'] = request.get('id')
+    response['check_ms'] = (time.time() - start) * 1000.
+    return response
+
+class ServiceStats:
+    '''Request counts, queue depth and latency of the service. The latency runs from
+    reading a request off the socket to writing its response; the check time is the
+    part of it spent in the worker, the rest is queueing. The percentiles are over
+    the last window requests.'''
+    def __init__(self, window=STATS_WINDOW):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.invalid = 0
+        self.errors = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.check_times = collections.deque(maxlen=window)
+
+    def submitted(self):
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+    def completed(self, response, latency):
+        with self.lock:
+            self.queued -= 1
+            self.requests += 1
+            if not response['ok']:
+                self.errors += 1
+            elif not response['valid']:
+                self.invalid += 1
+            self.latencies.append(latency)
+            self.check_times.append(response['check_ms'] / 1000.)
+
+    def _summary(self, values):
+        if not values:
+            return None
+        values = numpy.array(values) * 1000.
+        return {'mean': values.mean(), 'p50': numpy.percentile(values, 50), 'p95': numpy.percentile(values, 95),
+                'p99': numpy.percentile(values, 99), 'max': values.max()}
+
+    def as_dict(self):
+        with self.lock:
+            uptime = time.time() - self.start
+            return {'uptime': uptime, 'requests': self.requests, 'invalid': self.invalid, 'errors': self.errors,
+                    'queue_depth': self.queued, 'max_queue_depth': self.max_queued,
+                    'requests_per_s': self.requests / uptime if uptime > 0.0 else 0.0,
+                    'latency_ms': self._summary(self.latencies), 'check_ms': self._summary(self.check_times)}
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    '''One client connection: a JSON request per line, a JSON response per line.
+    Validation requests are queued on the worker pool as they are read, so a client
+    may send many before reading the responses; these come back in the order they
+    complete, matched to the requests by their 'id'. The responses are written by a
+    thread of the connection, never by the pool's result handler thread (which all
+    the connections share), so a client which is slow to read only holds up itself.
+    A validation request which is not answered within the timeout of the service
+    gets an error response: its worker died (the pool replaces the worker, but not
+    its task) or is stuck.'''
+    def handle(self):
+        self.responses = Queue.Queue()
+        self.lock = threading.Lock()
+        # The validation requests waiting for their response: {key: (time received, id)}
+        self.pending = dict()
+        self.keys = itertools.count()
+        writer = threading.Thread(target=self._write_responses, name="hdf_service writer")
+        writer.daemon = True
+        writer.start()
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError, e:
+                self._respond({'ok': False, 'error': "Bad request: %s"%(e)})
+                continue
+            self._dispatch(request)
+        # Answer everything asked before the client hung up
+        self.responses.put(None)
+        writer.join()
+
+    def _dispatch(self, request):
+        service = self.server.service
+        op = request.get('op', 'validate')
+        if op == 'validate':
+            key = next(self.keys)
+            with self.lock:
+                self.pending[key] = (time.time(), request.get('id'))
+            service.stats.submitted()
+            def callback(response):
+                # Runs in the result handler thread of the pool: hand over, don't write
+                self.responses.put( (response, key) )
+            service.pool.apply_async(_validate, (request,), callback=callback)
+            # Let the writer know there is one more deadline to watch
+            self.responses.put( (None, key) )
+        elif op == 'stats':
+            self._respond({'id': request.get('id'), 'ok': True, 'stats': service.stats.as_dict()})
+        elif op == 'ping':
+            self._respond({'id': request.get('id'), 'ok': True})
+        else:
+            self._respond({'id': request.get('id'), 'ok': False, 'error': "Unknown op \'%s\'"%(op)})
+
+    def _respond(self, response):
+        self.responses.put( (response, None) )
+
+    def _expired(self, timeout):
+        '''Error responses for the validation requests which have run out of time'''
+        now = time.time()
+        with self.lock:
+            return [({'id': request_id, 'ok': False, 'check_ms': (now - received) * 1000.,
+                      'error': "No response within %.0fs: the worker died or is stuck"%(timeout)}, key)
+                    for key, (received, request_id) in self.pending.items() if now >= received + timeout]
+
+    def _write_responses(self):
+        '''Write the queued responses to the client until it has hung up and all its
+        validation requests are answered'''
+        stats = self.server.service.stats
+        timeout = self.server.service.timeout
+        connected = True
+        reading = True
+        while True:
+            with self.lock:
+                if not reading and not self.pending:
+                    return
+                received = [received for (received, request_id) in self.pending.values()]
+            wait = None
+            if received:
+                wait = max(0.0, min(received) + timeout - time.time())
+            try:
+                items = [self.responses.get(timeout=wait)]
+            except Queue.Empty:
+                items = self._expired(timeout)
+            for item in items:
+                if item is None:
+                    reading = False
+                    continue
+                response, key = item
+                if response is None:
+                    continue
+                if key is not None:
+                    with self.lock:
+                        entry = self.pending.pop(key, None)
+                    if entry is None:
+                        # Already answered as out of time
+                        continue
+                    # Counted before the client can see the response and ask for the stats
+                    stats.completed(response, time.time() - entry[0])
+                if connected:
+                    try:
+                        self.wfile.write(json.dumps(response) + "\n")
+                        self.wfile.flush()
+                    except socket.error:
+                        # The client went away: nobody to tell
+                        connected = False
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error, e:
+            # Closing flushes what is left of the responses to a client which hung up
+            if e.args[0] not in [errno.EPIPE, errno.ECONNRESET]:
+                raise
+            self.rfile.close()
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class ValidationService:
+    '''A resident validator: keeps the modules loaded and the layouts parsed, and
+    checks HDF5 files against them on request from a local UNIX socket. The checks
+    are those of hdf_series.py, run on a pool of jobs worker processes. Each worker
+    keeps the layouts it has seen; the layouts given up front are loaded before the
+    workers start, so every worker has them from the first request. A request not
+    answered within timeout seconds gets an error response.'''
+    def __init__(self, socket_file=SOCKET_FILE, jobs=multiprocessing.cpu_count(), layouts=[],
+                 timeout=REQUEST_TIMEOUT):
+        self.socket_file = socket_file
+        self.jobs = jobs
+        self.timeout = timeout
+        self.layouts = [os.path.abspath(layout) for layout in layouts]
+        self.stats = ServiceStats()
+        self.pool = None
+        self.server = None
+
+    def start(self):
+        for layout in self.layouts:
+            _checker(layout, 0.0, 0.0)
+        _check_socket_dir(self.socket_file)
+        self._remove_stale_socket()
+        self.pool = multiprocessing.Pool(self.jobs, _init_worker)
+        self.server = _Server(self.socket_file, _RequestHandler)
+        self.server.service = self
+        return self
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_file):
+            return
+        client = None
+        try:
+            client = ValidationClient(self.socket_file)
+            client.ping()
+        except socket.error:
+            # Left behind by a service which died
+            os.remove(self.socket_file)
+            return
+        finally:
+            if client is not None:
+                client.close()
+        raise ServiceError("A validation service is already running on %s"%(self.socket_file))
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.socket_file):
+                os.remove(self.socket_file)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+class ValidationClient:
+    '''Client of a ValidationService'''
+    def __init__(self, socket_file=SOCKET_FILE, timeout=None):
+        _check_socket_dir(socket_file)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_file)
+        self.rfile = self.sock.makefile('rb')
+        self.next_id = 0
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def _send(self, request):
+        self.next_id += 1
+        request['id'] = self.next_id
+        self.sock.sendall(json.dumps(request) + "\n")
+        return self.next_id
+
+    def _receive(self):
+        line = self.rfile.readline()
+        if not line:
+            raise ServiceError("The validation service closed the connection")
+        return json.loads(line)
+
+    def request(self, request):
+        '''Send one request and return its response'''
+        self._send(request)
+        return self._receive()
+
+    def ping(self):
+        return self.request({'op': 'ping'})
+
+    def stats(self):
+        return self.request({'op': 'stats'})['stats']
+
+    def validate(self, xml_file, hdf_file, schema=False, rtol=0.0, atol=0.0):
+        '''Validate one file. Returns the response dictionary: 'valid' and 'problems'
+        if 'ok', else 'error'.'''
+        return self.validate_many(xml_file, [hdf_file], schema, rtol, atol)[0]
+
+    def validate_many(self, xml_file, hdf_files, schema=False, rtol=0.0, atol=0.0):
+        '''Validate many files against one layout. All requests are sent before any
+        response is read, so the service checks them in parallel. Returns the
+        responses in the order of hdf_files.'''
+        ids = [self._send({'op': 'validate', 'xml': os.path.abspath(xml_file), 'hdf': os.path.abspath(hdf_file),
+                           'schema': schema, 'rtol': rtol, 'atol': atol})
+               for hdf_file in hdf_files]
+        responses = dict()
+        while len(responses) < len(ids):
+            response = self._receive()
+            responses[response['id']] = response
+        return [responses[i] for i in ids]
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident HDF5 validation service on a local UNIX socket "
+                                     "(serve), and its client (check, stats)")
+    parser.add_argument('--socket', '-s', metavar='FILE', dest='socket_file', action='store', default=SOCKET_FILE,
+                        help='UNIX socket of the service')
+    subparsers = parser.add_subparsers(dest='command')
+    serve = subparsers.add_parser('serve', help='Run the service')
+    serve.add_argument('--jobs', '-j', metavar='N', dest='jobs', action='store', type=int,
+                       default=multiprocessing.cpu_count(), help='Number of worker processes')
+    serve.add_argument('--layout', '-l', metavar='XMLFILE', dest='layouts', action='append', default=[],
+                       help='Load this XML layout at start up (repeat for more layouts)')
+    serve.add_argument('--timeout', metavar='T', dest='timeout', action='store', type=float,
+                       default=REQUEST_TIMEOUT, help='Seconds before a request which is not answered fails')
+    check = subparsers.add_parser('check', help='Validate HDF5 files through the service')
+    check.add_argument('xmlfile', metavar='XMLFILE', type=str,
+                       help='XML file describing the layout of the HDF5 files')
+    check.add_argument('hdf5files', metavar='HDF5FILE', type=str, nargs='+',
+                       help='HDF5 file to validate')
+    check.add_argument('--schema', dest='schema', action='store_true', default=False,
+                       help='Also validate the XML layout against the XSD schema')
+    check.add_argument('--float-rtol', dest='rtol', action='store', type=float, default=0.0,
+                       help='Relative tolerance of float constant attributes')
+    check.add_argument('--float-atol', dest='atol', action='store', type=float, default=0.0,
+                       help='Absolute tolerance of float constant attributes')
+    subparsers.add_parser('stats', help='Print the request, queue depth and latency statistics of the service')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        service = ValidationService(args.socket_file, args.jobs, args.layouts, args.timeout).start()
+        # Stop cleanly (removing the socket) when told to
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, terminate)
+        print "Validation service with %d workers on %s"%(args.jobs, args.socket_file)
+        try:
+            service.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    client = ValidationClient(args.socket_file)
+    try:
+        if args.command == 'stats':
+            print json.dumps(client.stats(), indent=1, sort_keys=True)
+            return
+        failed = False
+        for response in client.validate_many(args.xmlfile, args.hdf5files, args.schema, args.rtol, args.atol):
+            if not response['ok']:
+                print "ERROR: %s"%(response['error'])
+                failed = True
+            elif response['valid']:
+                print "%s: OK (%.1fms)"%(response['file'], response['check_ms'])
+            else:
+                print "%s: %d problems\n%s"%(response['file'], len(response['problems']),
+                                             "\n".join(["  " + problem for problem in response['problems']]))
+                failed = True
+    finally:
+        client.close()
+    if failed:
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
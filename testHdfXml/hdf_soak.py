@@ -0,0 +1,268 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import time
+import subprocess
+import csv
+import numpy
+
+# Columns of the time series of a soak run, after the memory series
+SAMPLE_FIELDS = ['cycle', 'time', 'mode', 'elapsed', 'ok']
+
+class ManualRestart:
+    '''Ask the operator to restart the IOC (as the heap corruption script always did)'''
+    def __init__(self, autosave_wait=30.0, sleep=time.sleep):
+        self.autosave_wait = autosave_wait
+        self.sleep = sleep
+
+    def __call__(self):
+        print "Waiting %.0fsec for autosave to do its thing"%(self.autosave_wait)
+        self.sleep(self.autosave_wait)
+        print "Please SHUT DOWN the IOC - and restart it!"
+        raw_input("Hit enter when IOC is running again and autosave has restored PVs... ")
+
+class CommandRestart:
+    '''Restart the IOC with a shell command (for example a procServ or systemd restart,
+    possibly through ssh), then wait until ready() returns True: the IOC is back and
+    autosave has restored its PVs.'''
+    def __init__(self, command, ready=None, autosave_wait=30.0, timeout=300.0, sleep=time.sleep):
+        self.command = command
+        self.ready = ready
+        self.autosave_wait = autosave_wait
+        self.timeout = timeout
+        self.sleep = sleep
+
+    def __call__(self):
+        self.sleep(self.autosave_wait)
+        status = subprocess.call(self.command, shell=True)
+        if status != 0:
+            raise RuntimeError("IOC restart command \'%s\' failed with status %d"%(self.command, status))
+        deadline = time.time() + self.timeout
+        while self.ready is not None and not self.ready():
+            if time.time() > deadline:
+                raise RuntimeError("IOC not ready %.0fs after restart"%(self.timeout))
+            self.sleep(1.0)
+
+class ProcRss:
+    '''Resident set size in bytes of a process on this host, from /proc'''
+    def __init__(self, pid):
+        self.pid = pid
+
+    def __call__(self):
+        with open("/proc/%d/status"%(self.pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return None
+
+class CommandRss:
+    '''Resident set size in bytes from a shell command printing it in kB, for an IOC
+    on another host: "ssh iochost ps -o rss= -C st.cmd" for example'''
+    def __init__(self, command):
+        self.command = command
+
+    def __call__(self):
+        return int(subprocess.check_output(self.command, shell=True).split()[0]) * 1024
+
+def leak_rate(x, y, warmup=0.1):
+    '''Least squares slope of y over x, leaving out the first warmup fraction of the
+    samples (while pools and caches fill up). Returns None with too few samples.'''
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    keep = numpy.isfinite(y)
+    x, y = x[keep], y[keep]
+    start = int(len(x) * warmup)
+    x, y = x[start:], y[start:]
+    if len(x) < 3 or numpy.ptp(x) == 0:
+        return None
+    return numpy.polyfit(x, y, 1)[0]
+
+def segments(cycles, restarts):
+    '''Split the samples at the IOC restarts. cycles are the cycle numbers of the
+    samples, restarts the cycles after which the IOC was restarted. Returns the
+    list of (start, stop) sample index ranges between the restarts.'''
+    cycles = numpy.asarray(cycles)
+    bounds = sorted(set([int(numpy.searchsorted(cycles, restart, side='right')) for restart in restarts]))
+    bounds = [0] + [bound for bound in bounds if 0 < bound < len(cycles)] + [len(cycles)]
+    return [(start, stop) for (start, stop) in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def segmented_leak_rate(x, y, ranges, warmup=0.1):
+    '''Leak rate of a series which restarts from its baseline at every IOC restart:
+    the slope is fitted within each of the (start, stop) sample ranges, leaving out
+    its own warmup, and the slopes are averaged weighted by the number of samples
+    fitted. Returns None if no range has enough samples.'''
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    slopes, weights = [], []
+    for (start, stop) in ranges:
+        slope = leak_rate(x[start:stop], y[start:stop], warmup)
+        if slope is None:
+            continue
+        fitted = numpy.isfinite(y[start:stop]).sum()
+        slopes.append(slope)
+        weights.append(fitted - int(fitted * warmup))
+    if not slopes:
+        return None
+    return numpy.average(slopes, weights=weights)
+
+def step_changes(y, min_step, threshold=8.0, boundaries=()):
+    '''Return [(index, step)] of the jumps in a series: samples which differ from the
+    previous one by more than min_step and by more than threshold times the median
+    absolute deviation of all the sample to sample differences. The differences
+    into the samples at the indices in boundaries (the first samples after IOC
+    restarts) are not taken into account.'''
+    y = numpy.asarray(y, dtype=numpy.float64)
+    diffs = numpy.diff(y)
+    keep = numpy.isfinite(diffs)
+    for boundary in boundaries:
+        if 0 < boundary <= len(diffs):
+            keep[boundary - 1] = False
+    if keep.sum() < 3:
+        return []
+    median = numpy.median(diffs[keep])
+    mad = numpy.median(numpy.abs(diffs[keep] - median))
+    limit = max(min_step, threshold * mad)
+    return [(i + 1, diffs[i]) for i in numpy.flatnonzero(keep & (numpy.abs(diffs - median) > limit))]
+
+class SoakReport:
+    '''The time series of a soak run and what it tells about memory use.
+
+    Each sample holds the cycle number, time since start, the mode of the cycle, how
+    long it took, whether it succeeded and the memory series (PoolUsedMem in MB of the
+    driver and the plugin, RSS in bytes; NaN where a sample could not be read).'''
+    def __init__(self, series):
+        # Names of the memory series and their minimum step size
+        self.series = series
+        self.samples = []
+        self.restarts = []
+
+    def add(self, sample):
+        self.samples.append(sample)
+
+    def column(self, name):
+        return numpy.array([sample[name] for sample in self.samples], dtype=numpy.float64)
+
+    @property
+    def failures(self):
+        return [sample for sample in self.samples if not sample['ok']]
+
+    def segments(self):
+        '''The (start, stop) sample ranges between the IOC restarts'''
+        return segments(self.column('cycle'), [cycle for (cycle, elapsed) in self.restarts])
+
+    def leak_rates(self, warmup=0.1):
+        '''{series: (growth per cycle, growth per hour)} of the memory series. Each IOC
+        restart takes the memory back to its baseline, so the growth is fitted between
+        the restarts (see segmented_leak_rate).'''
+        cycles = self.column('cycle')
+        times = self.column('time')
+        ranges = self.segments()
+        rates = dict()
+        for name in self.series:
+            values = self.column(name)
+            per_hour = segmented_leak_rate(times, values, ranges, warmup)
+            if per_hour is not None:
+                # The sample times are in seconds
+                per_hour *= 3600.0
+            rates[name] = (segmented_leak_rate(cycles, values, ranges, warmup), per_hour)
+        return rates
+
+    def steps(self):
+        '''[(cycle, series, step)] of the step changes in the memory series, other than
+        the drops at the IOC restarts'''
+        cycles = self.column('cycle')
+        boundaries = [start for (start, stop) in self.segments()[1:]]
+        steps = []
+        for name, min_step in self.series.iteritems():
+            steps += [(int(cycles[i]), name, step)
+                      for (i, step) in step_changes(self.column(name), min_step, boundaries=boundaries)]
+        return sorted(steps)
+
+    def save_csv(self, fname):
+        with open(fname, 'wb') as f:
+            writer = csv.DictWriter(f, SAMPLE_FIELDS + sorted(self.series), extrasaction='ignore')
+            writer.writeheader()
+            for sample in self.samples:
+                writer.writerow(sample)
+
+    def summary(self, warmup=0.1):
+        lines = ["%d cycles, %d failed, %d IOC restarts"%(len(self.samples), len(self.failures), len(self.restarts))]
+        if self.samples:
+            lines[0] += " in %.1fs"%(self.samples[-1]['time'])
+        for name, (per_cycle, per_hour) in sorted(self.leak_rates(warmup).iteritems()):
+            if per_cycle is None:
+                lines.append("  %-24s: not enough samples"%(name))
+            else:
+                lines.append("  %-24s: %+.4g per cycle, %+.4g per hour"%(name, per_cycle, per_hour))
+        for (cycle, name, step) in self.steps():
+            lines.append("  step in %s at cycle %d: %+.4g"%(name, cycle, step))
+        for sample in self.failures[:10]:
+            lines.append("  cycle %d (%s) failed"%(sample['cycle'], sample['mode']))
+        return "\n".join(lines)
+
+class SoakHarness:
+    '''Run capture cycles over and over, unattended, and sample memory use after each.
+
+    cycles is a list of (mode name, function) run in turn: one soak cycle is one call.
+    probes is a dictionary {series name: (function returning the value, minimum step)}
+    sampled after every cycle. restart (a callable, see ManualRestart and CommandRestart)
+    restarts the IOC every restart_every cycles and after a failed cycle; with restart
+    None a failed cycle ends the run.'''
+    def __init__(self, cycles, probes, restart=None, restart_every=0, setup=None):
+        self.cycles = cycles
+        self.probes = probes
+        self.restart = restart
+        self.restart_every = restart_every
+        self.setup = setup
+
+    def _sample(self, sample):
+        for name, (probe, min_step) in self.probes.iteritems():
+            try:
+                value = probe()
+            except Exception, e:
+                print "Cannot sample %s: %s"%(name, e)
+                value = None
+            if value is None:
+                value = float('nan')
+            sample[name] = value
+
+    def _restart(self, report, cycle, start):
+        self.restart()
+        report.restarts.append( (cycle, time.time() - start) )
+        if self.setup is not None:
+            self.setup()
+
+    def run(self, num_cycles, report_every=100):
+        report = SoakReport(dict([(name, min_step) for name, (probe, min_step) in self.probes.iteritems()]))
+        if self.setup is not None:
+            self.setup()
+        start = time.time()
+        for cycle in range(num_cycles):
+            mode, function = self.cycles[cycle % len(self.cycles)]
+            cycle_start = time.time()
+            ok = True
+            try:
+                function()
+            except Exception, e:
+                ok = False
+                print "Cycle %d (%s) failed: %s"%(cycle, mode, e)
+            sample = {'cycle': cycle, 'time': time.time() - start, 'mode': mode,
+                      'elapsed': time.time() - cycle_start, 'ok': ok}
+            self._sample(sample)
+            report.add(sample)
+            if report_every and (cycle + 1) % report_every == 0:
+                print "Cycle %d: %s"%(cycle + 1, ", ".join(["%s %.4g"%(name, sample[name])
+                                                             for name in sorted(self.probes)]))
+            if not ok:
+                if self.restart is None:
+                    break
+                self._restart(report, cycle, start)
+            elif self.restart is not None and self.restart_every and (cycle + 1) % self.restart_every == 0:
+                self._restart(report, cycle, start)
+        return report
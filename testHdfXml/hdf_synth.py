@@ -0,0 +1,281 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, argparse
+import random
+from xml.sax.saxutils import quoteattr
+import numpy
+import h5py
+
+import hdf_xml
+import hdf_ndattr
+
+# The types of the constant attributes, used in turn
+CONSTANT_TYPES = [hdf_xml.INT, hdf_xml.FLOAT, 'string']
+# The 'when' of the NDAttribute attributes, used in turn ('' is every frame)
+WHEN_VALUES = ['', hdf_ndattr.ON_FILE_OPEN, hdf_ndattr.ON_FILE_CLOSE]
+
+class LayoutSpec:
+    '''The shape of a synthetic layout.
+
+    Attributes:
+        depth:      Number of levels of groups below the top 'entry' group
+        fanout:     Number of child groups of each group
+        groups:     Total number of groups (the tree is filled breadth first and
+                    cut off at this number) or None for the full tree
+        datasets:   Number of NDAttribute datasets in each group
+        attributes: Number of attributes of each group and dataset
+        ndattribute_fraction: Fraction of the attributes with an NDAttribute source
+                    (the rest are int, float and string constants)
+        frames:     Number of frames in the matching HDF5 files
+        frame_shape: (y, x) size of the detector frames
+    '''
+    def __init__(self, depth=3, fanout=4, groups=None, datasets=2, attributes=4,
+                 ndattribute_fraction=0.25, frames=4, frame_shape=(4, 4)):
+        self.depth = depth
+        self.fanout = fanout
+        self.groups = groups
+        self.datasets = datasets
+        self.attributes = attributes
+        self.ndattribute_fraction = ndattribute_fraction
+        self.frames = frames
+        self.frame_shape = frame_shape
+
+    @property
+    def max_groups(self):
+        '''Number of groups in the full tree'''
+        return sum([self.fanout**level for level in range(self.depth + 1)])
+
+    @property
+    def num_groups(self):
+        if self.groups is None:
+            return self.max_groups
+        return min(self.groups, self.max_groups)
+
+    @property
+    def elements(self):
+        '''Number of XML elements (groups, datasets and attributes) of the layout'''
+        # Each group has its attributes and datasets, the top group also the detector dataset
+        per_group = 1 + self.attributes + self.datasets * (1 + self.attributes)
+        return self.num_groups * per_group + 1 + self.attributes
+
+    @property
+    def key(self):
+        '''Identifies the spec in file names'''
+        return "d%d_f%d_g%d_s%d_a%d_n%.0f"%(self.depth, self.fanout, self.num_groups, self.datasets,
+                                           self.attributes, 100*self.ndattribute_fraction)
+
+    def __repr__(self):
+        return "<LayoutSpec: %s, %d elements>"%(self.key, self.elements)
+
+def spec_for_elements(elements, depth=3, datasets=2, attributes=4, ndattribute_fraction=0.25, **kargs):
+    '''Return a LayoutSpec of about the given number of XML elements: the number of
+    groups follows from the size of a group, the fanout is the smallest which holds
+    that many groups in depth levels'''
+    per_group = 1 + attributes + datasets * (1 + attributes)
+    groups = max(1, int(round((elements - 1 - attributes) / float(per_group))))
+    fanout = 1
+    while sum([fanout**level for level in range(depth + 1)]) < groups:
+        fanout += 1
+    return LayoutSpec(depth, fanout, groups, datasets, attributes, ndattribute_fraction, **kargs)
+
+class _Group:
+    '''A group of the synthetic layout tree'''
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.attributes = []
+        self.datasets = []
+        self.children = []
+
+class SyntheticLayout:
+    '''A generated layout tree, written out as an XML layout file (valid against the
+    XSD schema) and as a HDF5 file with exactly that structure, which passes the
+    checks of test_hdf_xml.py. The top group 'entry' holds the detector dataset.
+    The same spec and seed always give the same layout.
+
+    Attributes are (name, source, type or 'when', value or NDAttribute name) tuples,
+    datasets (name, source, NDAttribute name, attributes) tuples.
+    '''
+    def __init__(self, spec, seed=0):
+        self.spec = spec
+        self.random = random.Random(seed)
+        self.ndattributes = 0
+        self.root = _Group("entry", "/entry")
+        self.root.attributes = self._attributes()
+        self.root.datasets.append( ("data", hdf_xml.DETECTOR, None, self._attributes()) )
+        self._build()
+
+    def _attributes(self):
+        attributes = []
+        for i in range(self.spec.attributes):
+            if self.random.random() < self.spec.ndattribute_fraction:
+                attributes.append( ("ndattr%d"%(i), hdf_xml.NDATTRIBUTE, WHEN_VALUES[i % len(WHEN_VALUES)],
+                                    self._ndattribute()) )
+            else:
+                attr_type = CONSTANT_TYPES[i % len(CONSTANT_TYPES)]
+                count = self.random.choice([1, 1, 1, 4])
+                if attr_type == hdf_xml.INT:
+                    value = ",".join([str(self.random.randint(-1000, 1000)) for n in range(count)])
+                elif attr_type == hdf_xml.FLOAT:
+                    value = ",".join([repr(round(self.random.uniform(-1e3, 1e3), 6)) for n in range(count)])
+                else:
+                    value = "value_%d"%(self.random.randint(0, 1000000))
+                attributes.append( ("const%d"%(i), hdf_xml.CONSTANT, attr_type, value) )
+        return attributes
+
+    def _ndattribute(self):
+        self.ndattributes += 1
+        return "Synth%d"%(self.ndattributes)
+
+    def _build(self):
+        # Breadth first, so a cut off tree is still as shallow and wide as possible
+        level = [self.root]
+        count = 1
+        for depth in range(self.spec.depth + 1):
+            next_level = []
+            for group in level:
+                for i in range(self.spec.datasets):
+                    group.datasets.append( ("attr%d"%(i), hdf_xml.NDATTRIBUTE, self._ndattribute(), self._attributes()) )
+                if depth == self.spec.depth:
+                    continue
+                for i in range(self.spec.fanout):
+                    if count >= self.spec.num_groups:
+                        break
+                    child = _Group("group%d"%(i), group.path + "/group%d"%(i))
+                    child.attributes = self._attributes()
+                    group.children.append(child)
+                    next_level.append(child)
+                    count += 1
+            level = next_level
+
+    def groups(self):
+        '''Yield all groups, depth first in document order'''
+        stack = [self.root]
+        while stack:
+            group = stack.pop()
+            yield group
+            stack.extend(reversed(group.children))
+
+    def write_xml(self, fname):
+        with open(fname, 'w') as f:
+            f.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<xml>\n")
+            self._write_group(f, self.root, "  ")
+            f.write("</xml>\n")
+
+    def _write_attributes(self, f, attributes, indent):
+        for (name, source, type_or_when, value) in attributes:
+            if source == hdf_xml.CONSTANT:
+                f.write("%s<attribute name=\"%s\" source=\"constant\" value=%s type=\"%s\"/>\n"
+                        %(indent, name, quoteattr(value), type_or_when))
+            elif type_or_when:
+                f.write("%s<attribute name=\"%s\" source=\"ndattribute\" ndattribute=\"%s\" when=\"%s\"/>\n"
+                        %(indent, name, value, type_or_when))
+            else:
+                f.write("%s<attribute name=\"%s\" source=\"ndattribute\" ndattribute=\"%s\"/>\n"
+                        %(indent, name, value))
+
+    def _write_group(self, f, group, indent):
+        f.write("%s<group name=\"%s\">\n"%(indent, group.name))
+        self._write_attributes(f, group.attributes, indent + "  ")
+        for (name, source, ndattribute, attributes) in group.datasets:
+            if source == hdf_xml.DETECTOR:
+                f.write("%s  <dataset name=\"%s\" source=\"detector\" det_default=\"true\">\n"%(indent, name))
+            else:
+                f.write("%s  <dataset name=\"%s\" source=\"ndattribute\" ndattribute=\"%s\">\n"
+                        %(indent, name, ndattribute))
+            self._write_attributes(f, attributes, indent + "    ")
+            f.write("%s  </dataset>\n"%(indent))
+        for child in group.children:
+            self._write_group(f, child, indent + "  ")
+        f.write("%s</group>\n"%(indent))
+
+    def write_hdf(self, fname):
+        '''Write the matching HDF5 file, with frames and NDAttribute values as the file writer would'''
+        frames = self.spec.frames
+        with h5py.File(fname, 'w') as hdf:
+            for group in self.groups():
+                hdf_group = hdf.create_group(group.path)
+                self._set_attributes(hdf_group, group.attributes)
+                for (name, source, ndattribute, attributes) in group.datasets:
+                    if source == hdf_xml.DETECTOR:
+                        data = numpy.zeros((frames,) + tuple(self.spec.frame_shape), dtype=numpy.uint16)
+                    else:
+                        data = numpy.arange(frames, dtype=numpy.float64)
+                    self._set_attributes(hdf_group.create_dataset(name, data=data), attributes)
+
+    def _set_attributes(self, obj, attributes):
+        for (name, source, type_or_when, value) in attributes:
+            if source == hdf_xml.NDATTRIBUTE:
+                obj.attrs[name] = numpy.float64(0.0)
+            elif type_or_when == hdf_xml.INT:
+                obj.attrs[name] = numpy.array(hdf_xml._constant_value(type_or_when, value), dtype=numpy.int32)
+            elif type_or_when == hdf_xml.FLOAT:
+                obj.attrs[name] = numpy.array(hdf_xml._constant_value(type_or_when, value), dtype=numpy.float64)
+            else:
+                obj.attrs[name] = numpy.string_(value)
+
+def generate(spec, directory, seed=0, hdf=True):
+    '''Write the layout of spec (and its HDF5 file) to directory, unless they are
+    there already. Returns the names of the (XML file, HDF5 file or None).'''
+    base = os.path.join(directory, "synth_%s_r%d"%(spec.key, seed))
+    xml_file = base + ".xml"
+    hdf_file = None
+    if hdf:
+        hdf_file = base + ".h5"
+    if os.path.exists(xml_file) and (hdf_file is None or os.path.exists(hdf_file)):
+        return xml_file, hdf_file
+    layout = SyntheticLayout(spec, seed)
+    # Write to temporary names first so an interrupted run leaves no half files to be reused
+    layout.write_xml(xml_file + ".tmp")
+    if hdf_file is not None:
+        layout.write_hdf(hdf_file + ".tmp")
+        os.rename(hdf_file + ".tmp", hdf_file)
+    os.rename(xml_file + ".tmp", xml_file)
+    return xml_file, hdf_file
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic XML layout of any size, valid against the "
+                                     "XSD schema, and a HDF5 file with the matching structure")
+    parser.add_argument('--elements', metavar='N', dest='elements', action='store', type=int, default=None,
+                        help='Approximate number of XML elements (sets the number of groups and the fanout)')
+    parser.add_argument('--depth', metavar='N', dest='depth', action='store', type=int, default=3,
+                        help='Number of levels of groups below the top group')
+    parser.add_argument('--fanout', metavar='N', dest='fanout', action='store', type=int, default=4,
+                        help='Number of child groups of each group')
+    parser.add_argument('--datasets', metavar='N', dest='datasets', action='store', type=int, default=2,
+                        help='Number of NDAttribute datasets in each group')
+    parser.add_argument('--attributes', metavar='N', dest='attributes', action='store', type=int, default=4,
+                        help='Number of attributes of each group and dataset')
+    parser.add_argument('--ndattribute-fraction', metavar='F', dest='ndattribute_fraction', action='store',
+                        type=float, default=0.25, help='Fraction of NDAttribute (rather than constant) attributes')
+    parser.add_argument('--frames', metavar='N', dest='frames', action='store', type=int, default=4,
+                        help='Number of frames in the HDF5 file')
+    parser.add_argument('--seed', metavar='N', dest='seed', action='store', type=int, default=0,
+                        help='Seed of the random attribute mix and values')
+    parser.add_argument('--dir', '-d', metavar='DIR', dest='directory', action='store', default='.',
+                        help='Directory to write the files to')
+    parser.add_argument('--no-hdf', dest='hdf', action='store_false', default=True,
+                        help='Only write the XML layout')
+    args = parser.parse_args()
+
+    if args.elements is not None:
+        spec = spec_for_elements(args.elements, args.depth, args.datasets, args.attributes,
+                                 args.ndattribute_fraction, frames=args.frames)
+    else:
+        spec = LayoutSpec(args.depth, args.fanout, None, args.datasets, args.attributes,
+                          args.ndattribute_fraction, args.frames)
+    xml_file, hdf_file = generate(spec, args.directory, args.seed, args.hdf)
+    print "%s: %d groups, %d elements"%(xml_file, spec.num_groups, spec.elements)
+    if hdf_file is not None:
+        print hdf_file
+
+if __name__=="__main__":
+    main()
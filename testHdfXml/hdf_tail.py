@@ -0,0 +1,299 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, sys, time, argparse
+import bisect
+import numpy
+import h5py
+
+import hdf_xml
+import hdf_index
+import hdf_compare
+import hdf_ndattr
+import hdf_frames
+
+# Seconds between polls of the file for new frames
+POLL_PERIOD = 0.05
+
+class StructureError(Exception):
+    '''Raised when a file being written does not have the structure of its XML definition'''
+    def __init__(self, result):
+        Exception.__init__(self, str(result))
+        self.result = result
+
+class FrameClock:
+    '''The times at which a frame counter (the driver's ArrayCounter_RBV) reached its
+    values, as seen by a monitor. update() is the monitor callback. A monitor may
+    skip values; time_of() then gives the time the counter first reached or passed
+    the requested value.'''
+    def __init__(self):
+        self.counters = []
+        self.times = []
+
+    def update(self, counter):
+        counter = int(counter)
+        if self.counters and counter < self.counters[-1]:
+            # The counter was reset: a new acquisition
+            self.counters = []
+            self.times = []
+        if not self.counters or counter > self.counters[-1]:
+            self.counters.append(counter)
+            self.times.append(time.time())
+
+    def time_of(self, counter):
+        i = bisect.bisect_left(self.counters, counter)
+        if i == len(self.counters):
+            return None
+        return self.times[i]
+
+class _StepCheck:
+    '''Incremental check of a per-frame NDAttribute dataset, block by block as
+    frames are appended: counters must increase by exactly one, time stamps must
+    never decrease. Only the first problem of a dataset is reported.'''
+    def __init__(self, name, counter):
+        self.name = name
+        self.counter = counter
+        self.previous = None
+        self.failed = False
+
+    def check(self, start, block):
+        if self.failed or not len(block):
+            return []
+        if self.counter:
+            block = hdf_ndattr.frame_rows(block, numpy.int64)
+        else:
+            block = hdf_ndattr.frame_rows(block, numpy.float64)
+        if self.previous is not None:
+            block = numpy.concatenate((self.previous, block))
+            start -= 1
+        self.previous = block[-1:]
+        if self.counter:
+            bad = numpy.flatnonzero((numpy.diff(block, axis=0) != 1).any(axis=1))
+            description = "counter gap"
+        else:
+            bad = numpy.flatnonzero((numpy.diff(block, axis=0) < 0).any(axis=1))
+            description = "time stamp decreases"
+        if not bad.size:
+            return []
+        self.failed = True
+        return ["NDAttribute dataset \'%s\' %s at frame %d: %s -> %s"
+                %(self.name, description, start + bad[0] + 1,
+                  hdf_ndattr.row_text(block[bad[0]]), hdf_ndattr.row_text(block[bad[0]+1]))]
+
+class TailResult:
+    '''The outcome of following a file while it was written.
+
+    Attributes:
+        filename:   The HDF5 file
+        structure:  Structural problems found when the file appeared (the tail
+                    stops at once if there are any)
+        problems:   Problems found in the frames and per-frame NDAttributes
+        frames:     Number of frames seen on disk
+        latencies:  Seconds from each frame's acquisition to it being visible on
+                    disk (only for frames whose acquisition time is known)
+        elapsed:    Seconds spent following the file
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.structure = []
+        self.problems = []
+        self.frames = 0
+        self.latencies = []
+        self.elapsed = 0.0
+
+    @property
+    def valid(self):
+        return not (self.structure or self.problems)
+
+    def latency_summary(self):
+        '''(mean, median, 95th percentile, max) of the latencies or None'''
+        if not self.latencies:
+            return None
+        latencies = numpy.array(self.latencies)
+        return (latencies.mean(), numpy.median(latencies), numpy.percentile(latencies, 95), latencies.max())
+
+    def __str__(self):
+        s = "%s: %d frames followed in %.3fs"%(self.filename, self.frames, self.elapsed)
+        latency = self.latency_summary()
+        if latency is not None:
+            s += ", latency to disk mean %.1fms median %.1fms 95%% %.1fms max %.1fms"\
+                %tuple([1000.*value for value in latency])
+        problems = self.structure + self.problems
+        if problems:
+            s += "\n%d problems:\n%s"%(len(problems), "\n".join(["  " + problem for problem in problems]))
+        return s
+
+class TailValidator:
+    '''Follow a HDF5 file while the file writer produces it in SWMR mode.
+    As soon as the file can be opened its structure is checked against the XML
+    definition: all groups and detector datasets must exist with their attributes
+    (apart from the ones only written when the file is closed). After that the
+    newly appended frames are checked on every poll: the per-frame NDAttribute
+    counters and time stamps and, if a reference is given (see hdf_frames), the
+    detector frame data.
+
+    Given a FrameClock of the driver's ArrayCounter, the latency from the acquisition
+    of each frame to it being visible on disk is measured. Frames are matched to the
+    counter through the ArrayCounter NDAttribute dataset if there is one, else frame
+    n (from 0) is taken to be counter value n+1.
+
+    If newer_than (a time.time() value) is given, a file last modified before then
+    is taken to be left over from an earlier run and is not opened: holding it open
+    would also stop the writer from overwriting it.
+    '''
+    def __init__(self, xml_def, hdf_file, reference=None, clock=None, newer_than=None):
+        self.xml_def = xml_def
+        self.hdf_file = hdf_file
+        self.reference = reference
+        self.clock = clock
+        self.newer_than = newer_than
+        self.hdf = None
+        self.result = TailResult(hdf_file)
+        self.datasets = dict()
+        self.steps = dict()
+        self.counter_dataset = None
+        self.detector = None
+
+    def open(self):
+        '''Try to open the file for SWMR reading. Returns True once it is open.'''
+        if not os.path.exists(self.hdf_file):
+            return False
+        # Whole seconds: some file systems don't keep finer modification times
+        if self.newer_than is not None and int(os.path.getmtime(self.hdf_file)) < int(self.newer_than):
+            return False
+        try:
+            self.hdf = h5py.File(self.hdf_file, 'r', libver='latest', swmr=True)
+        except IOError:
+            # Not there yet, or not in SWMR mode yet
+            return False
+        return True
+
+    def close(self):
+        if self.hdf is not None:
+            self.hdf.close()
+            self.hdf = None
+
+    def check_structure(self):
+        '''Check the structure of the opened file. Returns a list of problems.'''
+        index = hdf_index.HdfIndex().build(self.hdf)
+        problems = []
+        for group in self.xml_def.groups:
+            if group not in index:
+                problems.append("Group \'%s\' should exist in the HDF file"%(group))
+        for name, (source, ndattribute, attributes) in self.xml_def.datasets.iteritems():
+            if source == hdf_xml.DETECTOR and name not in index:
+                problems.append("Detector dataset \'%s\' should exist in HDF5"%(name))
+        # Attributes which are only written when the file is closed can't be there yet
+        deferred = set([(attribute.parent, attribute.name) for attribute in self.xml_def.attributes
+                        if attribute.is_ndattribute() and attribute.when == hdf_ndattr.ON_FILE_CLOSE])
+        problems += [str(mismatch) for mismatch in hdf_compare.AttributeComparison(self.xml_def).compare(index)
+                     if (mismatch.path, mismatch.name) not in deferred]
+        self._select_datasets(index)
+        return problems
+
+    def _select_datasets(self, index):
+        '''Select the datasets followed frame by frame'''
+        self.detector = self.xml_def.detector_default
+        if self.detector is not None and self.detector in index:
+            self.datasets[self.detector] = self.hdf[self.detector]
+        for name, ndattribute in hdf_ndattr.ndattribute_datasets(self.xml_def, index).iteritems():
+            if not index[name].shape:
+                continue
+            self.datasets[name] = self.hdf[name]
+            if ndattribute in hdf_ndattr.COUNTER_NDATTRIBUTES:
+                self.steps[name] = _StepCheck(name, True)
+            elif ndattribute in hdf_ndattr.TIMESTAMP_NDATTRIBUTES:
+                self.steps[name] = _StepCheck(name, False)
+            if ndattribute == 'ArrayCounter':
+                self.counter_dataset = name
+
+    def poll(self):
+        '''Check the frames appended since the last poll. Returns the number of new frames.'''
+        now = time.time()
+        if not self.datasets:
+            return 0
+        for dset in self.datasets.itervalues():
+            dset.refresh()
+        # A frame is on disk once all its datasets have been extended
+        visible = min([dset.shape[0] for dset in self.datasets.itervalues()])
+        start = self.result.frames
+        if visible <= start:
+            return 0
+        for name, step in self.steps.iteritems():
+            self.result.problems += step.check(start, self.datasets[name][start:visible])
+        if self.reference is not None and self.detector in self.datasets:
+            block = self.datasets[self.detector][start:visible]
+            self.result.problems += ["Frame %d %s"%(frame, problem)
+                                     for (frame, problem) in self.reference.check_block(start, block)]
+        if self.clock is not None:
+            if self.counter_dataset is not None:
+                counters = hdf_ndattr.frame_rows(self.datasets[self.counter_dataset][start:visible], numpy.int64)[:, 0]
+            else:
+                counters = range(start + 1, visible + 1)
+            for counter in counters:
+                acquired = self.clock.time_of(int(counter))
+                if acquired is not None:
+                    self.result.latencies.append(now - acquired)
+        self.result.frames = visible
+        return visible - start
+
+    def run(self, done=None, sleep=time.sleep, poll_period=POLL_PERIOD, idle_timeout=10.0):
+        '''Follow the file until done() returns True (the writer closed the file), or
+        if done is None until no new frames have appeared for idle_timeout seconds.
+        Stops at once if the structure is wrong. sleep is called between polls: pass
+        cothread.Sleep when running under cothread. Returns the TailResult.'''
+        start = time.time()
+        try:
+            while not self.open():
+                if time.time() - start > idle_timeout:
+                    self.result.structure.append("File did not appear (in SWMR mode) within %.1fs"%(idle_timeout))
+                    return self.result
+                sleep(poll_period)
+            self.result.structure = self.check_structure()
+            if self.result.structure:
+                return self.result
+            last_progress = time.time()
+            while True:
+                finished = done is not None and done()
+                if self.poll():
+                    last_progress = time.time()
+                if finished or (done is None and time.time() - last_progress > idle_timeout):
+                    break
+                sleep(poll_period)
+        finally:
+            self.close()
+            self.result.elapsed = time.time() - start
+        return self.result
+
+def main():
+    parser = argparse.ArgumentParser(description="Follow a HDF5 file while the file writer writes it in SWMR mode "
+                                     "and validate it against its XML layout definition as it grows")
+    parser.add_argument('xmlfile', metavar='XMLFILE', type=str,
+                        help='XML file describing the layout of the HDF5 file')
+    parser.add_argument('hdf5file', metavar='HDF5FILE', type=str,
+                        help='HDF5 file being written')
+    parser.add_argument('--idle', metavar='T', dest='idle', action='store', type=float, default=10.0,
+                        help='Stop after T seconds without new frames')
+    parser.add_argument('--linear-ramp', dest='linear_ramp', action='store_true', default=False,
+                        help='Check the frames against the simDetector LinearRamp pattern')
+    hdf_frames.add_ramp_arguments(parser)
+    args = parser.parse_args()
+
+    reference = None
+    if args.linear_ramp:
+        reference = hdf_frames.ramp_from_arguments(parser, args)
+    tail = TailValidator(hdf_xml.load_definition(args.xmlfile), args.hdf5file, reference)
+    result = tail.run(idle_timeout=args.idle)
+    print result
+    if not result.valid:
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/bin/env dls-python
+import os, time, argparse
+import thread
+import json
+import atexit
+
+# Tracing is enabled for a whole run by setting HDF_TRACE to the name of the
+# Chrome trace file to write at exit; HDF_TRACE_TOP sets the length of the summary.
+TRACE_ENV = 'HDF_TRACE'
+TRACE_TOP_ENV = 'HDF_TRACE_TOP'
+
+class _NullSpan:
+    '''The span handed out while tracing is disabled: does nothing at all'''
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class Span:
+    '''A named, timed operation. Use as a context manager; the span is recorded
+    when the block exits (whether or not it raised).'''
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, type, value, traceback):
+        self.tracer.record(self.name, self.category, self.start, time.time() - self.start, self.args)
+        return False
+
+class Tracer:
+    '''Records spans around Channel Access calls and the parse, index and validate
+    phases. While disabled, span() returns a shared do-nothing object and traced
+    functions call straight through, so the instrumentation can stay in place.
+
+    Each event is a tuple (name, category, start, duration, pid, thread id, args)
+    with times in seconds. The events export to the Chrome trace-event JSON format
+    (load it in chrome://tracing or Perfetto) and summarise as text.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+
+    def enable(self):
+        self.enabled = True
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name, category='', **args):
+        '''Return a context manager recording the enclosed block as a span'''
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, category, args)
+
+    def record(self, name, category, start, duration, args=None):
+        self.events.append( (name, category, start, duration, os.getpid(), thread.get_ident(), args or {}) )
+
+    def traced(self, name, category, function, describe=None):
+        '''Wrap function so every call is recorded as a span. describe(args, kargs)
+        may return a dictionary of arguments to record with the span.'''
+        def wrapper(*args, **kargs):
+            if not self.enabled:
+                return function(*args, **kargs)
+            start = time.time()
+            try:
+                return function(*args, **kargs)
+            finally:
+                details = {}
+                if describe is not None:
+                    details = describe(args, kargs)
+                self.record(name, category, start, time.time() - start, details)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+
+    def take(self):
+        '''Return the recorded events and forget them (to hand them to another process)'''
+        events = self.events
+        self.events = []
+        return events
+
+    def extend(self, events):
+        '''Add events recorded elsewhere (for example in a worker process)'''
+        self.events.extend(events)
+
+    def chrome_trace(self):
+        '''The events as a Chrome trace-event dictionary ('X' complete events in microseconds)'''
+        if not self.events:
+            return {'traceEvents': []}
+        origin = min([event[2] for event in self.events])
+        trace = []
+        for (name, category, start, duration, pid, tid, args) in self.events:
+            trace.append({'name': name, 'cat': category or 'default', 'ph': 'X',
+                          'ts': (start - origin) * 1e6, 'dur': duration * 1e6,
+                          'pid': pid, 'tid': tid, 'args': args})
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self, top=10):
+        '''Text summary: the operations taking the most time in total, and the
+        slowest single calls'''
+        totals = dict()
+        for (name, category, start, duration, pid, tid, args) in self.events:
+            count, total, longest = totals.get((category, name), (0, 0.0, 0.0))
+            totals[(category, name)] = (count + 1, total + duration, max(longest, duration))
+        lines = ["%d spans; top %d operations by total time:"%(len(self.events), top),
+                 "  %-10s %-40s %7s %10s %10s %10s"%('category', 'name', 'count', 'total ms', 'mean ms', 'max ms')]
+        ranked = sorted(totals.iteritems(), key=lambda item: item[1][1], reverse=True)
+        for ((category, name), (count, total, longest)) in ranked[:top]:
+            lines.append("  %-10s %-40s %7d %10.1f %10.2f %10.2f"
+                         %(category, name[:40], count, total*1000., total*1000./count, longest*1000.))
+        lines.append("Top %d slowest calls:"%(top))
+        slowest = sorted(self.events, key=lambda event: event[3], reverse=True)
+        for (name, category, start, duration, pid, tid, args) in slowest[:top]:
+            details = " ".join(["%s=%s"%(key, args[key]) for key in sorted(args)])
+            lines.append("  %10.1fms %-10s %s %s"%(duration*1000., category, name, details))
+        return "\n".join(lines)
+
+# The tracer used by all the modules
+tracer = Tracer()
+
+def span(name, category='', **args):
+    return tracer.span(name, category, **args)
+
+def traced(name, category, function, describe=None):
+    return tracer.traced(name, category, function, describe)
+
+def enable():
+    tracer.enable()
+
+def finish(fname, top=10):
+    '''Save the Chrome trace to fname and print the summary'''
+    tracer.save(fname)
+    print tracer.summary(top)
+    print "Trace of %d spans written to %s"%(len(tracer.events), fname)
+
+def _finish_at_exit(fname, top, pid):
+    # Forked worker processes inherit the handler; only the process which set it up writes
+    if os.getpid() == pid:
+        finish(fname, top)
+
+if os.environ.get(TRACE_ENV):
+    enable()
+    atexit.register(_finish_at_exit, os.environ[TRACE_ENV], int(os.environ.get(TRACE_TOP_ENV, 10)), os.getpid())
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise a Chrome trace file written by the tracing "
+                                     "(HDF_TRACE=FILE or --trace FILE)")
+    parser.add_argument('tracefile', metavar='TRACEFILE', type=str,
+                        help='Chrome trace-event JSON file')
+    parser.add_argument('--top', '-t', metavar='N', dest='top', action='store', type=int, default=10,
+                        help='Number of operations in the summary')
+    args = parser.parse_args()
+
+    with open(args.tracefile) as f:
+        trace = json.load(f)
+    summary = Tracer()
+    for event in trace['traceEvents']:
+        category = event.get('cat', '')
+        if category == 'default':
+            category = ''
+        summary.record(event['name'], category, event['ts'] / 1e6, event['dur'] / 1e6, event.get('args'))
+    print summary.summary(args.top)
+
+if __name__=="__main__":
+    main()
@@ -1,5 +1,16 @@
 #!/bin/env dls-python
-import xml.dom.minidom as xml
+import os
+import posixpath
+import collections
+import hashlib
+import tempfile
+import marshal
+from collections import OrderedDict
+import xml.sax
+import xml.sax.handler
+
+import hdf_cache
+import hdf_trace
 
 CONSTANT = 'constant'
 NDATTRIBUTE = 'ndattribute'
@@ -8,6 +19,7 @@ DATASET = 'dataset'
 ATTRIBUTE = 'attribute'
 SOURCE = 'source'
 DETECTOR = 'detector'
+DET_DEFAULT = 'det_default'
 NAME = 'name'
 INT = 'int'
 FLOAT = 'float'
@@ -15,7 +27,22 @@ WHEN = 'when'
 TYPE = 'type'
 VALUE = 'value'
 
-class HdfAttribute:
+# Bump this whenever the parser, the layout model or the flat form of a definition
+# (see HdfXmlDefinition.flatten) changes in a way which makes previously cached
+# definitions invalid.
+PARSER_VERSION = 4
+
+def _intern(name):
+    '''Intern a name or path so the many repeats of it in a layout share one string.
+    Only (byte) strings can be interned: names with non-ASCII characters stay unicode.'''
+    try:
+        return intern(str(name))
+    except UnicodeEncodeError:
+        return name
+
+class HdfAttribute(object):
+    __slots__ = ('name', 'parent', 'source', 'type', 'value', 'ndattribute', 'when')
+
     def __init__(self, name, parent, source):
         self.name = name
         self.parent = parent
@@ -32,6 +59,13 @@ class HdfAttribute:
         self.ndattribute = None
         self.when = None
         
+    # Pickle the slots as a plain tuple (for the layout cache)
+    def __getstate__(self):
+        return tuple([getattr(self, slot) for slot in self.__slots__])
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
     def is_constant(self):
         return self.source == CONSTANT
     def is_ndattribute(self):
@@ -45,120 +79,534 @@ class HdfAttribute:
         s += ">"
         return s
 
-def getChildrenByName(node, name):
-    '''Utility function that seems to be missing from the xml.dom.minidom module'''
-    for child in node.childNodes:
-        if child.localName==name:
-            yield child
+class HdfNode(object):
+    '''A group or dataset in the layout tree.
+
+    Attributes:
+        name:       Name of the node (interned)
+        path:       Full name of the node (interned)
+        kind:       GROUP or DATASET
+        parent:     Parent HdfNode (None for the root)
+        children:   List of the child HdfNode in document order (None for datasets)
+        attributes: Dictionary of the attributes {Name: HdfAttribute}
+        ndattr_default: Groups only: True if this is the default destination of NDAttributes
+        source:     Datasets only: dataset source [detector, ndattribute, constant]
+        ndattribute: Datasets only: the NDAttribute source name or None
+    '''
+    __slots__ = ('name', 'path', 'kind', 'parent', 'children', 'attributes',
+                 'ndattr_default', 'source', 'ndattribute')
+
+    def __init__(self, name, path, kind, parent):
+        self.name = name
+        self.path = path
+        self.kind = kind
+        self.parent = parent
+        self.children = None
+        if kind == GROUP:
+            self.children = []
+        self.attributes = dict()
+        self.ndattr_default = False
+        self.source = None
+        self.ndattribute = None
+
+    def __getstate__(self):
+        return tuple([getattr(self, slot) for slot in self.__slots__])
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def is_group(self):
+        return self.kind == GROUP
+    def is_dataset(self):
+        return self.kind == DATASET
+
+    def as_tuple(self):
+        '''The (ndattr_default, attributes) or (source, ndattribute, attributes) tuple of
+        the groups and datasets dictionaries'''
+        if self.kind == GROUP:
+            return (self.ndattr_default, self.attributes)
+        return (self.source, self.ndattribute, self.attributes)
+
+    def walk(self):
+        '''Yield this node and all nodes below it, depth first in document order'''
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            if node.children:
+                stack.extend(reversed(node.children))
+
+    def __repr__(self):
+        return "<HdfNode: %s %s>"%(self.kind, self.path)
+
+class _ReadOnlyDict(collections.Mapping):
+    '''Read-only wrapper of a dictionary, for the containers of a frozen definition.
+    The lookups go straight to the wrapped dictionary so they cost no more than before.'''
+    def __init__(self, items):
+        self._items = items
+
+    def __getitem__(self, key):
+        return self._items[key]
+    def __contains__(self, key):
+        return key in self._items
+    def __iter__(self):
+        return iter(self._items)
+    def __len__(self):
+        return len(self._items)
+    def get(self, key, default=None):
+        return self._items.get(key, default)
+    def iteritems(self):
+        return self._items.iteritems()
+    def itervalues(self):
+        return self._items.itervalues()
+    def items(self):
+        return self._items.items()
+    def values(self):
+        return self._items.values()
+    def keys(self):
+        return self._items.keys()
+    def __repr__(self):
+        return repr(self._items)
+
+class _NodeView(collections.Mapping):
+    '''Read-only {full name: tuple} view of the groups or the datasets of a layout,
+    compatible with the dictionaries of earlier versions of HdfXmlDefinition'''
+    def __init__(self, nodes, kind):
+        self._nodes = nodes
+        self._kind = kind
+
+    def __getitem__(self, path):
+        node = self._nodes[path]
+        if node.kind != self._kind:
+            raise KeyError(path)
+        return node.as_tuple()
+
+    def __contains__(self, path):
+        node = self._nodes.get(path)
+        return node is not None and node.kind == self._kind
+
+    def __iter__(self):
+        kind = self._kind
+        return (path for (path, node) in self._nodes.iteritems() if node.kind == kind)
+
+    def __len__(self):
+        kind = self._kind
+        return sum(1 for node in self._nodes.itervalues() if node.kind == kind)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+def _constant_value(attr_type, value):
+    '''Convert the string value of a constant attribute according to its type.
+    Comma separated int and float values are turned into lists (or a single scalar
+    if only one value is given). Other types are returned unchanged.'''
+    if attr_type == INT:
+        value = [int(val) for val in value.split(',')]
+    elif attr_type == FLOAT:
+        value = [float(val) for val in value.split(',')]
+    else:
+        return value
+    if len(value) == 1: value = value[0]
+    return value
+
+class _LayoutHandler(xml.sax.handler.ContentHandler):
+    '''SAX content handler which builds the layout tree of a HdfXmlDefinition in a
+    single pass. A stack of the HdfNode of the currently open elements is kept, so the
+    parent of any element is at hand without walking back up through the document.
+    Elements without a name (like the hdf5_layout root element) are not part of the
+    tree: their children are attached to the root.'''
+    def __init__(self, definition):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.definition = definition
+        self.stack = []
+        self.det_default_found = False
+
+    def startElement(self, tag, attrs):
+        # Only an unbroken chain of named elements make up the parent name
+        parent = self.definition.root
+        if self.stack and self.stack[-1] is not None:
+            parent = self.stack[-1]
+        name = attrs.get(NAME, "")
+        node = None
+        if tag == GROUP and name != "":
+            node = self.definition._add_node(parent, name, GROUP)
+            node.ndattr_default = 'ndattr_default' in attrs
+            if node.ndattr_default and self.definition.ndattr_default is None:
+                self.definition.ndattr_default = node.path
+        elif tag == DATASET and name != "":
+            node = self.definition._add_node(parent, name, DATASET)
+            node.source = attrs.get(SOURCE, "")
+            if node.source == NDATTRIBUTE:
+                node.ndattribute = _intern(attrs.get(NDATTRIBUTE, ""))
+            # The detector frames go to the det_default dataset, or the first detector dataset
+            if node.source == DETECTOR:
+                if attrs.get(DET_DEFAULT, "").lower() in ["true", "1"]:
+                    if not self.det_default_found:
+                        self.definition.detector_default = node.path
+                    self.det_default_found = True
+                elif self.definition.detector_default is None:
+                    self.definition.detector_default = node.path
+        elif tag == ATTRIBUTE:
+            parent_path = ""
+            if self.stack and self.stack[-1] is not None:
+                parent_path = self.stack[-1].path
+            attribute = HdfAttribute(_intern(name), parent_path, attrs.get(SOURCE, ""))
+            # source: "constant" attributes have their type and value defined in the XML
+            if attribute.is_constant():
+                attribute.type = attrs.get(TYPE, "")
+                attribute.value = _constant_value(attribute.type, attrs.get(VALUE, ""))
+            # source: "ndattribute" specify an (areaDetector) NDAttribute name where to get data from
+            # and a 'when' parameter which can be 'OnFileClose', 'OnFileOpen' or defaults to nothing (on every frame)
+            elif attribute.is_ndattribute():
+                attribute.ndattribute = _intern(attrs.get(NDATTRIBUTE, ""))
+                attribute.when = _intern(attrs.get(WHEN, ""))
+            if self.stack and self.stack[-1] is not None:
+                self.stack[-1].attributes.update( {attribute.name: attribute} )
+            self.definition.attributes.append( attribute )
+        self.stack.append( node )
+
+    def endElement(self, tag):
+        self.stack.pop()
 
 class HdfXmlDefinition:
     ''' Read the XML definition of the layout of a HDF5 file.
-    The layout model is populated in containers within the class: gropus and datasets which
-    in turn contain attributes.
+    The layout is held in a tree of HdfNode (groups and datasets) which in turn contain
+    attributes. Every node can be looked up by its full name in O(1) through the 'nodes'
+    dictionary, and subtree() iterates over everything below a given path.
     The group and dataset containers can then be used to verify the correct configuration
     of groups and datasets inside a generated HDF5 file.
     
     Attributes:
-        groups:   Dictionary of groups as defined in the XML definition. 
+        root:     The HdfNode of the HDF5 root group "/"
+        nodes:    Dictionary of all groups and datasets: {full name: HdfNode}
+        groups:   Read-only dictionary view of the groups as defined in the XML definition. 
                   The keys are full names and the values are tuples: 
                     <bool: default destination>, 
                     <Attribute Dictionary: {Name: HdfAttribute}>
-        datasets: Dictionary of datasets as defined in the XML definition.
+        datasets: Read-only dictionary view of the datasets as defined in the XML definition.
                   The keys are full names and the values are tuples:
                     <str: dataset source [detector, ndattribute]>, 
                     <NDAttribute source string or None>,
                     <Attribute Dictionary: {Name: HdfAttribute}> 
+        attributes: List of all HdfAttribute in the XML definition in document order.
+        detector_default: Full name of the detector dataset which receives the detector
+                  frames (the one marked det_default or else the first one) or None.
+        ndattr_default: Full name of the group which receives the NDAttributes that have
+                  no dataset of their own (the first one marked ndattr_default) or None.
+        frozen:   True once freeze() made the definition read-only
     '''
     def __init__(self):
         # The resulting definition from the XML will be loaded into these containers
-        self.groups = dict()
-        self.datasets = dict()
+        self.root = HdfNode("", "/", GROUP, None)
+        self.nodes = dict()
         self.attributes = list()
+        self.detector_default = None
+        self.ndattr_default = None
+        self.frozen = False
         
+    @property
+    def groups(self):
+        return _NodeView(self.nodes, GROUP)
+    @property
+    def datasets(self):
+        return _NodeView(self.nodes, DATASET)
+
     def populate(self, xmlfile):
-        dom = xml.parse ( xmlfile ) 
-        self._handle_groups( dom.getElementsByTagName(GROUP) )
-        self._handle_datasets( dom.getElementsByTagName(DATASET))
-        self._handle_attributes( dom.getElementsByTagName(ATTRIBUTE))
-
-    def _parent_name(self, element):
-        parent = element.parentNode
-        parent_name = ""
-        delimiter = ""
-        while parent.getAttribute(NAME) != "":
-            parent_name = "%s%s%s"%( parent.getAttribute(NAME), delimiter, parent_name )
-            parent = parent.parentNode
-            delimiter = "/"
-        parent_name = "%s%s" %( delimiter, parent_name)
-        return parent_name
-    
-    def _handle_groups(self, groups):
-        for group in groups:
-            group_name = "/".join([self._parent_name(group), group.getAttribute(NAME)])
-            ndattr_default = group.hasAttribute('ndattr_default')
-            hdfattributes = self._get_attributes(group)
-            self.groups.update( {group_name: ( ndattr_default, hdfattributes) } )
-        
-    def _handle_datasets(self, datasets):
-        for dataset in datasets:
-            dset_name = "/".join([self._parent_name(dataset), dataset.getAttribute(NAME)])
-            dset_source = dataset.getAttribute(SOURCE)
-            dset_ndattribute = None
-            if dset_source == NDATTRIBUTE:
-                dset_ndattribute = dataset.getAttribute(NDATTRIBUTE)
-            dset_hdfattributes = self._get_attributes(dataset)
-            self.datasets.update( {dset_name: (dset_source, dset_ndattribute, dset_hdfattributes)})
-                
-    def _get_attributes(self, element):
-        attributes = dict()
-        for child in getChildrenByName(element, ATTRIBUTE):
-            attr_name = child.getAttribute(NAME)
-            attr_parent = self._parent_name(child)
-            attr_source = child.getAttribute(SOURCE)
-            attribute = HdfAttribute(attr_name, attr_parent, attr_source)
-            # source: "constant" attributes have their type and value defined in the XML
-            if attribute.is_constant():
-                attribute.type = child.getAttribute(TYPE)
-                attribute.value = child.getAttribute(VALUE)
-                if attribute.type == INT:
-                    attribute.value = [int(val) for val in attribute.value.split(',')]
-                    if len(attribute.value) == 1: attribute.value = attribute.value[0]
-                elif attribute.type == FLOAT:
-                    attribute.value = [float(val) for val in attribute.value.split(',')]
-                    if len(attribute.value) == 1: attribute.value = attribute.value[0]
-            # source: "ndattribute" specify an (areaDetector) NDAttribute name where to get data from
-            # and a 'when' parameter which can be 'OnFileClose', 'OnFileOpen' or defaults to nothing (on every frame)
-            elif attribute.is_ndattribute():
-                attribute.ndattribute = child.getAttribute(NDATTRIBUTE)
-                attribute.when = child.getAttribute(WHEN)
-            attributes.update( {attr_name: attribute} )
-        return attributes
+        '''Parse the XML file in a single streaming pass and build the layout tree'''
+        with hdf_trace.span("HdfXmlDefinition.populate", "parse", file=xmlfile):
+            xml.sax.parse( xmlfile, _LayoutHandler(self) )
+
+    def freeze(self):
+        '''Make the definition read-only so one copy can be shared by all users of the
+        layout cache: nothing can be added any more, and the nodes dictionary, the
+        attributes list and the children and attributes of the nodes become read-only.'''
+        if self.frozen:
+            return self
+        for node in [self.root] + self.nodes.values():
+            if node.children is not None:
+                node.children = tuple(node.children)
+            node.attributes = _ReadOnlyDict(node.attributes)
+        self.nodes = _ReadOnlyDict(self.nodes)
+        self.attributes = tuple(self.attributes)
+        self.frozen = True
+        return self
+
+    def flatten(self):
+        '''Return the definition as nested tuples of plain values, which marshal can
+        save and load much faster than the tree of objects can be pickled:
+        (attributes, number of listed attributes, nodes, detector_default, ndattr_default).
+        The attributes are the states of all HdfAttribute, those of the attributes list
+        first. The nodes are (name, path, kind, parent path, in the tree, ndattr_default,
+        source, ndattribute, attribute indices) in document order; nodes which a later
+        dataset of the same path cut off from the tree follow at the end.'''
+        attributes = list(self.attributes)
+        index = dict([(id(attribute), i) for (i, attribute) in enumerate(attributes)])
+        def attribute_indices(node):
+            indices = []
+            for attribute in node.attributes.itervalues():
+                if id(attribute) not in index:
+                    index[id(attribute)] = len(attributes)
+                    attributes.append(attribute)
+                indices.append(index[id(attribute)])
+            return tuple(sorted(indices))
+        def record(node, in_tree):
+            return (node.name, node.path, node.kind, node.parent.path, in_tree, node.ndattr_default,
+                    node.source, node.ndattribute, attribute_indices(node))
+        tree = list(self.subtree())
+        in_tree = set([id(node) for node in tree])
+        nodes = [record(node, True) for node in tree]
+        nodes += [record(node, False) for (path, node) in sorted(self.nodes.iteritems())
+                  if id(node) not in in_tree]
+        return (tuple([attribute.__getstate__() for attribute in attributes]), len(self.attributes),
+                tuple(nodes), self.detector_default, self.ndattr_default)
+
+    def load_flat(self, flat):
+        '''Rebuild the definition from the output of flatten(). The objects are made
+        without their __init__ and their slots set directly: this runs once for every
+        element of the layout, so it is what a load from the disk cache costs.'''
+        attributes, listed, nodes, self.detector_default, self.ndattr_default = flat
+        new_attribute = HdfAttribute.__new__
+        objects = []
+        for (name, parent, source, attr_type, value, ndattribute, when) in attributes:
+            attribute = new_attribute(HdfAttribute)
+            attribute.name = name
+            attribute.parent = parent
+            attribute.source = source
+            attribute.type = attr_type
+            attribute.value = value
+            attribute.ndattribute = ndattribute
+            attribute.when = when
+            objects.append(attribute)
+        self.attributes = objects[:listed]
+        new_node = HdfNode.__new__
+        by_path = {"/": self.root}
+        self.nodes = dict()
+        for (name, path, kind, parent_path, in_tree, ndattr_default, source, ndattribute, indices) in nodes:
+            parent = by_path.get(parent_path, self.root)
+            node = new_node(HdfNode)
+            node.name = name
+            node.path = path
+            node.kind = kind
+            node.parent = parent
+            node.children = [] if kind == GROUP else None
+            node.attributes = dict([(objects[i].name, objects[i]) for i in indices])
+            node.ndattr_default = ndattr_default
+            node.source = source
+            node.ndattribute = ndattribute
+            if in_tree:
+                parent.children.append(node)
+                by_path[path] = node
+            self.nodes[path] = node
+        return self
+
+    def _add_node(self, parent, name, kind):
+        if self.frozen:
+            raise TypeError("The layout definition is read-only: it is shared through the layout cache")
+        name = _intern(name)
+        if parent is self.root:
+            path = _intern("/" + name)
+        else:
+            path = _intern(parent.path + "/" + name)
+        previous = self.nodes.get(path)
+        node = HdfNode(name, path, kind, parent)
+        if previous is not None:
+            # A later definition of the same path replaces the earlier entry only, as in
+            # the groups and datasets dictionaries: what was defined below the earlier
+            # group is kept and moves to the new one (or stays in 'nodes' if the new
+            # node is a dataset)
+            previous.parent.children.remove(previous)
+            if previous.children and node.children is not None:
+                for child in previous.children:
+                    child.parent = node
+                node.children.extend(previous.children)
+        parent.children.append(node)
+        self.nodes[path] = node
+        return node
+
+    def _parent_node(self, path):
+        parent = self.nodes.get(posixpath.dirname(path))
+        if parent is None or not parent.is_group():
+            return self.root
+        return parent
+
+    def add_group(self, path, ndattr_default=False):
+        '''Add a group by its full name (below its parent group if that is defined)'''
+        node = self._add_node(self._parent_node(path), posixpath.basename(path), GROUP)
+        node.ndattr_default = ndattr_default
+        if ndattr_default and self.ndattr_default is None:
+            self.ndattr_default = node.path
+        return node
+
+    def add_dataset(self, path, source, ndattribute=None):
+        '''Add a dataset by its full name (below its parent group if that is defined)'''
+        node = self._add_node(self._parent_node(path), posixpath.basename(path), DATASET)
+        node.source = source
+        node.ndattribute = ndattribute
+        if source == DETECTOR and self.detector_default is None:
+            self.detector_default = node.path
+        return node
+
+    def subtree(self, path="/", kind=None):
+        '''Yield the HdfNode at path and all nodes below it in document order,
+        optionally only those of one kind (GROUP or DATASET)'''
+        node = self.root
+        if path != "/":
+            node = self.nodes[path.rstrip("/")]
+        for node in node.walk():
+            if node is not self.root and (kind is None or node.kind == kind):
+                yield node
+
+    def ndattribute_destination(self, ndattribute):
+        '''Full name of the dataset which receives an NDAttribute: the dataset with that
+        ndattribute source, else a dataset named after it in the ndattr_default group
+        (or None if there is neither)'''
+        for node in self.nodes.itervalues():
+            if node.kind == DATASET and node.source == NDATTRIBUTE and node.ndattribute == ndattribute:
+                return node.path
+        if self.ndattr_default is None:
+            return None
+        return "/".join([self.ndattr_default, ndattribute])
+
+class LayoutCache:
+    '''Cache of compiled (parsed) HdfXmlDefinition objects.
+    Definitions are kept in memory for the lifetime of the process and in a cache
+    directory so they survive between runs. Entries are keyed by the SHA1 of the XML
+    file content and the PARSER_VERSION, so an edited layout or a newer parser never
+    picks up a stale entry. The hash of a file is remembered for as long as its size,
+    mtime and inode stay the same, so a load from memory does not read the file again.
+
+    The definitions handed out are frozen (read-only) and shared by all callers, so
+    a load from memory costs no more than a dictionary lookup. On disk a definition
+    is saved in its flat form (see HdfXmlDefinition.flatten) with marshal, which
+    loads several times faster than parsing or unpickling the tree. The cache
+    directory is only used if nobody but the current user can write to it, and any
+    entry which cannot be read back is treated as a miss.
+
+    Both levels are size bounded: the least recently used definitions are dropped
+    from memory beyond max_entries and the least recently used files are removed
+    from the cache directory beyond max_bytes.
+
+    The cache is disabled by setting the 'enabled' attribute to False or by setting
+    the HDF_XML_CACHE environment variable to 0. The cache directory defaults to
+    ~/.cache/hdf_xml and can be changed with the HDF_XML_CACHE_DIR variable.
+    '''
+    def __init__(self, cache_dir=None, max_entries=32, max_bytes=256*1024*1024):
+        if cache_dir is None:
+            cache_dir = hdf_cache.cache_dir('hdf_xml', 'HDF_XML_CACHE_DIR')
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = os.environ.get('HDF_XML_CACHE', '1') not in ['0', 'no', 'off']
+        self._memory = OrderedDict()
+        self._keys = dict()
+
+    def key(self, xmlfile):
+        '''Return the cache key for the current content of xmlfile'''
+        path = os.path.abspath(xmlfile)
+        stat = os.stat(path)
+        stat = (stat.st_size, stat.st_mtime, stat.st_ino)
+        known = self._keys.get(path)
+        if known is not None and known[0] == stat:
+            return known[1]
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024*1024), b''):
+                sha.update(block)
+        key = "%s-v%d"%(sha.hexdigest(), PARSER_VERSION)
+        self._keys[path] = (stat, key)
+        return key
+
+    def _cache_file(self, key):
+        return os.path.join(self.cache_dir, key + '.layout')
+
+    def load(self, xmlfile):
+        '''Return the frozen HdfXmlDefinition of xmlfile, from the cache if possible'''
+        if not self.enabled:
+            definition = HdfXmlDefinition()
+            definition.populate(xmlfile)
+            return definition.freeze()
+        key = self.key(xmlfile)
+        definition = self._memory.pop(key, None)
+        if definition is None:
+            definition = self._load_file(key)
+        if definition is None:
+            definition = HdfXmlDefinition()
+            definition.populate(xmlfile)
+            definition.freeze()
+            self._store_file(key, definition)
+        self._memory[key] = definition
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+        return definition
+
+    def clear(self):
+        '''Drop all entries from memory and from the cache directory'''
+        self._memory.clear()
+        for fname in self._cache_files():
+            os.remove(fname)
+
+    def _cache_files(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [os.path.join(self.cache_dir, fname) for fname in os.listdir(self.cache_dir)
+                if fname.endswith('.layout')]
+
+    def _load_file(self, key):
+        fname = self._cache_file(key)
+        try:
+            if not os.path.exists(fname) or not hdf_cache.private_dir(self.cache_dir):
+                return None
+            with open(fname, 'rb') as f:
+                definition = HdfXmlDefinition().load_flat(marshal.load(f))
+            # Touch the file so the eviction can tell which entries are in use
+            os.utime(fname, None)
+        except Exception:
+            # A damaged or unreadable entry is a miss: it is parsed and saved again
+            return None
+        return definition.freeze()
+
+    def _store_file(self, key, definition):
+        try:
+            if not hdf_cache.private_dir(self.cache_dir):
+                return
+            # Write to a temporary file first so a concurrent reader never sees half an entry
+            fd, tmpname = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(definition.flatten(), f)
+            os.rename(tmpname, self._cache_file(key))
+        except (IOError, OSError, ValueError):
+            # A read-only or full disk just means we don't get a persistent cache
+            return
+        self._evict_files()
+
+    def _evict_files(self):
+        entries = []
+        for fname in self._cache_files():
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            entries.append( (stat.st_mtime, stat.st_size, fname) )
+        entries.sort()
+        total = sum([size for (mtime, size, fname) in entries])
+        for (mtime, size, fname) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= size
+
+# The process wide cache used by load_definition()
+layout_cache = LayoutCache()
+
+def load_definition(xmlfile):
+    '''Return a populated HdfXmlDefinition for xmlfile, using the layout cache.
+    The definition is frozen (read-only) and shared with the other callers.'''
+    with hdf_trace.span("load_definition", "parse", file=xmlfile):
+        return layout_cache.load(xmlfile)
 
-        
-    def _handle_attributes(self, attributes):
-        for attr in attributes:
-            attr_name = attr.getAttribute(NAME)
-            attr_parent = self._parent_name(attr)
-            attr_source = attr.getAttribute(SOURCE)
-            attribute = HdfAttribute(attr_name, attr_parent, attr_source)
-            # source: "constant" attributes have their type and value defined in the XML
-            if attribute.is_constant():
-                attribute.type = attr.getAttribute(TYPE)
-                attribute.value = attr.getAttribute(VALUE)
-                if attribute.type == INT:
-                    attribute.value = [int(val) for val in attribute.value.split(',')]
-                    if len(attribute.value) == 1: attribute.value = attribute.value[0]
-                elif attribute.type == FLOAT:
-                    attribute.value = [float(val) for val in attribute.value.split(',')]
-                    if len(attribute.value) == 1: attribute.value = attribute.value[0]
-            # source: "ndattribute" specify an (areaDetector) NDAttribute name where to get data from
-            # and a 'when' parameter which can be 'OnFileClose', 'OnFileOpen' or defaults to nothing (on every frame)
-            elif attribute.is_ndattribute():
-                attribute.ndattribute = attr.getAttribute(NDATTRIBUTE)
-                attribute.when = attr.getAttribute(WHEN)
-            self.attributes.append( attribute )
-            
-            
 def main():
     xml_def = HdfXmlDefinition()
     xml_def.populate('data/layout.xml')
@@ -0,0 +1,808 @@
+#!/bin/env dls-python
+'''An in-process stand-in for a simDetector IOC with a HDF5 file writer plugin.
+
+The module serves the PVs used by SimDet and HdfPlugin in adclientxmlhdf through
+a small subset of the cothread and cothread.catools interface (caget, caput,
+camonitor, connect, ca_nothing, Spawn, Event, Timedout and dbr) so the client code can run
+unchanged without a network or an IOC. Set ADCLIENT_SIMIOC=1 in the environment
+to make adclientxmlhdf use it.
+
+Devices are created on first use of their base PV: a base PV accessed with driver
+fields (Acquire, NumImages, ...) becomes a simulated detector driver and one with
+file writer fields (Capture, FileWriteMode, ...) becomes a simulated HDF5 file
+writer, which writes its files according to the XML layout in XMLFileName.
+The detector produces the simDetector LinearRamp pattern with a configurable frame
+size and maximum frame rate (ADCLIENT_SIMIOC_FRAME=<x>x<y>, ADCLIENT_SIMIOC_RATE=<Hz>).
+ADCLIENT_SIMIOC_LATENCY=<seconds> adds a network round trip to every caget and caput.
+'''
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, sys, time, argparse
+import threading
+import traceback
+import Queue
+import numpy
+import h5py
+
+import hdf_xml
+import hdf_frames
+
+class Timedout(Exception):
+    pass
+
+class ca_nothing(Exception):
+    '''What caget and caput raise, as cothread.catools does, for a PV which cannot be
+    reached: the IOC is down (SimIoc.running is False). With throw=False caget
+    returns it instead, which is false and has ok False.'''
+    ok = False
+
+    def __init__(self, name, errorcode="Virtual circuit disconnect"):
+        Exception.__init__(self, "%s: %s"%(name, errorcode))
+        self.name = name
+        self.errorcode = errorcode
+
+    def __nonzero__(self):
+        return False
+
+class ca_int(int):
+    '''An integer PV value. Like cothread.catools, which returns its values as
+    subclasses of the Python types, the simulated IOC never hands out a plain int:
+    values must be compared with ==, not by identity.'''
+    ok = True
+
+    def __new__(cls, value, name):
+        value = int.__new__(cls, value)
+        value.name = name
+        return value
+
+class dbr:
+    '''The subset of cothread.dbr used by the clients'''
+    DBR_CHAR_STR = 'DBR_CHAR_STR'
+
+def Sleep(delay):
+    time.sleep(delay)
+
+class Event:
+    '''A thread based equivalent of cothread.Event'''
+    def __init__(self, auto_reset=True):
+        self.auto_reset = auto_reset
+        self._cond = threading.Condition()
+        self._signalled = False
+
+    def Signal(self, value=None):
+        with self._cond:
+            self._signalled = True
+            self._cond.notify_all()
+
+    def Reset(self):
+        with self._cond:
+            self._signalled = False
+
+    def Wait(self, timeout=None):
+        with self._cond:
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._signalled:
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Timedout("Timed out waiting for event")
+                self._cond.wait(remaining)
+            if self.auto_reset:
+                self._signalled = False
+
+class Spawn:
+    '''A thread based equivalent of cothread.Spawn. As with cothread an exception of
+    the function is only re-raised by Wait() with raise_on_wait=True; otherwise it is
+    printed and Wait() returns None.'''
+    def __init__(self, function, *args, **kargs):
+        self.raise_on_wait = kargs.pop('raise_on_wait', False)
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        thread = threading.Thread(target=self._run, args=(function, args, kargs))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, function, args, kargs):
+        try:
+            self._result = function(*args, **kargs)
+        except:
+            if self.raise_on_wait:
+                self._exc_info = sys.exc_info()
+            else:
+                traceback.print_exc()
+        self._done.set()
+
+    def Wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise Timedout("Timed out waiting for task")
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+# Enumerated fields: the put value can be the string or the index, the value is the index
+ENUMS = {'ImageMode':       ['Single', 'Multiple', 'Continuous'],
+         'FileWriteMode':   ['Single', 'Capture', 'Stream'],
+         'EnableCallbacks': ['Disable', 'Enable'],
+         'ArrayCallbacks':  ['Disable', 'Enable'],
+         'AutoIncrement':   ['No', 'Yes'],
+         'AutoSave':        ['No', 'Yes'],
+         'DeleteDriverFile':['No', 'Yes'],
+         'LazyOpen':        ['No', 'Yes'],
+         'XMLValid':        ['No', 'Yes'],
+         'Acquire':         ['Done', 'Acquire'],
+         'Capture':         ['Done', 'Capture'],
+         'Compression':     ['None', 'N-bit', 'szip', 'zlib']}
+
+def _enum_index(field, value):
+    choices = ENUMS.get(field.replace('_RBV', ''))
+    if choices is None or not isinstance(value, basestring):
+        return value
+    if value in choices:
+        return choices.index(value)
+    return int(value)
+
+class SimArray:
+    '''A simulated NDArray: the frame data and its NDAttributes'''
+    def __init__(self, data, attributes):
+        self.data = data
+        self.attributes = attributes
+
+class SimDevice:
+    '''Base class of the simulated devices: a set of fields below a base PV.
+    Setting a field posts the new value to the monitors of the PV and of its _RBV.'''
+    FIELDS = {}
+
+    def __init__(self, ioc, basepv, portname):
+        self.ioc = ioc
+        self.basepv = basepv
+        self.values = dict(self.FIELDS)
+        self.values['PortName_RBV'] = portname
+        self.portname = portname
+
+    def get(self, field):
+        if field not in self.values:
+            self.values[field] = 0
+        return self.values[field]
+
+    def set(self, field, value):
+        '''Set a field (and its readback) and post the monitors'''
+        fields = [field]
+        if field + '_RBV' in self.values:
+            fields.append(field + '_RBV')
+        for name in fields:
+            with self.ioc.lock:
+                self.values[name] = value
+            self.ioc.post("%s:%s"%(self.basepv, name), value)
+
+    def put(self, field, value):
+        '''Handle a put from a client. Returns an Event to wait on for completion or None.'''
+        self.set(field, _enum_index(field, value))
+        return None
+
+DRIVER_FIELDS = {'Acquire': 0, 'Acquire_RBV': 0,
+                 'AcquireTime': 0.1, 'AcquireTime_RBV': 0.1,
+                 'AcquirePeriod': 0.1, 'AcquirePeriod_RBV': 0.1,
+                 'ImageMode': 0, 'ImageMode_RBV': 0,
+                 'NumImages': 1, 'NumImages_RBV': 1,
+                 'ArrayCounter': 0, 'ArrayCounter_RBV': 0,
+                 'ArrayCallbacks': 1, 'ArrayCallbacks_RBV': 1,
+                 'Gain': 1.0, 'Gain_RBV': 1.0,
+                 'GainX': 1.0, 'GainX_RBV': 1.0, 'GainY': 1.0, 'GainY_RBV': 1.0,
+                 'Reset': 0,
+                 'BinX': 1, 'BinY': 1, 'MinX': 0, 'MinY': 0,
+                 'SizeX': 0, 'SizeY': 0, 'ArraySize_RBV': 0,
+                 'PoolUsedMem': 0.0,
+                 'Manufacturer_RBV': 'Simulated detector', 'Model_RBV': 'Basic simulator'}
+
+# Driver settings which reset the LinearRamp image, as on the simDetector
+RESET_FIELDS = ['Reset', 'Gain', 'GainX', 'GainY', 'SizeX', 'SizeY', 'BinX', 'BinY', 'MinX', 'MinY']
+
+class SimDriver(SimDevice):
+    '''A simulated simDetector driver producing LinearRamp frames'''
+    FIELDS = DRIVER_FIELDS
+
+    def __init__(self, ioc, basepv, portname):
+        SimDevice.__init__(self, ioc, basepv, portname)
+        self.acquiring = False
+        self.stop = threading.Event()
+        self.done = Event(auto_reset=False)
+        self.done.Signal()
+        self.unique_id = 0
+        # Frames produced since the LinearRamp image was last reset
+        self.since_reset = 0
+
+    def put(self, field, value):
+        value = _enum_index(field, value)
+        if field in RESET_FIELDS:
+            self.since_reset = 0
+        if field != 'Acquire':
+            self.set(field, value)
+            return None
+        if value and not self.acquiring:
+            self.acquiring = True
+            self.stop.clear()
+            self.done.Reset()
+            self.set('Acquire', 1)
+            thread = threading.Thread(target=self._acquire)
+            thread.daemon = True
+            thread.start()
+        elif not value and self.acquiring:
+            self.stop.set()
+        return self.done
+
+    def _acquire(self):
+        try:
+            mode = self.get('ImageMode')
+            num = {0: 1, 1: self.get('NumImages')}.get(mode, None)
+            period = max(self.get('AcquirePeriod'), self.get('AcquireTime'))
+            if self.ioc.max_frame_rate:
+                period = max(period, 1.0/self.ioc.max_frame_rate)
+            pattern = hdf_frames.LinearRampPattern(self.get('Gain'), self.get('GainX'), self.get('GainY'), 0)
+            count = 0
+            next_frame = time.time()
+            while not self.stop.is_set() and (num is None or count < num):
+                next_frame += period
+                delay = next_frame - time.time()
+                if delay > 0 and self.stop.wait(delay):
+                    break
+                counter = self.get('ArrayCounter') + 1
+                self.unique_id += 1
+                data = pattern.expected(self.since_reset, 1, self.frame_shape(), self.ioc.dtype)[0]
+                self.since_reset += 1
+                self.set('ArraySize_RBV', data.nbytes)
+                self.set('ArrayCounter', counter)
+                count += 1
+                if self.get('ArrayCallbacks'):
+                    self.ioc.publish(self.portname, SimArray(data, self._attributes(counter)))
+                    # The arrays queued in the plugins are held in the driver's pool
+                    self.set('PoolUsedMem', self.ioc.queued_arrays(self.portname) * data.nbytes / (1024.*1024.))
+        finally:
+            self.acquiring = False
+            self.set('Acquire', 0)
+            self.done.Signal()
+
+    def frame_shape(self):
+        '''(y, x) size of the frames: SizeY and SizeX if set, otherwise the IOC default'''
+        ysize, xsize = self.ioc.frame_shape
+        return (self.get('SizeY') or ysize, self.get('SizeX') or xsize)
+
+    def _attributes(self, counter):
+        ysize, xsize = self.frame_shape()
+        return {'ArrayCounter': counter,
+                'NDArrayUniqueId': self.unique_id,
+                'NDArrayTimeStamp': time.time(),
+                'AcqTime': float(self.get('AcquireTime')),
+                'AcqPeriod': float(self.get('AcquirePeriod')),
+                'Gain': float(self.get('Gain')),
+                'BinX': self.get('BinX'), 'BinY': self.get('BinY'),
+                'MinX': self.get('MinX'), 'MinY': self.get('MinY'),
+                'SizeX': xsize, 'SizeY': ysize,
+                'MaxSizeX': xsize, 'MaxSizeY': ysize,
+                'ColorMode': 0,
+                'CameraManufacturer': self.get('Manufacturer_RBV'),
+                'CameraModel': self.get('Model_RBV')}
+
+class SimHdfFile:
+    '''A HDF5 file written by the simulated file writer according to a HdfXmlDefinition.
+    The datasets are created on the first frame, when the frame size and NDAttributes
+    are known. Detector frames go to the layout's detector_default dataset, NDAttributes
+    to their source="ndattribute" datasets and any others to the ndattr_default group.
+    Frames are written in blocks of flush_frames (the plugin's NumFramesFlush).
+    The detector dataset is chunked by chunking (frames, rows, columns; 0 meaning one
+    frame or the full frame size) and compressed with compression (an h5py filter name).
+    alignment (threshold, interval) sets the HDF5 boundary alignment.
+    With swmr the file is switched to SWMR (single writer, multiple reader) mode once
+    the datasets are created and every block of frames is flushed to disk, so readers
+    can follow the file while it is being written.'''
+    def __init__(self, filename, layout, flush_frames=1, chunking=(0, 0, 0), compression=None,
+                 compression_opts=None, alignment=(0, 0), swmr=False):
+        self.filename = filename
+        self.layout = layout
+        self.flush_frames = max(1, flush_frames)
+        self.chunking = chunking
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.swmr = swmr
+        threshold, interval = alignment
+        fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+        if interval > 1:
+            fapl.set_alignment(threshold, interval)
+        if swmr:
+            # SWMR needs the HDF5 1.10 file format
+            fapl.set_libver_bounds(h5py.h5f.LIBVER_LATEST, h5py.h5f.LIBVER_LATEST)
+        self.hdf = h5py.File(h5py.h5f.create(filename, h5py.h5f.ACC_TRUNC, fapl=fapl))
+        self.frames = 0
+        self.written = 0
+        self.pending = []
+        self.last = None
+        self.ndattr_datasets = dict()
+        for node in layout.subtree('/', hdf_xml.GROUP):
+            group = self.hdf.require_group(node.path)
+            self._set_constants(group, node.attributes)
+        self.default_group = layout.ndattr_default
+
+    def _set_constants(self, obj, attributes):
+        for attribute in attributes.itervalues():
+            if attribute.is_constant():
+                value = attribute.value
+                if isinstance(value, list):
+                    value = numpy.array(value)
+                elif isinstance(value, basestring):
+                    value = numpy.string_(value.encode('utf-8'))
+                obj.attrs[attribute.name] = value
+
+    def _set_ndattributes(self, obj, attributes, array, when):
+        for attribute in attributes.itervalues():
+            if attribute.is_ndattribute() and attribute.when in when \
+                    and attribute.ndattribute in array.attributes:
+                value = array.attributes[attribute.ndattribute]
+                if isinstance(value, basestring):
+                    value = numpy.string_(value)
+                obj.attrs[attribute.name] = value
+
+    def _create(self, array):
+        ysize, xsize = array.data.shape
+        frames, rows, cols = self.chunking
+        chunks = (max(1, frames), min(rows or ysize, ysize), min(cols or xsize, xsize))
+        for name, (source, ndattribute, attributes) in self.layout.datasets.iteritems():
+            if source == hdf_xml.DETECTOR:
+                if name == self.layout.detector_default:
+                    dset = self.hdf.create_dataset(name, (0, ysize, xsize), array.data.dtype,
+                                                   maxshape=(None, ysize, xsize), chunks=chunks,
+                                                   compression=self.compression,
+                                                   compression_opts=self.compression_opts)
+                else:
+                    dset = self.hdf.create_dataset(name, (1, ysize, xsize), array.data.dtype,
+                                                   chunks=(1, ysize, xsize))
+            elif source == hdf_xml.NDATTRIBUTE and ndattribute in array.attributes:
+                dset = self._create_ndattr(name, array.attributes[ndattribute])
+                self.ndattr_datasets[name] = ndattribute
+            else:
+                continue
+            self._set_constants(dset, attributes)
+        if self.default_group is not None:
+            placed = set(self.ndattr_datasets.itervalues())
+            for ndattribute, value in array.attributes.iteritems():
+                name = "/".join([self.default_group, ndattribute])
+                if ndattribute in placed or name in self.hdf:
+                    continue
+                self._create_ndattr(name, value)
+                self.ndattr_datasets[name] = ndattribute
+
+    def _create_ndattr(self, name, value):
+        if isinstance(value, basestring):
+            dtype = 'S256'
+        else:
+            dtype = numpy.asarray(value).dtype
+        return self.hdf.create_dataset(name, (0,), dtype, maxshape=(None,), chunks=(1024,))
+
+    def write(self, array):
+        if self.frames == 0:
+            self._create(array)
+            for name, (ndattr_default, attributes) in self.layout.groups.iteritems():
+                self._set_ndattributes(self.hdf[name], attributes, array, ['OnFileOpen', ''])
+            for name, (source, ndattribute, attributes) in self.layout.datasets.iteritems():
+                if name in self.hdf:
+                    self._set_ndattributes(self.hdf[name], attributes, array, ['OnFileOpen', ''])
+            if self.swmr:
+                # No new objects can be created from here on
+                self.hdf.swmr_mode = True
+        self.pending.append(array)
+        self.frames += 1
+        self.last = array
+        if len(self.pending) >= self.flush_frames:
+            self.flush()
+
+    def flush(self):
+        '''Write the pending frames and their NDAttributes in one go'''
+        if not self.pending:
+            return
+        start, count = self.written, len(self.pending)
+        detector = self.layout.detector_default
+        if detector is not None:
+            dset = self.hdf[detector]
+            dset.resize(start + count, axis=0)
+            dset[start:start+count] = numpy.array([array.data for array in self.pending])
+        for name, ndattribute in self.ndattr_datasets.iteritems():
+            dset = self.hdf[name]
+            dset.resize(start + count, axis=0)
+            dset[start:start+count] = [array.attributes[ndattribute] for array in self.pending]
+        self.written += count
+        self.pending = []
+        if self.swmr:
+            self.hdf.flush()
+
+    def close(self):
+        self.flush()
+        if self.last is not None:
+            for name, (ndattr_default, attributes) in self.layout.groups.iteritems():
+                self._set_ndattributes(self.hdf[name], attributes, self.last, ['OnFileClose'])
+            for name, (source, ndattribute, attributes) in self.layout.datasets.iteritems():
+                if name in self.hdf:
+                    self._set_ndattributes(self.hdf[name], attributes, self.last, ['OnFileClose'])
+        self.hdf.close()
+
+PLUGIN_FIELDS = {'EnableCallbacks': 1, 'EnableCallbacks_RBV': 1,
+                 'NDArrayPort': '', 'NDArrayPort_RBV': '',
+                 'ArrayCounter': 0, 'ArrayCounter_RBV': 0,
+                 'DroppedArrays': 0, 'DroppedArrays_RBV': 0,
+                 'QueueSize': 20, 'QueueFree': 20,
+                 'PoolUsedMem': 0.0,
+                 'NumCapture': 1, 'NumCapture_RBV': 1, 'NumCaptured_RBV': 0,
+                 'Capture': 0, 'Capture_RBV': 0,
+                 'LazyOpen': 0, 'LazyOpen_RBV': 0,
+                 'FilePath': '', 'FilePath_RBV': '',
+                 'FileName': '', 'FileName_RBV': '',
+                 'FileNumber': 0, 'FileNumber_RBV': 0,
+                 'FileTemplate': '%s%s_%d.h5', 'FileTemplate_RBV': '%s%s_%d.h5',
+                 'FullFileName_RBV': '',
+                 'FileWriteMode': 0, 'FileWriteMode_RBV': 0,
+                 'AutoIncrement': 0, 'AutoIncrement_RBV': 0,
+                 'AutoSave': 0, 'AutoSave_RBV': 0,
+                 'XMLFileName': '', 'XMLFileName_RBV': '',
+                 'NumFramesFlush': 1, 'NumFramesFlush_RBV': 1,
+                 'NumFramesChunks': 1, 'NumRowChunks': 0, 'NumColChunks': 0,
+                 'BoundaryAlign': 0, 'BoundaryThreshold': 65536,
+                 'Compression': 0, 'ZLevel': 6,
+                 'SWMRMode': 0, 'SWMRMode_RBV': 0, 'SWMRActive_RBV': 0,
+                 'XMLValid_RBV': 1, 'XMLErroMsg_RBV': ''}
+
+# The layout used when no XML file is configured
+DEFAULT_LAYOUT_DATASET = '/entry/data/data'
+
+class SimHdfPlugin(SimDevice):
+    '''A simulated NDFileHDF5 plugin supporting the Single, Capture and Stream write modes'''
+    FIELDS = PLUGIN_FIELDS
+
+    def __init__(self, ioc, basepv, portname):
+        SimDevice.__init__(self, ioc, basepv, portname)
+        self.queue = Queue.Queue(self.get('QueueSize'))
+        self.layout = self._default_layout()
+        self.file = None
+        self.buffer = []
+        self.done = Event(auto_reset=False)
+        self.done.Signal()
+        # Capture is started and stopped by the clients while the plugin thread writes
+        self.file_lock = threading.RLock()
+        thread = threading.Thread(target=self._process)
+        thread.daemon = True
+        thread.start()
+
+    def _default_layout(self):
+        layout = hdf_xml.HdfXmlDefinition()
+        layout.add_group('/entry')
+        layout.add_group('/entry/data')
+        layout.add_dataset(DEFAULT_LAYOUT_DATASET, hdf_xml.DETECTOR)
+        return layout
+
+    def put(self, field, value):
+        value = _enum_index(field, value)
+        if field == 'FilePath' and value and not value.endswith('/'):
+            value += '/'
+        self.set(field, value)
+        if field == 'XMLFileName':
+            self._load_layout(value)
+        elif field == 'Capture':
+            with self.file_lock:
+                if value:
+                    self._start_capture()
+                else:
+                    self._stop_capture()
+            return self.done
+        return None
+
+    def _load_layout(self, xmlfile):
+        if not xmlfile:
+            self.layout = self._default_layout()
+            self.set('XMLValid_RBV', 1)
+            self.set('XMLErroMsg_RBV', '')
+            return
+        try:
+            self.layout = hdf_xml.load_definition(xmlfile)
+        except Exception, e:
+            self.set('XMLValid_RBV', 0)
+            self.set('XMLErroMsg_RBV', str(e)[:255])
+            return
+        self.set('XMLValid_RBV', 1)
+        self.set('XMLErroMsg_RBV', '')
+
+    def _next_filename(self):
+        template = self.get('FileTemplate')
+        args = (self.get('FilePath'), self.get('FileName'), self.get('FileNumber'))
+        try:
+            filename = template % args
+        except TypeError:
+            filename = template % args[:2]
+        if self.get('AutoIncrement'):
+            self.set('FileNumber', self.get('FileNumber') + 1)
+        return filename
+
+    def _open(self):
+        filename = self._next_filename()
+        # Only zlib compression is simulated, the other filters write uncompressed data
+        compression, compression_opts = None, None
+        if self.get('Compression') == ENUMS['Compression'].index('zlib'):
+            compression, compression_opts = 'gzip', self.get('ZLevel')
+        self.file = SimHdfFile(filename, self.layout, self.get('NumFramesFlush'),
+                               chunking=(self.get('NumFramesChunks'), self.get('NumRowChunks'),
+                                         self.get('NumColChunks')),
+                               compression=compression, compression_opts=compression_opts,
+                               alignment=(self.get('BoundaryThreshold'), self.get('BoundaryAlign')),
+                               swmr=bool(self.get('SWMRMode')))
+        self.set('FullFileName_RBV', filename)
+        self.set('SWMRActive_RBV', self.get('SWMRMode'))
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.set('SWMRActive_RBV', 0)
+
+    def _start_capture(self):
+        with self.ioc.lock:
+            self.done.Reset()
+            self.buffer = []
+        self.set('NumCaptured_RBV', 0)
+        if self.get('FileWriteMode') == 2 and not self.get('LazyOpen'):
+            self._open()
+        self.set('Capture', 1)
+
+    def _stop_capture(self):
+        if self.get('FileWriteMode') == 1 and self.buffer:
+            self._open()
+            for array in self.buffer:
+                self.file.write(array)
+            self.buffer = []
+        self._close()
+        self.set('Capture', 0)
+        self.done.Signal()
+
+    def receive(self, array):
+        '''Queue an array from the driver, dropping it if the queue is full'''
+        if not self.get('EnableCallbacks'):
+            return
+        try:
+            self.queue.put_nowait(array)
+        except Queue.Full:
+            self.set('DroppedArrays', self.get('DroppedArrays') + 1)
+        self.set('QueueFree', self.get('QueueSize') - self.queue.qsize())
+
+    def _process(self):
+        while True:
+            array = self.queue.get()
+            self.set('QueueFree', self.get('QueueSize') - self.queue.qsize())
+            with self.file_lock:
+                self._write(array)
+            # Counted once the array has been written (or ignored)
+            self.set('ArrayCounter', self.get('ArrayCounter') + 1)
+
+    def _write(self, array):
+        mode = self.get('FileWriteMode')
+        if mode == 0:
+            if self.get('AutoSave') or self.get('Capture'):
+                self._open()
+                self.file.write(array)
+                self._close()
+            return
+        if not self.get('Capture'):
+            return
+        if mode == 1:
+            self.buffer.append(array)
+        else:
+            if self.file is None:
+                self._open()
+            self.file.write(array)
+        captured = self.get('NumCaptured_RBV') + 1
+        self.set('NumCaptured_RBV', captured)
+        numcapture = self.get('NumCapture')
+        if numcapture > 0 and captured >= numcapture:
+            self._stop_capture()
+
+class Subscription:
+    '''Handle of a camonitor subscription'''
+    def __init__(self, ioc, pv, callback):
+        self.ioc = ioc
+        self.pv = pv
+        self.callback = callback
+
+    def close(self):
+        self.ioc.unsubscribe(self)
+
+class SimIoc:
+    '''The simulated IOC: a set of devices and the monitors on their PVs'''
+    def __init__(self, frame_shape=(40, 60), max_frame_rate=None, dtype=numpy.uint8, latency=0.0):
+        self.frame_shape = frame_shape
+        self.max_frame_rate = max_frame_rate
+        # Seconds of the round trip of each caget and caput
+        self.latency = latency
+        self.dtype = dtype
+        self.devices = dict()
+        self.subscriptions = dict()
+        self.lock = threading.RLock()
+        # False while the IOC is down: all its PVs are disconnected
+        self.running = True
+
+    def _device(self, pv, fields=None):
+        '''Return (device, field) for a PV, creating the device if the fields tell its kind'''
+        if not self.running:
+            raise ca_nothing(pv)
+        if ':' not in pv:
+            raise Timedout("No such PV: %s"%pv)
+        basepv, field = pv.rsplit(':', 1)
+        with self.lock:
+            device = self.devices.get(basepv)
+            if device is None:
+                fields = set(fields or [field])
+                kinds = [kind for kind, known in [(SimDriver, DRIVER_FIELDS), (SimHdfPlugin, PLUGIN_FIELDS)]
+                         if fields & set(known) - set(['ArrayCounter', 'ArrayCounter_RBV'])]
+                if len(kinds) != 1:
+                    raise Timedout("No such PV: %s"%pv)
+                portname = "%s%d"%({SimDriver: 'SIM', SimHdfPlugin: 'FileHDF'}[kinds[0]], len(self.devices) + 1)
+                device = kinds[0](self, basepv, portname)
+                self.devices[basepv] = device
+        return device, field
+
+    def connect(self, pvs):
+        pvs = _as_list(pvs)
+        fields = dict()
+        for pv in pvs:
+            if ':' in pv:
+                basepv, field = pv.rsplit(':', 1)
+                fields.setdefault(basepv, []).append(field)
+        for pv in pvs:
+            basepv = pv.rsplit(':', 1)[0]
+            self._device(pv, fields.get(basepv))
+
+    def get(self, pv):
+        device, field = self._device(pv)
+        return device.get(field)
+
+    def put(self, pv, value):
+        device, field = self._device(pv)
+        return device.put(field, value)
+
+    def publish(self, portname, array):
+        '''Deliver an array from a driver to all enabled plugins connected to its port'''
+        for device in self.devices.values():
+            if isinstance(device, SimHdfPlugin) and device.get('NDArrayPort') == portname:
+                device.receive(array)
+
+    def queued_arrays(self, portname):
+        '''Number of arrays from a driver waiting in the queues of its plugins'''
+        return sum([device.queue.qsize() for device in self.devices.values()
+                    if isinstance(device, SimHdfPlugin) and device.get('NDArrayPort') == portname])
+
+    def subscribe(self, pv, callback):
+        self._device(pv)
+        subscription = Subscription(self, pv, callback)
+        with self.lock:
+            self.subscriptions.setdefault(pv, []).append(subscription)
+        callback(self.get(pv))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.pv, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+
+    def post(self, pv, value):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(pv, []))
+        for subscription in subscriptions:
+            subscription.callback(value)
+
+def _as_list(pvs):
+    if isinstance(pvs, basestring):
+        return [pvs]
+    return list(pvs)
+
+def _ioc_from_environment():
+    frame_shape = (40, 60)
+    if os.environ.get('ADCLIENT_SIMIOC_FRAME'):
+        xsize, ysize = os.environ['ADCLIENT_SIMIOC_FRAME'].lower().split('x')
+        frame_shape = (int(ysize), int(xsize))
+    max_frame_rate = None
+    if os.environ.get('ADCLIENT_SIMIOC_RATE'):
+        max_frame_rate = float(os.environ['ADCLIENT_SIMIOC_RATE'])
+    latency = float(os.environ.get('ADCLIENT_SIMIOC_LATENCY', 0.0) or 0.0)
+    return SimIoc(frame_shape, max_frame_rate, latency=latency)
+
+# The simulated IOC served by the catools functions below
+ioc = _ioc_from_environment()
+
+def _convert(value, datatype, pv=None):
+    if datatype == dbr.DBR_CHAR_STR:
+        return str(value)
+    if pv is not None and isinstance(value, (int, long)) and not isinstance(value, bool):
+        return ca_int(value, pv)
+    return value
+
+def _get(pv, datatype, throw):
+    try:
+        return _convert(ioc.get(pv), datatype, pv)
+    except ca_nothing, error:
+        if throw:
+            raise
+        return error
+
+def caget(pvs, datatype=None, timeout=5, throw=True, **kargs):
+    if ioc.latency:
+        time.sleep(ioc.latency)
+    if isinstance(pvs, basestring):
+        return _get(pvs, datatype, throw)
+    return [_get(pv, datatype, throw) for pv in pvs]
+
+def caput(pvs, values, repeat_value=False, datatype=None, wait=False, timeout=5, **kargs):
+    if isinstance(pvs, basestring):
+        pvs, values = [pvs], [values]
+    elif repeat_value:
+        values = [values] * len(pvs)
+    if ioc.latency:
+        time.sleep(ioc.latency)
+    completions = [ioc.put(pv, _convert(value, datatype)) for pv, value in zip(pvs, values)]
+    if wait:
+        for completion in completions:
+            if completion is not None:
+                completion.Wait(timeout)
+
+def camonitor(pvs, callback, datatype=None, **kargs):
+    if isinstance(pvs, basestring):
+        return ioc.subscribe(pvs, lambda value: callback(_convert(value, datatype, pvs)))
+    return [ioc.subscribe(pv, lambda value, index=index, pv=pv: callback(_convert(value, datatype, pv), index))
+            for index, pv in enumerate(pvs)]
+
+def connect(pvs, wait=True, timeout=5, **kargs):
+    ioc.connect(pvs)
+
+def main():
+    parser = argparse.ArgumentParser(description="Acquire simulated frames into a HDF5 file through the "
+                                     "in-process simulated IOC and report the throughput")
+    parser.add_argument('xmlfilename', metavar='XMLFILE', type=str,
+                        help='XML file describing the layout of the output HDF5 file')
+    parser.add_argument('hdf5filename', metavar='HDF5FILE', type=str,
+                        help='Output HDF5 file')
+    parser.add_argument('--num', '-n', metavar='N', dest='numimages', action='store', type=int, default=100,
+                        help='Number of images to record')
+    parser.add_argument('--frame', metavar='XxY', dest='frame', action='store', default='60x40',
+                        help='Frame size in pixels')
+    parser.add_argument('--flush', metavar='N', dest='flush', action='store', type=int, default=1,
+                        help='Number of frames the file writer buffers before writing them (NumFramesFlush)')
+    parser.add_argument('--rate', metavar='HZ', dest='rate', action='store', type=float, default=100.0,
+                        help='Maximum frame rate in Hz (0: as fast as possible)')
+    args = parser.parse_args()
+
+    # adclientxmlhdf imports this module as simioc, which is not __main__ when run as a script
+    os.environ['ADCLIENT_SIMIOC'] = '1'
+    import simioc
+    import adclientxmlhdf
+    xsize, ysize = args.frame.lower().split('x')
+    simioc.ioc.frame_shape = (int(ysize), int(xsize))
+    simioc.ioc.max_frame_rate = args.rate
+    simioc.caput('TESTSIMDETECTOR:HDF:NumFramesFlush', args.flush)
+    start = time.time()
+    try:
+        adclientxmlhdf.run_xml_hdf_writer(os.path.abspath(args.xmlfilename), os.path.abspath(args.hdf5filename),
+                                          exposure=0.0, nimages=args.numimages)
+    finally:
+        elapsed = time.time() - start
+        captured = simioc.caget('TESTSIMDETECTOR:HDF:NumCaptured_RBV')
+        dropped = simioc.caget('TESTSIMDETECTOR:HDF:DroppedArrays_RBV')
+        mbytes = captured * int(xsize) * int(ysize) * numpy.dtype(simioc.ioc.dtype).itemsize / (1024.*1024.)
+        print "%d frames captured, %d dropped in %.3fs: %.1f frames/s, %.1f MB/s"\
+            %(captured, dropped, elapsed, captured/elapsed, mbytes/elapsed)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,1126 @@
+#!/bin/env dls-python
+try:
+    from pkg_resources import require
+    require('h5py')
+    require('numpy')
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
+
+import os, sys, time
+import unittest
+import tempfile, shutil
+import multiprocessing
+import glob
+import socket
+import threading
+import traceback
+import json
+import warnings
+import StringIO
+import numpy
+import h5py
+
+# These tests of the helper modules never need an IOC: the Channel Access
+# client code always runs against the in-process simulated IOC.
+os.environ['ADCLIENT_SIMIOC'] = '1'
+
+import simioc
+import adclientxmlhdf
+import hdf_soak
+import hdf_schema
+import hdf_compare
+import hdf_frames
+import hdf_chunks
+import hdf_series
+import hdf_service
+import hdf_benchmark
+import hdf_scan
+import hdf_multi
+import hdf_tail
+import hdf_ndattr
+import hdf_index
+import hdf_xml
+import hdf_synth
+import hdf_scaling
+import hdf_trace
+import test_hdf_xml
+
+# The test data files, so the tests run from any directory
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+def data_file(name):
+    return os.path.join(DATA_DIR, name)
+
+def setUpModule():
+    # Keep the layouts the tests load out of the user's own cache directory
+    global CACHE_DIR
+    CACHE_DIR = tempfile.mkdtemp(prefix="test_hdf_tools_cache_")
+    hdf_xml.layout_cache.cache_dir = CACHE_DIR
+
+def tearDownModule():
+    shutil.rmtree(CACHE_DIR)
+
+class ToolTestCase(unittest.TestCase):
+    '''Base of the tests: each test gets its own temporary directory (self.directory)
+    and what the tools print to stdout is kept out of the test output.'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="test_hdf_tools_")
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+class TestPvBatch(ToolTestCase):
+    def test_failed_put_raises(self):
+        '''A batch with a write that fails must raise, not report success'''
+        batch = adclientxmlhdf.PvBatch("failing batch")
+        batch.put("TESTBATCH:CAM:Gain", 2.0)
+        batch.put("NOSUCHPV", 1)
+        self.assertRaises(simioc.Timedout, batch.execute)
+
+    def test_failed_stage_stops_batch(self):
+        '''The stages after a failed one are not sent'''
+        adclientxmlhdf.caput("TESTBATCH:CAM:Gain", 1.0, wait=True)
+        batch = adclientxmlhdf.PvBatch("failing stage")
+        batch.put("NOSUCHPV", 1)
+        batch.stage()
+        batch.put("TESTBATCH:CAM:Gain", 3.0)
+        self.assertRaises(simioc.Timedout, batch.execute)
+        self.assertEqual(adclientxmlhdf.caget("TESTBATCH:CAM:Gain"), 1.0)
+
+    def test_batch(self):
+        batch = adclientxmlhdf.PvBatch("batch")
+        batch.put("TESTBATCH:CAM:Gain", 4.0)
+        batch.put("TESTBATCH:CAM:BinX", 2)
+        batch.stage()
+        batch.put("TESTBATCH:CAM:BinY", 2)
+        batch.execute()
+        self.assertEqual(adclientxmlhdf.caget("TESTBATCH:CAM:Gain"), 4.0)
+        self.assertEqual(len(batch.latency), 2)
+
+@unittest.skipUnless(hdf_schema.HAVE_LXML, "lxml not available: layouts are not validated against the schema")
+class TestPvPool(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.calls = []
+        self.functions = (adclientxmlhdf.connect, adclientxmlhdf.caget)
+        def connect(pvs, **kargs):
+            self.calls.append(("connect", sorted(pvs)))
+            return self.functions[0](pvs, **kargs)
+        def caget(pvs, **kargs):
+            self.calls.append(("caget", pvs))
+            return self.functions[1](pvs, **kargs)
+        adclientxmlhdf.connect, adclientxmlhdf.caget = connect, caget
+
+    def tearDown(self):
+        adclientxmlhdf.connect, adclientxmlhdf.caget = self.functions
+        ToolTestCase.tearDown(self)
+
+    def test_connected_once(self):
+        '''The PVs of a base PV are connected and its port name read on first use only'''
+        pool = adclientxmlhdf.PvPool()
+        pvs = ["TESTPOOL:HDF:Capture", "TESTPOOL:HDF:NumCapture"]
+        entry = pool.get("TESTPOOL:HDF", pvs)
+        self.assertEqual(self.calls, [("connect", pvs + ["TESTPOOL:HDF:PortName_RBV"]),
+                                      ("caget", "TESTPOOL:HDF:PortName_RBV")])
+        self.assertTrue(pool.get("TESTPOOL:HDF", pvs) is entry)
+        self.assertEqual(len(self.calls), 2)
+        # Only the PVs not seen before are connected
+        pool.get("TESTPOOL:HDF", pvs + ["TESTPOOL:HDF:EnableCallbacks"])
+        self.assertEqual(self.calls[2:], [("connect", ["TESTPOOL:HDF:EnableCallbacks"])])
+        self.assertEqual((pool.hits, pool.misses), (2, 1))
+
+    def test_idle_evicted(self):
+        pool = adclientxmlhdf.PvPool(idle_timeout=60.0)
+        entry = pool.get("TESTPOOL:HDF", ["TESTPOOL:HDF:Capture"])
+        entry.last_used -= 120.0
+        self.assertFalse(pool.get("TESTPOOL:HDF", ["TESTPOOL:HDF:Capture"]) is entry)
+        self.assertEqual((pool.misses, pool.evictions), (2, 1))
+
+    def test_shared_by_objects(self):
+        '''Objects on the same base PV share the pooled entry'''
+        first = adclientxmlhdf.HdfPlugin("TESTPOOLSHARED:HDF")
+        calls = len(self.calls)
+        second = adclientxmlhdf.HdfPlugin("TESTPOOLSHARED:HDF")
+        self.assertEqual(len(self.calls), calls)
+        self.assertEqual(second.portname, first.portname)
+
+class TestBadLayout(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.xml_file = os.path.join(self.directory, "bad.xml")
+        with open(self.xml_file, 'w') as f:
+            f.write('<?xml version="1.0" standalone="no" ?>\n<hdf5_layout><no_such_element/></hdf5_layout>\n')
+
+    def test_rejected_before_any_pv(self):
+        '''A layout which does not match the schema is rejected before any PV is written'''
+        self.assertRaises(hdf_schema.InvalidLayout, adclientxmlhdf.run_xml_hdf_writer, self.xml_file,
+                          os.path.join(self.directory, "bad.h5"), exposure=0.01, nimages=1,
+                          simpv="TESTBADLAYOUT:CAM", hdfpv="TESTBADLAYOUT:HDF")
+        # The simulated IOC creates its devices on first access
+        self.assertFalse([basepv for basepv in simioc.ioc.devices if basepv.startswith("TESTBADLAYOUT")])
+
+class TestLayoutParser(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.xml_file = os.path.join(self.directory, "parser.xml")
+        with open(self.xml_file, 'w') as f:
+            f.write('<?xml version="1.0" standalone="no" ?>\n<hdf5_layout>\n'
+                    '<group name="entry">'
+                    '<attribute name="NX_class" source="constant" value="NXentry" type="string"/>'
+                    '<group name="instrument" ndattr_default="true"><group name="detector">'
+                    '<dataset name="first" source="detector"/>'
+                    '<dataset name="data" source="detector" det_default="true">'
+                    '<attribute name="scale" source="constant" value="1.5,2.5" type="float"/>'
+                    '<attribute name="count" source="constant" value="3" type="int"/>'
+                    '</dataset></group>'
+                    '<dataset name="counter" source="ndattribute" ndattribute="COUNTER"/>'
+                    '</group>'
+                    '<attribute name="start" source="ndattribute" ndattribute="START" when="OnFileOpen"/>'
+                    '</group>\n</hdf5_layout>\n')
+        self.xml_def = hdf_xml.HdfXmlDefinition()
+        self.xml_def.populate(self.xml_file)
+
+    def test_tree(self):
+        '''Nested elements become a tree of nodes, the unnamed root element is left out'''
+        self.assertEqual([node.path for node in self.xml_def.subtree()],
+                         ["/entry", "/entry/instrument", "/entry/instrument/detector",
+                          "/entry/instrument/detector/first", "/entry/instrument/detector/data",
+                          "/entry/instrument/counter"])
+        self.assertEqual(sorted(self.xml_def.groups),
+                         ["/entry", "/entry/instrument", "/entry/instrument/detector"])
+        detector = self.xml_def.nodes["/entry/instrument/detector"]
+        self.assertEqual(detector.parent, self.xml_def.nodes["/entry/instrument"])
+        self.assertEqual([node.name for node in detector.children], ["first", "data"])
+        self.assertEqual(self.xml_def.nodes["/entry/instrument/counter"].ndattribute, "COUNTER")
+
+    def test_defaults(self):
+        '''det_default beats the first detector dataset; the ndattr_default group takes
+        the NDAttributes without a dataset of their own'''
+        self.assertEqual(self.xml_def.detector_default, "/entry/instrument/detector/data")
+        self.assertEqual(self.xml_def.ndattr_default, "/entry/instrument")
+        self.assertEqual(self.xml_def.ndattribute_destination("COUNTER"), "/entry/instrument/counter")
+        self.assertEqual(self.xml_def.ndattribute_destination("OTHER"), "/entry/instrument/OTHER")
+
+    def test_attributes(self):
+        '''Attributes in document order, with typed constant values'''
+        attributes = self.xml_def.attributes
+        self.assertEqual([(attribute.name, attribute.parent) for attribute in attributes],
+                         [("NX_class", "/entry"), ("scale", "/entry/instrument/detector/data"),
+                          ("count", "/entry/instrument/detector/data"), ("start", "/entry")])
+        self.assertEqual([attribute.value for attribute in attributes[:3]], ["NXentry", [1.5, 2.5], 3])
+        self.assertEqual((attributes[3].ndattribute, attributes[3].when), ("START", "OnFileOpen"))
+        self.assertEqual(sorted(self.xml_def.nodes["/entry"].attributes), ["NX_class", "start"])
+
+class TestLayoutTree(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.xml_file = os.path.join(self.directory, "duplicate.xml")
+        with open(self.xml_file, 'w') as f:
+            f.write('<?xml version="1.0" standalone="no" ?>\n<hdf5_layout>\n'
+                    '<group name="entry"><group name="old">'
+                    '<dataset name="data" source="detector"><attribute name="a" source="constant" value="1" type="int"/></dataset>'
+                    '</group></group>\n'
+                    '<group name="entry"><dataset name="new" source="detector"/></group>\n'
+                    '</hdf5_layout>\n')
+
+    def test_duplicate_replaces_entry(self):
+        '''A redefined group replaces the earlier entry only, like the dictionaries did:
+        what was defined below the earlier group is kept, below the new one'''
+        xml_def = hdf_xml.HdfXmlDefinition()
+        xml_def.populate(self.xml_file)
+        self.assertEqual(sorted(xml_def.nodes), ["/entry", "/entry/new", "/entry/old", "/entry/old/data"])
+        self.assertEqual(sorted(xml_def.datasets), ["/entry/new", "/entry/old/data"])
+        self.assertEqual([node.path for node in xml_def.subtree("/entry")],
+                         ["/entry", "/entry/old", "/entry/old/data", "/entry/new"])
+        self.assertEqual(xml_def.nodes["/entry/old"].parent, xml_def.nodes["/entry"])
+        self.assertEqual([attribute.parent for attribute in xml_def.attributes], ["/entry/old/data"])
+        self.assertEqual(xml_def.detector_default, "/entry/old/data")
+
+class TestLayoutCache(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.cache_dir = os.path.join(self.directory, "cache")
+        self.xml_file = data_file("layout.xml")
+
+    def cached(self):
+        return [fname for fname in os.listdir(self.cache_dir) if fname.endswith(".layout")]
+
+    def test_shared_read_only(self):
+        '''The definition is handed out once for all callers, so it cannot be changed'''
+        cache = hdf_xml.LayoutCache(self.cache_dir)
+        definition = cache.load(self.xml_file)
+        self.assertTrue(cache.load(self.xml_file) is definition)
+        self.assertRaises(TypeError, definition.add_group, "/modified")
+        def replace():
+            definition.nodes["/entry"] = None
+        self.assertRaises(TypeError, replace)
+        self.assertRaises(AttributeError, lambda: definition.attributes.append(None))
+        self.assertRaises(AttributeError, lambda: definition.nodes["/entry"].children.append(None))
+        self.assertNotIn("/modified", definition.nodes)
+
+    def test_same_definition_from_disk(self):
+        parsed = hdf_xml.HdfXmlDefinition()
+        parsed.populate(self.xml_file)
+        hdf_xml.LayoutCache(self.cache_dir).load(self.xml_file)
+        self.assertEqual(len(self.cached()), 1)
+        loaded = hdf_xml.LayoutCache(self.cache_dir).load(self.xml_file)
+        self.assertEqual(loaded.flatten(), parsed.flatten())
+        self.assertEqual(sorted(loaded.datasets), sorted(parsed.datasets))
+        self.assertEqual(loaded.detector_default, parsed.detector_default)
+
+    def test_damaged_entry_is_a_miss(self):
+        hdf_xml.LayoutCache(self.cache_dir).load(self.xml_file)
+        for content in ["", "not marshal data", "\x00" * 64]:
+            with open(os.path.join(self.cache_dir, self.cached()[0]), 'wb') as f:
+                f.write(content)
+            definition = hdf_xml.LayoutCache(self.cache_dir).load(self.xml_file)
+            self.assertTrue(definition.detector_default)
+
+    def test_shared_cache_dir_not_used(self):
+        os.mkdir(self.cache_dir)
+        os.chmod(self.cache_dir, 0777)
+        hdf_xml.LayoutCache(self.cache_dir).load(self.xml_file)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_large_layout_timing(self):
+        '''A cached 50k element layout loads in milliseconds from memory, and from
+        the cache directory in a fraction of the time a parse takes'''
+        xml_file, hdf_file = hdf_synth.generate(hdf_synth.spec_for_elements(50000), self.directory, hdf=False)
+        def best(function, repeats=3):
+            times = []
+            for n in range(repeats):
+                start = time.time()
+                function()
+                times.append(time.time() - start)
+            return min(times)
+        cache = hdf_xml.LayoutCache(self.cache_dir)
+        start = time.time()
+        cache.load(xml_file)
+        parse = time.time() - start
+        self.assertTrue(best(lambda: cache.load(xml_file)) < 0.005)
+        self.assertTrue(best(lambda: hdf_xml.LayoutCache(self.cache_dir).load(xml_file)) < parse / 2)
+
+class TestSyntheticLayout(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.spec = hdf_synth.spec_for_elements(2000)
+        self.xml_file, self.hdf_file = hdf_synth.generate(self.spec, self.directory)
+
+    def test_size(self):
+        '''The layout has about the asked number of elements, exactly as many as the spec says'''
+        self.assertTrue(abs(self.spec.elements - 2000) < 2000 * 0.05)
+        xml_def = hdf_xml.HdfXmlDefinition()
+        xml_def.populate(self.xml_file)
+        self.assertEqual(len(xml_def.nodes) + len(xml_def.attributes), self.spec.elements)
+        self.assertEqual(len(xml_def.groups), self.spec.num_groups)
+
+    def test_reproducible(self):
+        '''The same spec and seed give the same layout; another seed another one'''
+        layouts = []
+        for seed in [0, 0, 1]:
+            directory = os.path.join(self.directory, "seed%d_%d"%(seed, len(layouts)))
+            os.mkdir(directory)
+            with open(hdf_synth.generate(self.spec, directory, seed, hdf=False)[0]) as f:
+                layouts.append(f.read())
+        self.assertEqual(layouts[0], layouts[1])
+        self.assertNotEqual(layouts[0], layouts[2])
+
+    def test_valid(self):
+        '''The layout validates against the schema and its HDF5 file passes the checks'''
+        if hdf_schema.HAVE_LXML:
+            self.assertTrue(hdf_schema.check_layout(self.xml_file, required=True).valid)
+        xml_def = hdf_xml.HdfXmlDefinition()
+        xml_def.populate(self.xml_file)
+        index = hdf_index.index_file(self.hdf_file)
+        self.assertEqual(hdf_compare.AttributeComparison(xml_def).compare(index), [])
+        self.assertEqual(hdf_ndattr.check_when_scalars(xml_def, index), [])
+        self.assertEqual(sorted([path for path in index.groups if path != "/"]), sorted(xml_def.groups))
+
+class TestScaling(ToolTestCase):
+    def results(self, exponent, scale=1.0):
+        return [hdf_scaling.ScalingResult(elements, 'parse', scale * 1e-5 * elements**exponent, 10.0, 3)
+                for elements in [1000, 10000, 100000]]
+
+    def test_exponents(self):
+        '''The sizes below min_elements, dominated by fixed costs, are left out of the fit'''
+        small = hdf_scaling.ScalingResult(100, 'parse', 1.0, 1.0, 1)
+        self.assertAlmostEqual(hdf_scaling.scaling_exponents(self.results(1.0) + [small])['parse'], 1.0)
+
+    def test_baseline(self):
+        '''Slower runs and a worse scaling are regressions, the same run is not'''
+        baseline_file = os.path.join(self.directory, "baseline.json")
+        hdf_scaling.write_json(self.results(1.0), baseline_file)
+        baseline = hdf_scaling.load_baseline(baseline_file)
+        self.assertEqual(hdf_scaling.compare_baseline(self.results(1.0), baseline), [])
+        slower = hdf_scaling.compare_baseline(self.results(1.0, scale=3.0), baseline)
+        self.assertEqual([key for (key, description) in slower], ["1000 parse", "10000 parse", "100000 parse"])
+        quadratic = hdf_scaling.compare_baseline(self.results(1.5, scale=1e-2), baseline)
+        self.assertEqual(quadratic[-1][0], 'parse')
+        self.assertTrue("scales as elements^1.50" in quadratic[-1][1])
+
+class TestNoLxml(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.have_lxml = hdf_schema.HAVE_LXML
+        hdf_schema.HAVE_LXML = False
+    def tearDown(self):
+        hdf_schema.HAVE_LXML = self.have_lxml
+        ToolTestCase.tearDown(self)
+
+    def test_required(self):
+        self.assertRaises(ImportError, hdf_schema.check_layout, data_file("layout.xml"), required=True)
+
+    def test_warning(self):
+        '''A layout which cannot be validated is not passed silently'''
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self.assertEqual(hdf_schema.check_layout(data_file("layout.xml")), None)
+        self.assertEqual([warning.category for warning in caught], [RuntimeWarning])
+
+class TestDroppedFrames(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.settings = (simioc.ioc.max_frame_rate, simioc.ioc.frame_shape)
+        # Frames produced faster than the plugin writes them
+        simioc.ioc.max_frame_rate = 0
+        simioc.ioc.frame_shape = (256, 256)
+    def tearDown(self):
+        simioc.ioc.max_frame_rate, simioc.ioc.frame_shape = self.settings
+        ToolTestCase.tearDown(self)
+
+    def test_drops_reported(self):
+        '''Dropped frames are reported instead of waited for, and capturing is stopped'''
+        captured, dropped, fullname = adclientxmlhdf.run_xml_hdf_writer(
+            data_file("layout.xml"), os.path.join(self.directory, "dropped.h5"),
+            exposure=0.0, nimages=64, simpv="TESTDROPPED:CAM", hdfpv="TESTDROPPED:HDF")
+        self.assertTrue(dropped > 0)
+        self.assertEqual(captured + dropped, 64)
+        self.assertEqual(adclientxmlhdf.caget("TESTDROPPED:HDF:Capture_RBV"), 0)
+        with h5py.File(fullname, 'r') as hdf:
+            self.assertEqual(hdf["/entry/detector/data1"].shape[0], captured)
+
+class TestWriterBenchmark(ToolTestCase):
+    def test_settings_restored(self):
+        '''The settings of the last point are not left on the IOC after a run'''
+        adclientxmlhdf.caput("TESTBENCHMARK:HDF:NumRowChunks", 20, wait=True)
+        adclientxmlhdf.caput("TESTBENCHMARK:HDF:Compression", "zlib", wait=True)
+        values = {'NumRowChunks': [8], 'NumColChunks': [0], 'NumFramesChunks': [2], 'BoundaryAlign': [0],
+                  'BoundaryThreshold': [65536], 'NumFramesFlush': [1], 'Compression': ['None']}
+        benchmark = hdf_benchmark.WriterBenchmark("TESTBENCHMARK:CAM", "TESTBENCHMARK:HDF", self.directory,
+                                                  num=4)
+        results = benchmark.run(hdf_benchmark.matrix([(32, 16)], values))
+        self.assertEqual(results[0].captured, 4)
+        self.assertEqual(adclientxmlhdf.caget("TESTBENCHMARK:HDF:NumRowChunks"), 20)
+        self.assertEqual(adclientxmlhdf.caget("TESTBENCHMARK:HDF:Compression"), 3)
+        self.assertEqual(adclientxmlhdf.caget("TESTBENCHMARK:CAM:SizeX"), 0)
+
+class TestScanSequence(ToolTestCase):
+    def scan(self, pipelined):
+        '''Run 3 files of different lengths and check every file holds its own frames, in order'''
+        name = {False: "sequential", True: "pipelined"}[pipelined]
+        files = hdf_scan.scan_files(self.directory, name, 3, 0, 0.001, data_file("layout.xml"))
+        for scan_file, nimages in zip(files, [3, 5, 4]):
+            scan_file.nimages = nimages
+        sequence = adclientxmlhdf.ScanSequence(adclientxmlhdf.SimDet("TESTSCAN:CAM"),
+                                               adclientxmlhdf.HdfPlugin("TESTSCAN:HDF"), pipelined)
+        sequence.run(files)
+        self.assertEqual(sorted(glob.glob(os.path.join(self.directory, name + "_*.h5"))),
+                         [scan_file.hdf_file for scan_file in files])
+        self.assertEqual(len(sequence.gaps()), 2)
+        last_id = 0
+        for scan_file in files:
+            self.assertEqual((scan_file.fullname, scan_file.captured, scan_file.dropped),
+                             (scan_file.hdf_file, scan_file.nimages, 0))
+            with h5py.File(scan_file.hdf_file, 'r') as hdf:
+                self.assertEqual(hdf["/entry/detector/data1"].shape[0], scan_file.nimages)
+                self.assertEqual(list(hdf["/entry/attributes/ArrayCounter"]), range(1, scan_file.nimages + 1))
+                ids = list(hdf["/entry/instruments/NDArrayUniqueId"])
+            self.assertEqual(ids, range(ids[0], ids[0] + scan_file.nimages))
+            self.assertTrue(ids[0] > last_id)
+            last_id = ids[-1]
+
+    def test_sequential(self):
+        self.scan(False)
+
+    def test_pipelined(self):
+        self.scan(True)
+
+class TestTail(ToolTestCase):
+    def test_wrong_structure_stops(self):
+        '''A file written with another layout than the validator\'s stops the acquisition at once'''
+        hdf_file = os.path.join(self.directory, "tail.h5")
+        sim = adclientxmlhdf.SimDet("TESTTAIL:CAM")
+        hdf = adclientxmlhdf.HdfPlugin("TESTTAIL:HDF")
+        nimages = 1000
+        with adclientxmlhdf.AreaDetector([sim], [hdf]):
+            hdf.set_data_source(sim)
+            hdf.configure_file(hdf_file, data_file("layout.xml"), swmr=True)
+            hdf.capture(nimages)
+            hdf.wait_capture_started()
+            try:
+                adclientxmlhdf.tail_capture(sim, hdf, data_file("dls.xml"), hdf_file, 0.01, nimages)
+                self.fail("No StructureError for a file with the wrong layout")
+            except hdf_tail.StructureError, e:
+                self.assertTrue(e.result.structure)
+                self.assertFalse(e.result.valid)
+            self.assertEqual(adclientxmlhdf.caget("TESTTAIL:CAM:Acquire_RBV"), 0)
+            self.assertEqual(adclientxmlhdf.caget("TESTTAIL:HDF:Capture_RBV"), 0)
+            self.assertTrue(adclientxmlhdf.caget("TESTTAIL:CAM:ArrayCounter_RBV") < nimages)
+
+    def test_monitors_compare_values(self):
+        '''The capture and acquisition monitors follow the PV values, which catools
+        (and simioc) deliver as int subclasses rather than plain ints'''
+        sim = adclientxmlhdf.SimDet("TESTMONITOR:CAM")
+        hdf = adclientxmlhdf.HdfPlugin("TESTMONITOR:HDF")
+        self.assertTrue(isinstance(adclientxmlhdf.caget("TESTMONITOR:HDF:Capture_RBV"), simioc.ca_int))
+        rate = simioc.ioc.max_frame_rate
+        simioc.ioc.max_frame_rate = 20.0
+        try:
+            with adclientxmlhdf.AreaDetector([sim], [hdf]):
+                hdf.set_data_source(sim)
+                hdf.configure_file(os.path.join(self.directory, "monitor.h5"), data_file("layout.xml"))
+                hdf.capture(4)
+                # Not wait_capture_started(), which sets capturing itself
+                with adclientxmlhdf.PvWaiter().watch("TESTMONITOR:HDF:Capture_RBV") as waiter:
+                    waiter.wait(lambda values: values.get("TESTMONITOR:HDF:Capture_RBV") == 1, 10.0)
+                self.assertTrue(hdf.capturing)
+                with adclientxmlhdf.PvWaiter().watch("TESTMONITOR:CAM:Acquire_RBV") as waiter:
+                    sim.acquire(0.0, 4, wait=False)
+                    waiter.wait(lambda values: values.get("TESTMONITOR:CAM:Acquire_RBV") == 1, 10.0)
+                self.assertTrue(sim.acquiring)
+                hdf.wait_capture_done(4)
+                self.assertFalse(hdf.capturing)
+        finally:
+            simioc.ioc.max_frame_rate = rate
+
+class TestMultiDetector(ToolTestCase):
+    def test_capture(self):
+        '''All pairs write their files; their acquisitions are started with one caput'''
+        pairs = [("TESTMULTI%d:CAM"%(n), "TESTMULTI%d:HDF"%(n)) for n in range(3)]
+        multi = hdf_multi.MultiDetector(pairs, self.directory, data_file("layout.xml"))
+        caput = hdf_multi.caput
+        starts = []
+        def counted(pvs, values, **kargs):
+            if not isinstance(pvs, basestring) and pvs[0].endswith(":Acquire"):
+                starts.append(pvs)
+            return caput(pvs, values, **kargs)
+        hdf_multi.caput = counted
+        try:
+            report = multi.run(0.0, 5)
+        finally:
+            hdf_multi.caput = caput
+        self.assertEqual(starts, [[simpv + ":Acquire" for (simpv, hdfpv) in pairs]])
+        self.assertEqual([(result.simpv, result.hdfpv) for result in report.results], pairs)
+        self.assertEqual((report.captured, report.dropped), (15, 0))
+        for hdfpv in [hdfpv for (simpv, hdfpv) in pairs]:
+            hdf_file = os.path.join(self.directory, hdfpv.replace(':', '_') + ".h5")
+            with h5py.File(hdf_file, 'r') as hdf:
+                self.assertEqual(hdf[hdf_xml.load_definition(data_file("layout.xml")).detector_default].shape[0], 5)
+
+    def test_run_all_waits_for_all(self):
+        '''The first error is raised, but only after all the tasks have finished'''
+        finished = []
+        def task(n):
+            if n == 0:
+                raise ValueError("task %d failed"%(n))
+            time.sleep(0.05)
+            finished.append(n)
+            return n
+        self.assertEqual(hdf_multi.run_all(task, [(1,), (2,)]), [1, 2])
+        del finished[:]
+        self.assertRaises(ValueError, hdf_multi.run_all, task, [(0,), (1,), (2,)])
+        self.assertEqual(sorted(finished), [1, 2])
+
+class TestHealthSampler(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.settings = (simioc.ioc.max_frame_rate, simioc.ioc.frame_shape)
+        # Frames produced faster than the plugin writes them
+        simioc.ioc.max_frame_rate = 0
+        simioc.ioc.frame_shape = (256, 256)
+    def tearDown(self):
+        simioc.ioc.max_frame_rate, simioc.ioc.frame_shape = self.settings
+        ToolTestCase.tearDown(self)
+
+    def test_falling_behind(self):
+        '''Dropped arrays and a full queue are recorded as events, consecutive drops as one'''
+        sim = adclientxmlhdf.SimDet("TESTHEALTH:CAM")
+        hdf = adclientxmlhdf.HdfPlugin("TESTHEALTH:HDF")
+        ad = adclientxmlhdf.AreaDetector([sim], [hdf])
+        with ad:
+            hdf.set_data_source(sim)
+            hdf.configure_file(os.path.join(self.directory, "health.h5"), data_file("layout.xml"))
+            hdf.capture(64)
+            hdf.wait_capture_started()
+            with adclientxmlhdf.HealthSampler(ad) as sampler:
+                sim.acquire(0.0, 64)
+                captured, dropped, fullname = hdf.finish_capture(64)
+        self.assertTrue(dropped > 0)
+        events = [description for (t, basepv, description) in sampler.events]
+        drops = [int(description.split()[1]) for description in events if description.startswith("dropped")]
+        self.assertEqual(sum(drops), dropped)
+        self.assertTrue(len(drops) < dropped)
+        self.assertTrue([description for description in events if description.startswith("queue")])
+        self.assertEqual(sampler.series["TESTHEALTH:HDF:DroppedArrays_RBV"].last(), dropped)
+        self.assertTrue("TESTHEALTH:HDF falling behind: dropped" in sampler.summary())
+
+class TestTrace(ToolTestCase):
+    def test_disabled(self):
+        '''Nothing is recorded and the traced functions call straight through'''
+        tracer = hdf_trace.Tracer()
+        with tracer.span("block", "phase"):
+            pass
+        self.assertEqual(tracer.traced("add", "ca", lambda a, b: a + b)(1, 2), 3)
+        self.assertEqual(tracer.events, [])
+
+    def test_spans(self):
+        '''A span is recorded whether or not its block raised, a traced call with its
+        described arguments'''
+        tracer = hdf_trace.Tracer()
+        tracer.enable()
+        try:
+            with tracer.span("block", "phase", file="a.h5"):
+                raise ValueError("in the block")
+        except ValueError:
+            pass
+        add = tracer.traced("add", "ca", lambda a, b: a + b, lambda args, kargs: {'a': args[0]})
+        self.assertEqual(add(1, 2), 3)
+        self.assertEqual([(name, category, args) for (name, category, start, duration, pid, tid, args)
+                          in tracer.events], [("block", "phase", {'file': "a.h5"}), ("add", "ca", {'a': 1})])
+        events = tracer.take()
+        self.assertEqual(tracer.events, [])
+        tracer.extend(events)
+        self.assertEqual(len(tracer.events), 2)
+
+    def test_chrome_trace(self):
+        '''The saved trace is Chrome trace-event JSON, which the summary reads back'''
+        tracer = hdf_trace.Tracer()
+        tracer.record("slow", "ca", 100.0, 0.5, {'pvs': "A"})
+        tracer.record("fast", "", 100.25, 0.001)
+        tracer.record("slow", "ca", 101.0, 0.25)
+        trace_file = os.path.join(self.directory, "trace.json")
+        tracer.save(trace_file)
+        with open(trace_file) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual([(event['name'], event['cat'], event['ph'], event['ts'], event['dur']) for event in events],
+                         [("slow", "ca", "X", 0.0, 5e5), ("fast", "default", "X", 2.5e5, 1e3),
+                          ("slow", "ca", "X", 1e6, 2.5e5)])
+        lines = tracer.summary(top=1).splitlines()
+        self.assertEqual(lines[0], "3 spans; top 1 operations by total time:")
+        self.assertEqual(lines[2].split()[:3], ["ca", "slow", "2"])
+        self.assertEqual(lines[4].split()[:3], ["500.0ms", "ca", "slow"])
+
+    def test_instrumented(self):
+        '''Parsing a layout and a CA call are traced by the shared tracer'''
+        # Leave what HDF_TRACE may have traced so far as it was
+        enabled, events = hdf_trace.tracer.enabled, hdf_trace.tracer.take()
+        hdf_trace.enable()
+        try:
+            xml_def = hdf_xml.HdfXmlDefinition()
+            xml_def.populate(data_file("layout.xml"))
+            adclientxmlhdf.caput("TESTTRACE:HDF:NumCapture", 1)
+        finally:
+            hdf_trace.tracer.enabled = enabled
+            traced = hdf_trace.tracer.take()
+            hdf_trace.tracer.extend(events)
+        self.assertEqual([(event[0], event[1]) for event in traced],
+                         [("HdfXmlDefinition.populate", "parse"), ("caput", "ca")])
+
+class TestSoakReport(ToolTestCase):
+    def soak(self, leak, restart_every, cycles=300, noise=0.05, step_at=None):
+        '''A synthetic soak run: memory growing by leak per cycle from a baseline of 100,
+        back to the baseline after every restart, and an optional step of 50'''
+        random = numpy.random.RandomState(1)
+        report = hdf_soak.SoakReport({'PoolUsedMem': 1.0})
+        since_restart = 0
+        for cycle in range(cycles):
+            value = 100.0 + leak * since_restart + random.normal(0.0, noise)
+            if step_at is not None and cycle >= step_at:
+                value += 50.0
+            report.add({'cycle': cycle, 'time': cycle * 2.0, 'mode': 'stream', 'elapsed': 2.0, 'ok': True,
+                        'PoolUsedMem': value})
+            since_restart += 1
+            if restart_every and (cycle + 1) % restart_every == 0:
+                report.restarts.append( (cycle, cycle * 2.0) )
+                since_restart = 0
+        return report
+
+    def test_leak_between_restarts(self):
+        '''The growth between restarts is found, not flattened by the drops at the restarts'''
+        report = self.soak(leak=0.5, restart_every=50)
+        per_cycle, per_hour = report.leak_rates()['PoolUsedMem']
+        self.assertAlmostEqual(per_cycle, 0.5, places=2)
+        self.assertAlmostEqual(per_hour, 0.5 / 2.0 * 3600.0, delta=5.0)
+
+    def test_no_leak_with_restarts(self):
+        report = self.soak(leak=0.0, restart_every=50)
+        per_cycle, per_hour = report.leak_rates()['PoolUsedMem']
+        self.assertAlmostEqual(per_cycle, 0.0, places=2)
+
+    def test_restarts_are_not_steps(self):
+        report = self.soak(leak=0.5, restart_every=50)
+        self.assertEqual(report.steps(), [])
+
+    def test_step_between_restarts(self):
+        report = self.soak(leak=0.0, restart_every=50, step_at=120)
+        self.assertEqual([(cycle, name) for (cycle, name, step) in report.steps()], [(120, 'PoolUsedMem')])
+
+    def test_segments(self):
+        self.assertEqual(hdf_soak.segments(range(10), [3, 6]), [(0, 4), (4, 7), (7, 10)])
+        self.assertEqual(hdf_soak.segments(range(10), [9]), [(0, 10)])
+
+class TestSoakRestart(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        # The heap corruption script lives one directory up
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import test_hdf_heap_corruption_bug
+        self.script = test_hdf_heap_corruption_bug
+        self.settings = (self.script.HDF, simioc.ioc.running)
+        self.script.HDF = "TESTRESTART:HDF"
+        simioc.caput(self.script.HDF + ":NDArrayPort", "")
+
+    def tearDown(self):
+        self.script.HDF, simioc.ioc.running = self.settings
+        sys.path.pop(0)
+        ToolTestCase.tearDown(self)
+
+    def test_ca_nothing_while_down(self):
+        '''A stopped IOC disconnects its PVs, as cothread.catools reports it'''
+        simioc.ioc.running = False
+        self.assertRaises(simioc.ca_nothing, simioc.caget, self.script.HDF + ":PortName_RBV")
+        value = simioc.caget(self.script.HDF + ":PortName_RBV", throw=False)
+        self.assertFalse(value.ok)
+
+    def test_ioc_ready(self):
+        '''Waiting for a restarted IOC polls through the disconnects instead of ending the soak'''
+        simioc.ioc.running = False
+        polls = []
+        def sleep(delay):
+            polls.append(delay)
+            if len(polls) == 3:
+                simioc.ioc.running = True
+        restart = hdf_soak.CommandRestart("true", ready=self.script.ioc_ready, autosave_wait=0.0, sleep=sleep)
+        restart()
+        self.assertEqual(len(polls), 3)
+        self.assertTrue(self.script.ioc_ready())
+
+class TestFrameCheck(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.hdf_file = os.path.join(self.directory, "frames.h5")
+
+    def write(self, frames):
+        with h5py.File(self.hdf_file, 'w') as hdf:
+            hdf.create_dataset("data", data=frames, chunks=(1,) + frames.shape[1:])
+
+    def ramp(self, start, count):
+        # What a simDetector with Gain 3, GainX 2 and GainY 1 writes, start frames after a reset
+        return hdf_frames.LinearRampPattern(3, 2, 1, 0).expected(start, count, (8, 20), numpy.uint8)
+
+    def test_ramp_wraps(self):
+        frames = self.ramp(0, 2)
+        self.assertEqual(frames[0, 7, 19], (2*19 + 7) * 3 % 256)
+        self.assertEqual(frames[1, 7, 19], ((2*19 + 7) * 3 + 3) % 256)
+
+    def test_ramp_calibrated_from_first_frame(self):
+        '''A file which starts part way along the ramp is checked against its own first frame'''
+        self.write(self.ramp(100, 10))
+        result = hdf_frames.check_frames(self.hdf_file, "data", hdf_frames.LinearRampPattern(3, 2, 1), workers=3)
+        self.assertEqual(result.frames, 10)
+        self.assertEqual(result.problems, [])
+
+    def test_ramp_corrupt_frame(self):
+        frames = self.ramp(0, 10)
+        frames[6, 2, 3] += 1
+        self.write(frames)
+        result = hdf_frames.check_frames(self.hdf_file, "data", hdf_frames.LinearRampPattern(3, 2, 1), workers=3)
+        self.assertEqual([frame for (frame, problem) in result.problems], [6])
+
+    def test_manifest_swapped_frames(self):
+        '''Reordered frames are reported as such by the worker threads'''
+        frames = self.ramp(0, 10)
+        self.write(frames)
+        manifest = hdf_frames.create_manifest(self.hdf_file, "data", workers=3)
+        manifest_file = os.path.join(self.directory, "frames.sha1")
+        manifest.save(manifest_file)
+        frames[[2, 5]] = frames[[5, 2]]
+        self.write(frames)
+        manifest = hdf_frames.ChecksumManifest().load(manifest_file)
+        result = hdf_frames.check_frames(self.hdf_file, "data", manifest, workers=3)
+        self.assertEqual(result.problems, [(2, "holds the content of frame 5"), (5, "holds the content of frame 2")])
+
+class TestIndexCache(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.hdf_file = os.path.join(self.directory, "data", "indexed.h5")
+        self.cache_dir = os.path.join(self.directory, "cache")
+        os.mkdir(os.path.dirname(self.hdf_file))
+        with h5py.File(self.hdf_file, 'w') as hdf:
+            hdf.create_dataset("entry/data", data=numpy.zeros((4, 2)))
+
+    def test_no_files_next_to_data(self):
+        hdf_index.index_file(self.hdf_file)
+        hdf_index.index_file(self.hdf_file, cache=True, cache_dir=self.cache_dir)
+        self.assertEqual(os.listdir(os.path.dirname(self.hdf_file)), ["indexed.h5"])
+
+    def test_private_cache_keyed_by_mtime(self):
+        index = hdf_index.index_file(self.hdf_file, cache=True, cache_dir=self.cache_dir)
+        self.assertEqual(os.stat(self.cache_dir).st_mode & 0777, 0700)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertEqual(hdf_index.index_file(self.hdf_file, cache=True, cache_dir=self.cache_dir).datasets,
+                         index.datasets)
+        with h5py.File(self.hdf_file, 'a') as hdf:
+            hdf.create_dataset("entry/more", data=numpy.zeros(3))
+        os.utime(self.hdf_file, (0, 1))
+        index = hdf_index.index_file(self.hdf_file, cache=True, cache_dir=self.cache_dir)
+        self.assertIn("/entry/more", index)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_shared_cache_dir_not_used(self):
+        os.mkdir(self.cache_dir)
+        os.chmod(self.cache_dir, 0777)
+        hdf_index.index_file(self.hdf_file, cache=True, cache_dir=self.cache_dir)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_damaged_index_rebuilt(self):
+        hdf_index.index_file(self.hdf_file, cache=True, cache_dir=self.cache_dir)
+        with open(hdf_index.cache_name(self.hdf_file, self.cache_dir), 'wb') as f:
+            f.write("not an index")
+        self.assertIn("/entry/data", hdf_index.index_file(self.hdf_file, cache=True, cache_dir=self.cache_dir))
+
+class TestAttributeComparison(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        xml_file = os.path.join(self.directory, "attributes.xml")
+        with open(xml_file, 'w') as f:
+            f.write('<?xml version="1.0" standalone="no" ?>\n<hdf5_layout>\n<group name="entry">'
+                    '<attribute name="title" source="constant" value="scan" type="string"/>'
+                    '<attribute name="count" source="constant" value="3" type="int"/>'
+                    '<attribute name="missing" source="constant" value="1" type="int"/>'
+                    '<dataset name="data" source="detector">'
+                    '<attribute name="scale" source="constant" value="1.5,2.5" type="float"/>'
+                    '<attribute name="offset" source="constant" value="0.1" type="float"/>'
+                    '<attribute name="size" source="constant" value="4" type="int"/>'
+                    '</dataset></group>\n</hdf5_layout>\n')
+        self.xml_def = hdf_xml.HdfXmlDefinition()
+        self.xml_def.populate(xml_file)
+        self.hdf_file = os.path.join(self.directory, "attributes.h5")
+
+    def write(self, title="scan", count=3, scale=(1.5, 2.5), offset=0.1, size=4):
+        with h5py.File(self.hdf_file, 'w') as hdf:
+            entry = hdf.create_group("entry")
+            entry.attrs["title"] = title
+            entry.attrs["count"] = count
+            data = entry.create_dataset("data", data=numpy.zeros((2, 2)))
+            data.attrs["scale"] = numpy.array(scale)
+            data.attrs["offset"] = offset
+            data.attrs["size"] = size
+        return hdf_index.index_file(self.hdf_file)
+
+    def mismatches(self, index, rtol=0.0, atol=0.0, kind=None):
+        comparison = hdf_compare.AttributeComparison(self.xml_def, rtol, atol)
+        return sorted([(m.path, m.name, m.reason) for m in comparison.compare(index, kind)])
+
+    def test_matching(self):
+        self.assertEqual(self.mismatches(self.write()), [("/entry", "missing", hdf_compare.MISSING)])
+
+    def test_all_mismatches(self):
+        '''Every difference is reported, each with its reason'''
+        index = self.write(title="other", count=4, scale=(1.5, 2.5, 3.5), size="4")
+        self.assertEqual(self.mismatches(index),
+                         [("/entry", "count", hdf_compare.MISMATCH), ("/entry", "missing", hdf_compare.MISSING),
+                          ("/entry", "title", hdf_compare.MISMATCH),
+                          ("/entry/data", "scale", hdf_compare.SHAPE), ("/entry/data", "size", hdf_compare.TYPE)])
+        self.assertEqual(self.mismatches(index, kind=hdf_index.DATASET),
+                         [("/entry/data", "scale", hdf_compare.SHAPE), ("/entry/data", "size", hdf_compare.TYPE)])
+
+    def test_float_tolerance(self):
+        index = self.write(offset=0.1 + 1e-9)
+        self.assertEqual(self.mismatches(index, kind=hdf_index.DATASET), [("/entry/data", "offset", hdf_compare.MISMATCH)])
+        self.assertEqual(self.mismatches(index, atol=1e-6, kind=hdf_index.DATASET), [])
+
+class TestNDAttributeValues(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.hdf_file = os.path.join(self.directory, "ndattr.h5")
+
+    def check(self, check, values, chunk_size):
+        with h5py.File(self.hdf_file, 'w') as hdf:
+            hdf.create_dataset("values", data=values)
+        with h5py.File(self.hdf_file, 'r') as hdf:
+            return check("values", hdf["values"], chunk_size)
+
+    def test_counter_per_frame_rows(self):
+        '''A (frames x n) counter dataset is checked frame by frame, not as one flat vector'''
+        counters = numpy.array([[frame, frame + 10] for frame in range(1, 9)])
+        self.assertEqual(self.check(hdf_ndattr.check_counter, counters, 3), [])
+        counters[5:] += 1
+        problems = self.check(hdf_ndattr.check_counter, counters, 3)
+        self.assertEqual(len(problems), 1)
+        self.assertIn("1 gaps; first at frame 5: [5, 15] -> [7, 17]", problems[0])
+
+    def test_timestamp_per_frame_rows(self):
+        stamps = numpy.array([[frame, 0.5] for frame in range(6)], dtype=numpy.float64)
+        self.assertEqual(self.check(hdf_ndattr.check_monotonic, stamps, 4), [])
+        stamps[4, 1] = 0.25
+        problems = self.check(hdf_ndattr.check_monotonic, stamps, 4)
+        self.assertEqual(len(problems), 1)
+        self.assertIn("decreases 1 times; first at frame 4:", problems[0])
+
+class TestChunkReport(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.hdf_file = os.path.join(self.directory, "chunks.h5")
+        with h5py.File(self.hdf_file, 'w') as hdf:
+            hdf.create_dataset("data", data=numpy.zeros((8, 32, 32), numpy.uint16), chunks=(1, 32, 32))
+
+    def test_unknown_alignment_noted(self):
+        '''Where the HDF5 library cannot give the chunk offsets the report says so'''
+        advisor = hdf_chunks.ChunkAdvisor(['frame'], 1024*1024, repeat=1, directory=self.directory)
+        report = hdf_chunks.analyse(self.hdf_file, advisor, datasets=["/data"])
+        layout = report.layouts[0]
+        if layout.alignment is None:
+            self.assertEqual(len(report.notes), 1)
+            self.assertTrue("/data cannot be determined" in report.notes[0])
+            self.assertTrue("Note: alignment" in report.summary())
+        else:
+            self.assertEqual(report.notes, [])
+
+    def advice(self, *timings):
+        '''A ChunkAdvice with a candidate per {pattern: elapsed}, the first being the current chunking'''
+        advice = hdf_chunks.ChunkAdvice(None, None, 8, ['frame', 'pixel'])
+        for i, elapsed in enumerate(timings):
+            results = dict([(pattern, hdf_chunks.PatternResult(pattern, 1024, t)) for (pattern, t) in elapsed.items()])
+            candidate = hdf_chunks.CandidateResult((1, 32, 32 >> i), results, 1024)
+            if not advice.candidates:
+                advice.current = results
+            candidate.compare((advice.candidates or [candidate])[0])
+            advice.candidates.append(candidate)
+        return advice
+
+    def test_noise_not_recommended(self):
+        '''A candidate only faster by timing noise does not replace the current chunking'''
+        advice = self.advice({'frame': 1.0, 'pixel': 1.0}, {'frame': 0.99, 'pixel': 0.99})
+        self.assertTrue(advice.best is advice.candidates[0])
+        advice = self.advice({'frame': 1.0, 'pixel': 1.0}, {'frame': 0.5, 'pixel': 0.8})
+        self.assertTrue(advice.best is advice.candidates[1])
+
+    def test_missing_speedups(self):
+        '''Patterns which were not timed, or too fast to time, are left out rather than fatal'''
+        advice = self.advice({'frame': 1.0, 'pixel': 0.0}, {'frame': 0.5}, {'frame': 0.5, 'pixel': 0.0})
+        self.assertTrue(advice.best is advice.candidates[0])
+        self.assertEqual(advice.best_for('pixel'), None)
+        self.assertTrue("n/a" in advice.summary().split("\n")[-2])
+
+    def test_writer_settings(self):
+        settings = hdf_chunks.writer_settings((4, 32, 16))
+        self.assertEqual(sorted(settings), sorted(hdf_chunks.WRITER_FIELDS))
+        self.assertEqual((settings['NumFramesChunks'], settings['NumRowChunks'], settings['NumColChunks']), (4, 32, 16))
+
+class TestSectionFixture(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.ini_file = os.path.join(self.directory, "test.ini")
+        self.calls = []
+        self.functions = (adclientxmlhdf.run_xml_hdf_writer, hdf_index.index_file)
+        def counted(name, function):
+            def call(*args, **kargs):
+                self.calls.append(name)
+                return function(*args, **kargs)
+            return call
+        adclientxmlhdf.run_xml_hdf_writer = counted("acquire", adclientxmlhdf.run_xml_hdf_writer)
+        hdf_index.index_file = counted("index", hdf_index.index_file)
+
+    def tearDown(self):
+        adclientxmlhdf.run_xml_hdf_writer, hdf_index.index_file = self.functions
+        ToolTestCase.tearDown(self)
+
+    def run_section(self, xml_file):
+        with open(self.ini_file, 'w') as f:
+            f.write("[FIXTURE]\nsimpv = TESTFIXTURE:CAM\nhdfpv = TESTFIXTURE:HDF\n"
+                    "xml_file = %s\nhdf_file = %s\n"%(xml_file, os.path.join(self.directory, "fixture.h5")))
+        return test_hdf_xml._run_section((self.ini_file, "FIXTURE", 0, False))
+
+    def test_acquired_once(self):
+        '''All the test methods of a section share one acquisition and one index'''
+        result = self.run_section(data_file("layout.xml"))
+        self.assertEqual((result['failures'], result['errors']), ([], []))
+        self.assertTrue(result['testsRun'] > 1)
+        self.assertEqual(self.calls, ["acquire", "index"])
+
+    def test_missing_xml_file(self):
+        '''A section which cannot be set up fails once, not in every test method'''
+        result = self.run_section(os.path.join(self.directory, "missing.xml"))
+        self.assertEqual((result['testsRun'], len(result['errors'])), (0, 1))
+        self.assertTrue("Cannot complete tests without XML file" in result['errors'][0][1])
+        self.assertEqual(self.calls, [])
+
+class TestParallelIni(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.ini_file = os.path.join(self.directory, "test.ini")
+
+    def sections(self, text):
+        with open(self.ini_file, 'w') as f:
+            f.write(text)
+        return test_hdf_xml.shared_pv_sections(self.ini_file)
+
+    def test_default_pvs_are_shared(self):
+        self.assertEqual(self.sections("[A]\nxml_file = a.xml\n"), ['A'])
+
+    def test_worker_pvs(self):
+        self.assertEqual(self.sections("[DEFAULT]\nsimpv = SIM%(worker)s:CAM\nhdfpv = SIM%(worker)s:HDF\n"
+                                       "[A]\nxml_file = a.xml\n[B]\nhdfpv = SIM:HDF\n"), ['B'])
+
+    def test_worker_ids(self):
+        '''A worker started to replace one which died gets a worker index of its own'''
+        pool = multiprocessing.Pool(2, test_hdf_xml._init_worker, (multiprocessing.Value('i', 0),))
+        try:
+            self.assertEqual(sorted(set(pool.map(_worker_id, [0.2, 0.2], chunksize=1))), [1, 2])
+            pool.apply_async(os._exit, (1,))
+            ids = set(pool.map(_worker_id, [0.05] * 20, chunksize=1))
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(len(ids), 2)
+        self.assertTrue(3 in ids)
+
+def _worker_id(delay):
+    time.sleep(delay)
+    return test_hdf_xml.WORKER_ID
+
+class TestSeries(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.xml_file = data_file("layout.xml")
+        self.files = []
+        for n in range(3):
+            fname = os.path.join(self.directory, "series_%d.h5"%(n))
+            shutil.copy(data_file("layout_test.h5"), fname)
+            self.files.append(fname)
+        self.manifest_file = os.path.join(self.directory, "manifest.json")
+
+    def test_deleted_file(self):
+        '''A file deleted after the series was listed is reported, not fatal'''
+        manifest = hdf_series.Manifest(self.xml_file)
+        os.remove(self.files[1])
+        report = hdf_series.validate_series(self.xml_file, self.files, manifest)
+        self.assertEqual(len(report.results), 3)
+        self.assertEqual([result.path for result in report.invalid if result.stat is None], [self.files[1]])
+        self.assertFalse(self.files[1] in manifest.files)
+
+    def test_unreadable_values(self):
+        '''A file whose contents the checks choke on is marked invalid, the others are still checked'''
+        with h5py.File(self.files[2], 'a') as hdf:
+            size = hdf["/entry/attributes/ArrayCounter"].shape[0]
+            del hdf["/entry/attributes/ArrayCounter"]
+            hdf.create_dataset("/entry/attributes/ArrayCounter", data=["x"]*size)
+        manifest = hdf_series.Manifest(self.xml_file)
+        report = hdf_series.validate_series(self.xml_file, self.files, manifest)
+        self.assertEqual(len(report.results), 3)
+        failed = [result.path for result in report.results
+                  if [problem for problem in result.problems if problem.startswith("Cannot check file: ValueError")]]
+        self.assertEqual(failed, [self.files[2]])
+
+    def test_manifest_tolerances(self):
+        '''Results recorded with other float tolerances are checked again'''
+        manifest = hdf_series.Manifest(self.xml_file, 1e-6, 0.0)
+        hdf_series.validate_series(self.xml_file, self.files, manifest, rtol=1e-6)
+        manifest.save(self.manifest_file)
+        manifest = hdf_series.Manifest(self.xml_file, 1e-6, 0.0).load(self.manifest_file)
+        self.assertEqual(hdf_series.validate_series(self.xml_file, self.files, manifest, rtol=1e-6).checked, 0)
+        manifest = hdf_series.Manifest(self.xml_file).load(self.manifest_file)
+        self.assertEqual(hdf_series.validate_series(self.xml_file, self.files, manifest).checked, 3)
+
+class TestService(ToolTestCase):
+    def setUp(self):
+        ToolTestCase.setUp(self)
+        self.socket_file = os.path.join(self.directory, "service.sock")
+        self.xml_file = data_file("layout.xml")
+        self.service = hdf_service.ValidationService(self.socket_file, 2, [self.xml_file]).start()
+        self.server = self.service.server
+        # Record what the server would print for a connection which failed
+        self.errors = []
+        self.server.handle_error = lambda request, client_address: self.errors.append(traceback.format_exc())
+        self.closed = threading.Semaphore(0)
+        shutdown_request = self.server.shutdown_request
+        def closed(request):
+            shutdown_request(request)
+            self.closed.release()
+        self.server.shutdown_request = closed
+        self.thread = threading.Thread(target=self.service.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.clients = []
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.shutdown()
+        self.thread.join()
+        ToolTestCase.tearDown(self)
+
+    def client(self, timeout=None):
+        client = hdf_service.ValidationClient(self.socket_file, timeout)
+        self.clients.append(client)
+        return client
+
+    def test_validate(self):
+        response = self.client(10.0).validate(self.xml_file, data_file("layout_test.h5"))
+        self.assertTrue(response['ok'])
+        self.assertEqual(response['file'], data_file("layout_test.h5"))
+
+    def test_slow_client(self):
+        '''A client which does not read its responses does not hold up the others'''
+        slow = self.client()
+        # Enough responses to fill the socket buffers many times over
+        for n in range(4000):
+            slow._send({'op': 'validate', 'xml': self.xml_file, 'hdf': os.path.join(self.directory, "%d.h5"%(n))})
+        try:
+            response = self.client(10.0).validate(self.xml_file, data_file("layout_test.h5"))
+        except socket.timeout:
+            self.fail("The response was held up by a client which does not read")
+        self.assertTrue(response['ok'])
+        # A client hanging up on its responses is nothing to print a traceback about
+        slow.close()
+        self.clients.remove(slow)
+        deadline = time.time() + 30.0
+        while not self.closed.acquire(False):
+            self.assertTrue(time.time() < deadline, "The connection of the slow client was not closed")
+            time.sleep(0.01)
+        self.assertEqual(self.errors, [])
+
+    def test_stuck_worker(self):
+        '''A request whose worker never answers fails after the timeout, and the
+        connection is still closed'''
+        self.service.timeout = 1.0
+        # Opening a FIFO blocks until somebody writes to it: the worker is stuck
+        fifo = os.path.join(self.directory, "stuck.h5")
+        os.mkfifo(fifo)
+        client = self.client(30.0)
+        response = client.validate(self.xml_file, fifo)
+        self.assertFalse(response['ok'])
+        self.assertTrue("No response within" in response['error'])
+        self.assertEqual(client.stats()['errors'], 1)
+        # The other worker carries on
+        self.assertTrue(client.validate(self.xml_file, data_file("layout_test.h5"))['ok'])
+        client.close()
+        self.clients.remove(client)
+        self.assertTrue(self.closed.acquire(True))
+
+    def test_shared_socket_directory(self):
+        '''No socket in a directory where other users could replace it'''
+        directory = os.path.join(self.directory, "shared")
+        os.mkdir(directory)
+        os.chmod(directory, 0777)
+        socket_file = os.path.join(directory, "service.sock")
+        self.assertRaises(hdf_service.ServiceError, hdf_service.ValidationService(socket_file).start)
+        self.assertRaises(hdf_service.ServiceError, hdf_service.ValidationClient, socket_file)
+        self.assertFalse(os.path.exists(socket_file))
+
+if __name__=="__main__":
+    unittest.main()
@@ -8,12 +8,19 @@ except:
     # and that is OK too...
     pass
     
-import os, argparse
+import os, sys, time, argparse
 import unittest
 import ConfigParser
-import h5py 
+import StringIO
+import multiprocessing
 
 import hdf_xml
+import hdf_index
+import hdf_compare
+import hdf_ndattr
+import hdf_frames
+import hdf_schema
+import hdf_trace
 
 # The adclientxmlhdf module imports the DLS cothread.catools module
 # which is an EPICS Channel Access client.
@@ -21,13 +28,29 @@ import hdf_xml
 # run the IOC client code which generates the HDF5 output files based on
 # the users XML definition. The user will have to manually supply the HDF5 file
 # instead (defined in the .ini file).
+# With ADCLIENT_SIMIOC=1 the client drives the in-process simulated IOC (simioc.py)
+# instead, which needs neither cothread nor an IOC.
 try:
     import adclientxmlhdf
     RUN_CA_CLIENT=True
-    print "DLS cothread.catools module is available."
 except ImportError:
     RUN_CA_CLIENT=False
 
+# Index of the worker process running the tests (1 when running serially).
+# It is available to the ini file as %(worker)s so each parallel worker can
+# be pointed at its own IOC PV prefix.
+WORKER_ID = 1
+
+# The IOC PVs the file is acquired with, unless the ini file sets them
+PV_DEFAULTS = {'simpv': 'TESTSIMDETECTOR:CAM',
+               'hdfpv': 'TESTSIMDETECTOR:HDF'}
+
+def make_class(cls, ini_file, section):
+    '''Generate a class based on cls for one section of the ini_file.
+    The ini file name and section name are stored as constants in the class.'''
+    name = '%s: %s' %(cls.__name__, section)
+    return type(name, (cls,), {'ini_file': ini_file, 'ini_section': section})
+
 def make_classes(cls, ini_file):
     '''Programatically generate (yield) a number of classes.
     The classes are based on the cls input and the section names of the
@@ -37,122 +60,256 @@ def make_classes(cls, ini_file):
     cfg.read(ini_file)
     sections = cfg.sections()
     for section in sections:
-        name = '%s: %s' %(cls.__name__, section)
-        yield type(name, (cls,), {'ini_file': ini_file, 'ini_section': section})       
+        yield make_class(cls, ini_file, section)
 
 class TestHdfXml(unittest.TestCase):
     ini_file = None
     ini_section = None
     
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
+        '''Acquire, open and index the HDF5 file once per ini section.
+        All the test methods of the section share these read-only.'''
+        with hdf_trace.span("setUpClass", "phase", section=cls.ini_section):
+            cls._set_up_class()
+
+    @classmethod
+    def _set_up_class(cls):
         # First read the ini file (with a few sensible defaults)
-        defaults = {'num_images': "4", 'exposure': "0.1",
-                    'simpv': 'TESTSIMDETECTOR:CAM',
-                    'hdfpv': 'TESTSIMDETECTOR:HDF'}
+        defaults = dict(PV_DEFAULTS)
+        defaults.update({'num_images': "4", 'exposure': "0.1",
+                         'worker': str(WORKER_ID),
+                         'float_rtol': "0.0", 'float_atol': "0.0",
+                         'schema_valid': "true",
+                         'frame_reference': "",
+                         'ramp_gain': "", 'ramp_gain_x': "", 'ramp_gain_y': ""})
         cfg = ConfigParser.SafeConfigParser( defaults = defaults )
-        cfg.read(self.ini_file)
-        xml_file = cfg.get(self.ini_section, 'xml_file')
-        hdf_file = cfg.get(self.ini_section, 'hdf_file')
+        cfg.read(cls.ini_file)
+        xml_file = cfg.get(cls.ini_section, 'xml_file')
+        hdf_file = cfg.get(cls.ini_section, 'hdf_file')
 
         # Check that an XML definition file already exist
-        self.assertTrue(os.path.exists(xml_file), \
-                        "Cannot complete tests without XML file: \'%s\'"%(xml_file))
+        if not os.path.exists(xml_file):
+            raise cls.failureException("Cannot complete tests without XML file: \'%s\'"%(xml_file))
+        # The number of frames is only known if we acquire the file ourselves
+        cls.num_frames = None
+        # Layouts which are known not to match the schema are acquired without the check
+        cls.schema_valid = cfg.getboolean(cls.ini_section, 'schema_valid')
         if RUN_CA_CLIENT:
+            cls.num_frames = cfg.getint(cls.ini_section, 'num_images')
             # Use the XML file (and some IOC out there) to create a HDF5 file
             adclientxmlhdf.run_xml_hdf_writer(xml_file, hdf_file, 
-                                              nimages= cfg.getint(self.ini_section, 'num_images'), 
-                                              exposure= cfg.getfloat(self.ini_section, 'exposure'),
-                                              simpv = cfg.get(self.ini_section, 'simpv'),
-                                              hdfpv = cfg.get(self.ini_section, 'hdfpv') )
+                                              nimages= cfg.getint(cls.ini_section, 'num_images'), 
+                                              exposure= cfg.getfloat(cls.ini_section, 'exposure'),
+                                              simpv = cfg.get(cls.ini_section, 'simpv'),
+                                              hdfpv = cfg.get(cls.ini_section, 'hdfpv'),
+                                              check = cls.schema_valid )
         
         # Now check that the HDF5 file really exists
-        self.assertTrue(os.path.exists(hdf_file),
-                        "Cannot complete tests without HDF5 file: \'%s\'"%(hdf_file))
+        if not os.path.exists(hdf_file):
+            raise cls.failureException("Cannot complete tests without HDF5 file: \'%s\'"%(hdf_file))
         
-        self.xml_def = hdf_xml.HdfXmlDefinition()
-        self.xml_def.populate(xml_file)
-        self.hdf = h5py.File(hdf_file)
+        cls.hdf_file = hdf_file
+        cls.xml_file = xml_file
+        cls.xml_def = hdf_xml.load_definition(xml_file)
+        # Index all groups, datasets and their attributes in one pass. The checks
+        # run against this index and don't need to touch the file again.
+        cls.index = hdf_index.index_file(hdf_file)
         
         # Build some convenient lists of gropus and datasets
-        self.hdf_groups = []
-        self.hdf_datasets = []
-        def build_hdf_lists(name):
-            name = "/"+name
-            #print "build_hdf_lists: ", name
-            if type(self.hdf[name]) == h5py._hl.dataset.Dataset:
-                self.hdf_datasets.append(name)
-            elif type(self.hdf[name]) == h5py._hl.group.Group:
-                self.hdf_groups.append(name)
-        self.hdf.visit(build_hdf_lists)
-    
-    def tearDown(self):
-        self.hdf.close()
+        cls.hdf_groups = cls.index.groups
+        cls.hdf_datasets = cls.index.datasets
+        
+        # All expected attributes, batched for comparison against the index
+        cls.comparison = hdf_compare.AttributeComparison(cls.xml_def,
+                                                         rtol = cfg.getfloat(cls.ini_section, 'float_rtol'),
+                                                         atol = cfg.getfloat(cls.ini_section, 'float_atol'))
+        cls.ndattr_check = hdf_ndattr.NDAttributeCheck(cls.xml_def, cls.index)
+        # Optional reference for the detector frame data: the simDetector pattern or a manifest
+        cls.frame_reference = None
+        frame_reference = cfg.get(cls.ini_section, 'frame_reference')
+        if frame_reference == 'linear_ramp':
+            ramp = [cfg.get(cls.ini_section, option) for option in ['ramp_gain', 'ramp_gain_x', 'ramp_gain_y']]
+            if '' not in ramp:
+                cls.frame_reference = hdf_frames.LinearRampPattern(*[float(value) for value in ramp])
+            elif RUN_CA_CLIENT:
+                # The pattern depends on the gains the driver acquired the file with
+                cls.frame_reference = adclientxmlhdf.SimDet(cfg.get(cls.ini_section, 'simpv')).linear_ramp()
+            else:
+                raise cls.failureException("frame_reference = linear_ramp needs ramp_gain, ramp_gain_x and "
+                                           "ramp_gain_y (the simDetector Gain, GainX and GainY) without an IOC")
+        elif frame_reference:
+            cls.frame_reference = hdf_frames.ChecksumManifest().load(frame_reference)
             
+    def setUp(self):
+        # Each check is traced as a span of the validate phase
+        self._span = hdf_trace.span(self._testMethodName, "validate", section=self.ini_section)
+        self._span.__enter__()
+    def tearDown(self):
+        self._span.__exit__(None, None, None)
+
+    def test_xml_schema(self):
+        '''Check that the XML definition file validates against the XSD schema, or
+        that it does not if the section says so with schema_valid = false'''
+        if not hdf_schema.HAVE_LXML:
+            self.skipTest("lxml not available: the layout is not validated against the schema")
+        validation = hdf_schema.SchemaValidator().validate(self.xml_file)
+        if self.schema_valid:
+            self.assertTrue(validation.valid, str(validation))
+        else:
+            self.assertFalse(validation.valid, "The layout should not validate against the schema")
+
     def test_all_defined_groups(self):
         ''' Check if all XML defined groups are present in HDF5'''
         for group in self.xml_def.groups:
-            self.assertTrue(group in self.hdf, "Group \'%s\' should exist in the HDF file"%(group))
+            self.assertTrue(group in self.index, "Group \'%s\' should exist in the HDF file"%(group))
                     
     def test_group_attributes(self):
         '''Check if all groups in HDF5 have the pre-defined attributes present'''
-        for hdf_group_name in self.hdf_groups:
-            try:
-                attributes = self.xml_def.groups[hdf_group_name][1]
-                hdf_group = self.hdf[hdf_group_name]
-            except:
-                # No group of that name defined. Probably not reason to fail, so we just continue
-                continue
-            for attribute in attributes.itervalues():
-                #print "Group: %s  attr: %s" % (hdf_dset_name, attribute.name)
-                self.assertTrue(attribute.name in hdf_group.attrs, "Group \'%s\' should contain attribute \'%s\'"%(hdf_group_name, attribute.name))
-                # If the attribute is a constant we verify it's value too
-                if attribute.is_constant():
-                    # Numpy arrays (h5py uses numpy) are evaluated slightly differently
-                    if type( attribute.value ) == list:
-                        array_equal = (attribute.value == hdf_group.attrs[attribute.name])
-                        self.assertTrue( array_equal.all(), \
-                                         msg = "Group \'%s:%s\' constant value: %s == %s" \
-                                         %(hdf_group_name, attribute.name, attribute.value, hdf_group.attrs[attribute.name]) )
-                    else:
-                        self.assertEqual(attribute.value, hdf_group.attrs[attribute.name], \
-                                         msg = "Group \'%s:%s\' constant value: %s == %s" \
-                                         %(hdf_group_name, attribute.name, attribute.value, hdf_group.attrs[attribute.name]) )
+        mismatches = self.comparison.compare(self.index, hdf_index.GROUP)
+        self.assertFalse(mismatches, "%d group attribute mismatches:\n%s"
+                         %(len(mismatches), "\n".join([str(m) for m in mismatches])))
         
     def test_all_detector_dset(self):
         ''' Check if all defined detector datasets exist in HDF5'''
         for xml_dset in self.xml_def.datasets:
             if self.xml_def.datasets[xml_dset][0] == hdf_xml.DETECTOR:
-                self.assertTrue(xml_dset in self.hdf, "Detector dataset \'%s\' should exist in HDF5"%xml_dset)
+                self.assertTrue(xml_dset in self.index, "Detector dataset \'%s\' should exist in HDF5"%xml_dset)
         
     
     def test_dataset_attributes(self):
         ''' Check if all datasets in HDF5 have the pre-defined attributes present'''
-        for hdf_dset_name in self.hdf_datasets:
-            try:
-                attributes = self.xml_def.datasets[hdf_dset_name][2]
-            except:
-                # This dataset was not defined in the XML - it could have been added
-                # by anyone, which is in principle fine, so we just continue the loop here.
-                continue
-            hdf_dset = self.hdf[hdf_dset_name]
-            for attribute in attributes.itervalues():
-                #print "Group: %s  attr: %s" % (hdf_dset_name, attribute.name)
-                self.assertTrue(attribute.name in hdf_dset.attrs, \
-                                "Dataset \'%s\' should contain attribute \'%s\'"\
-                                %(hdf_dset_name, attribute.name))
-                # If the attribute is a constant we verify it's value too
-                if attribute.is_constant():
-                    # Numpy arrays (h5py uses numpy) are evaluated slightly differently
-                    if type( attribute.value ) == list:
-                        array_equal = (attribute.value == hdf_dset.attrs[attribute.name])
-                        self.assertTrue( array_equal.all(), \
-                                         msg = "Dataset \'%s\:%s' constant value: %s == %s" \
-                                         %(hdf_dset_name, attribute.name, attribute.value, hdf_dset.attrs[attribute.name]) )
-                    else:
-                        self.assertEqual(attribute.value, hdf_dset.attrs[attribute.name], \
-                                         msg = "Dataset \'%s:%s\' constant value: %s == %s" \
-                                         %(hdf_dset_name, attribute.name, attribute.value, hdf_dset.attrs[attribute.name]) )
+        mismatches = self.comparison.compare(self.index, hdf_index.DATASET)
+        self.assertFalse(mismatches, "%d dataset attribute mismatches:\n%s"
+                         %(len(mismatches), "\n".join([str(m) for m in mismatches])))
+
+    def test_ndattribute_datasets(self):
+        '''Check that NDAttribute datasets have one entry per frame, without gaps in the counters'''
+        num_frames = self.num_frames
+        if num_frames is None:
+            # Pre-existing file: expect as many entries as there are detector frames
+            num_frames = hdf_ndattr.detector_frames(self.xml_def, self.index)
+        problems = []
+        if num_frames is not None:
+            problems += self.ndattr_check.check_frame_count(num_frames)
+        problems += self.ndattr_check.check_values(self.hdf_file)
+        self.assertFalse(problems, "%d NDAttribute dataset problems:\n%s"%(len(problems), "\n".join(problems)))
 
+    def test_ndattribute_when(self):
+        '''Check that NDAttribute attributes written OnFileOpen or OnFileClose are scalars'''
+        problems = hdf_ndattr.check_when_scalars(self.xml_def, self.index)
+        self.assertFalse(problems, "%d NDAttribute attribute problems:\n%s"%(len(problems), "\n".join(problems)))
+
+    def test_detector_frames(self):
+        '''Check the detector frame data against the configured frame reference'''
+        if self.frame_reference is None:
+            self.skipTest("no frame_reference configured")
+        dset_name = self.xml_def.detector_default
+        self.assertTrue(dset_name in self.index, "Detector dataset \'%s\' should exist in HDF5"%dset_name)
+        result = hdf_frames.check_frames(self.hdf_file, dset_name, self.frame_reference)
+        problems = ["Frame %d %s"%(frame, problem) for (frame, problem) in result.problems]
+        self.assertFalse(problems, "%s\n%s"%(result, "\n".join(problems)))
+
+def _init_worker(last_worker_id):
+    '''Take the next worker index from the shared counter. The workers the pool
+    starts with get 1 to jobs; a worker the pool starts to replace one which died
+    gets an index above jobs of its own, so it never shares a worker\'s PVs.'''
+    global WORKER_ID
+    with last_worker_id.get_lock():
+        last_worker_id.value += 1
+        WORKER_ID = last_worker_id.value
+
+def _run_section(task):
+    '''Run the tests of one ini section in a worker process.
+    Returns the text output and a picklable summary of the unittest result.'''
+    ini_file, section, verbosity, failfast = task
+    stream = StringIO.StringIO()
+    result = unittest.TextTestResult(unittest.runner._WritelnDecorator(stream), True, verbosity)
+    result.failfast = failfast
+    suite = unittest.TestLoader().loadTestsFromTestCase(make_class(TestHdfXml, ini_file, section))
+    suite(result)
+    return {'section': section,
+            'output': stream.getvalue(),
+            'testsRun': result.testsRun,
+            'failures': [(result.getDescription(test), err) for (test, err) in result.failures],
+            'errors': [(result.getDescription(test), err) for (test, err) in result.errors],
+            'skipped': len(result.skipped),
+            'expectedFailures': len(result.expectedFailures),
+            'unexpectedSuccesses': len(result.unexpectedSuccesses),
+            'trace': hdf_trace.tracer.take()}
+
+def shared_pv_sections(ini_file):
+    '''The sections of the ini_file whose simpv or hdfpv is the same for every
+    worker (does not use %(worker)s): parallel workers would drive the same IOC.'''
+    defaults = dict(PV_DEFAULTS)
+    defaults['worker'] = "1"
+    cfg = ConfigParser.SafeConfigParser( defaults = defaults )
+    cfg.read(ini_file)
+    shared = []
+    for section in cfg.sections():
+        for option in ['simpv', 'hdfpv']:
+            if cfg.get(section, option, vars={'worker': "1"}) == cfg.get(section, option, vars={'worker': "2"}):
+                shared.append(section)
+                break
+    return shared
+
+def run_parallel(ini_file, jobs, verbosity=1, failfast=False, stream=sys.stderr):
+    '''Run the ini sections in a pool of jobs worker processes and print one
+    merged report in the same format as the unittest.TextTestRunner.
+    Returns True if all tests were successful.'''
+    cfg = ConfigParser.SafeConfigParser()
+    cfg.read(ini_file)
+    tasks = [(ini_file, section, verbosity, failfast) for section in cfg.sections()]
+    
+    pool = multiprocessing.Pool(jobs, _init_worker, (multiprocessing.Value('i', 0),))
+    
+    start = time.time()
+    results = []
+    try:
+        # Results are reported in ini file order as they come in
+        for result in pool.imap(_run_section, tasks):
+            results.append(result)
+            hdf_trace.tracer.extend(result['trace'])
+            stream.write(result['output'])
+            stream.flush()
+            if failfast and (result['failures'] or result['errors']):
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+    elapsed = time.time() - start
+    
+    if verbosity > 0:
+        stream.write('\n')
+    for flavour in ['ERROR', 'FAIL']:
+        key = {'ERROR': 'errors', 'FAIL': 'failures'}[flavour]
+        for result in results:
+            for description, err in result[key]:
+                stream.write(unittest.TextTestResult.separator1 + '\n')
+                stream.write("%s: %s\n" % (flavour, description))
+                stream.write(unittest.TextTestResult.separator2 + '\n')
+                stream.write("%s\n" % err)
+    
+    run = sum([result['testsRun'] for result in results])
+    stream.write(unittest.TextTestResult.separator2 + '\n')
+    stream.write("Ran %d test%s in %.3fs\n\n" % (run, run != 1 and "s" or "", elapsed))
+    infos = []
+    failed = sum([len(result['failures']) for result in results])
+    errored = sum([len(result['errors']) for result in results])
+    for name, count in [('failures', failed), ('errors', errored),
+                        ('skipped', sum([result['skipped'] for result in results])),
+                        ('expected failures', sum([result['expectedFailures'] for result in results])),
+                        ('unexpected successes', sum([result['unexpectedSuccesses'] for result in results]))]:
+        if count:
+            infos.append("%s=%d" % (name, count))
+    if failed or errored:
+        stream.write("FAILED")
+    else:
+        stream.write("OK")
+    if infos:
+        stream.write(" (%s)" % (", ".join(infos),))
+    stream.write('\n')
+    return not (failed or errored)
 
 def main():
     class AbsPathAction(argparse.Action):
@@ -169,14 +326,47 @@ def main():
                         help='Verbosity of the unittest output')
     parser.add_argument('--failfast', '-f', dest='failfast', action='store_true', default=False,
                         help='Abort on first encounted test failure or error')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', default=True,
+                        help='Always parse the XML files instead of using the compiled layout cache')
+    parser.add_argument('--jobs', '-j', metavar='N', dest='jobs', action='store', type=int, default=1,
+                        help='Number of worker processes to run the ini sections in parallel')
+    parser.add_argument('--trace', metavar='FILE', dest='trace', action='store', default=None,
+                        help='Trace the Channel Access calls and the parse, index and validate phases '
+                        'to FILE (Chrome trace JSON) and summarise them')
+    parser.add_argument('--trace-top', metavar='N', dest='trace_top', action='store', type=int, default=10,
+                        help='Number of operations in the trace summary')
     
     args = parser.parse_args()
     args = vars(args)
+    if RUN_CA_CLIENT:
+        print "Channel Access client: %s"%(adclientxmlhdf.CA_BACKEND)
+    if not args['cache']:
+        hdf_xml.layout_cache.enabled = False
+
+    if args['jobs'] > 1 and RUN_CA_CLIENT and not adclientxmlhdf.SIMULATED_IOC:
+        shared = shared_pv_sections(args['inifile'])
+        if shared:
+            parser.error("with --jobs %d every worker would drive the same IOC PVs in the sections: %s. "
+                         "Use %%(worker)s in their simpv and hdfpv, or run them without --jobs"
+                         %(args['jobs'], ", ".join(shared)))
 
-    suite = unittest.TestSuite()
-    for cls in make_classes(TestHdfXml, args['inifile']):
-        suite.addTest(unittest.TestLoader().loadTestsFromTestCase(cls))
-    unittest.TextTestRunner(verbosity=args['verbosity'], failfast=args['failfast']).run(suite)
+    if args['trace']:
+        hdf_trace.enable()
+    try:
+        if args['jobs'] > 1:
+            successful = run_parallel(args['inifile'], args['jobs'], verbosity=args['verbosity'],
+                                      failfast=args['failfast'])
+        else:
+            suite = unittest.TestSuite()
+            for cls in make_classes(TestHdfXml, args['inifile']):
+                suite.addTest(unittest.TestLoader().loadTestsFromTestCase(cls))
+            result = unittest.TextTestRunner(verbosity=args['verbosity'], failfast=args['failfast']).run(suite)
+            successful = result.wasSuccessful()
+    finally:
+        if args['trace']:
+            hdf_trace.finish(args['trace'], args['trace_top'])
+    if not successful:
+        sys.exit(1)
     
             
 if __name__=="__main__":
@@ -4,110 +4,261 @@
 # and described by Arhtur here: 
 # https://github.com/areaDetector/ADCore/pull/24
 
-from pkg_resources import require
-require("numpy")
-require("cothread")
+try:
+    from pkg_resources import require
+    require("numpy")
+    require("cothread")
+except:
+    # Some may not use setuptools/require for package management
+    # and that is OK too...
+    pass
 
-import cothread
-from cothread import dbr
-from cothread.catools import caget, caput
+import os, sys, argparse
 
-def load_settings( settings ):
+# The PvBatch and PvWaiter live with the rest of the Channel Access client code, as
+# do the (traced) caget and caput: run with HDF_TRACE=<file> to trace all CA calls.
+# cothread comes from there too, so ADCLIENT_SIMIOC=1 runs against the simulated IOC.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testHdfXml'))
+from adclientxmlhdf import PvBatch, PvWaiter, caget, caput, connect, ca_nothing, cothread, dbr
+import hdf_trace
+import hdf_soak
+
+# Base PVs of the simDetector driver and the HDF5 file writer, and where it writes
+CAM = "13SIM1:cam1"
+HDF = "13SIM1:HDF1"
+FILE_PATH = "H:/tmp/hdfbug"
+
+# The soak mode runs thousands of cycles: only report what goes wrong
+verbose = True
+
+def log(*args):
+    if verbose:
+        print " ".join([str(arg) for arg in args])
+
+def load_settings( settings, *stages ):
     '''Load a whole bunch of PV values in one go
     settings is a list of tuples: (pv, value, datatype)
+    All settings are written concurrently. Any further lists of settings are
+    written as separate stages, each after the previous one has completed.
     '''
-    for (pv, value, dtype,) in settings:
-        caput( pv, value, datatype=dtype, wait=True ) 
+    batch = PvBatch()
+    for stage in (settings,) + stages:
+        batch.stage()
+        for (pv, value, dtype,) in stage:
+            batch.put( pv, value, datatype=dtype )
+    batch.execute()
+    log(batch)
     
 
 def setup_hdf_writer_plugin():
     settings = [
-                ("13SIM1:HDF1:FilePath","H:/tmp/hdfbug", dbr.DBR_CHAR_STR),
-                ("13SIM1:HDF1:FileName", "testbug", dbr.DBR_CHAR_STR),
-                ("13SIM1:HDF1:AutoIncrement", "Yes", None),
-                ("13SIM1:HDF1:FileTemplate", "%s%s%d.h5", dbr.DBR_CHAR_STR),
-                ("13SIM1:HDF1:AutoSave", "Yes", None),
-                ("13SIM1:HDF1:FileWriteMode", "Single", None),
-                ("13SIM1:HDF1:NumCapture", 1, None),
-                ("13SIM1:HDF1:DeleteDriverFile", "No", None),
-                ("13SIM1:HDF1:NumRowChunks", 0, None),
-                ("13SIM1:HDF1:NumColChunks", 0, None),
-                ("13SIM1:HDF1:NumFramesChunks", 0, None),
-                ("13SIM1:HDF1:BoundaryAlign", 0, None),
-                ("13SIM1:HDF1:BoundaryThreshold", 65536, None),
-                ("13SIM1:HDF1:NumFramesFlush", 0, None),
-                ("13SIM1:HDF1:Compression", "None", None),
-                ("13SIM1:HDF1:NumExtraDims", 0, None),
-                ("13SIM1:HDF1:ExtraDimSizeN", 1, None),
-                ("13SIM1:HDF1:ExtraDimSizeX", 1, None),
-                ("13SIM1:HDF1:ExtraDimSizeY", 1, None),
+                (HDF + ":FilePath",FILE_PATH, dbr.DBR_CHAR_STR),
+                (HDF + ":FileName", "testbug", dbr.DBR_CHAR_STR),
+                (HDF + ":AutoIncrement", "Yes", None),
+                (HDF + ":FileTemplate", "%s%s%d.h5", dbr.DBR_CHAR_STR),
+                (HDF + ":AutoSave", "Yes", None),
+                (HDF + ":FileWriteMode", "Single", None),
+                (HDF + ":NumCapture", 1, None),
+                (HDF + ":DeleteDriverFile", "No", None),
+                (HDF + ":NumRowChunks", 0, None),
+                (HDF + ":NumColChunks", 0, None),
+                (HDF + ":NumFramesChunks", 0, None),
+                (HDF + ":BoundaryAlign", 0, None),
+                (HDF + ":BoundaryThreshold", 65536, None),
+                (HDF + ":NumFramesFlush", 0, None),
+                (HDF + ":Compression", "None", None),
+                (HDF + ":NumExtraDims", 0, None),
+                (HDF + ":ExtraDimSizeN", 1, None),
+                (HDF + ":ExtraDimSizeX", 1, None),
+                (HDF + ":ExtraDimSizeY", 1, None),
                 ]
     load_settings( settings )
 
-def stop_ioc():
-    print "Waiting 30sec for autosave to do its thing"
-    cothread.Sleep(30.0)
-    print "Please SHUT DOWN the IOC - and restart it!"
-    raw_input("Hit enter when IOC is running again and autosave has restored PVs... ")
+def stop_ioc(restart=None):
+    '''Have the IOC restarted, by default by asking the operator (see hdf_soak for hooks)'''
+    if restart is None:
+        restart = hdf_soak.ManualRestart(sleep=cothread.Sleep)
+    restart()
     
 def capture_one_image_single():
     settings = [
-                ("13SIM1:cam1:ImageMode", "Single", None),
-                ("13SIM1:cam1:ArrayCallbacks", "Enable" , None),
-                ("13SIM1:cam1:ArrayCounter", 0, None),
-                ("13SIM1:HDF1:EnableCallbacks", "Enable", None),
-                ("13SIM1:HDF1:ArrayCounter", 0, None),
+                (CAM + ":ImageMode", "Single", None),
+                (CAM + ":ArrayCallbacks", "Enable" , None),
+                (CAM + ":ArrayCounter", 0, None),
+                (HDF + ":EnableCallbacks", "Enable", None),
+                (HDF + ":ArrayCounter", 0, None),
                 ]
     load_settings( settings )
-    timeout = caget( "13SIM1:cam1:AcquirePeriod_RBV" ) * 1.5 + 1.0
-    print "Acquiring and storing a single image in \'Single\' mode"
-    caput( "13SIM1:cam1:Acquire", 1, wait=True, timeout=timeout )
-    # Wait for a brief moment to allow the file saving to complete
-    cothread.Sleep( 1.0 )
-    fname = caget( "13SIM1:HDF1:FullFileName_RBV", datatype=dbr.DBR_CHAR_STR )
-    print "Captured into image file: ", fname
+    # Each frame is progress, so allow a few acquire periods without any
+    idle_timeout = caget( CAM + ":AcquirePeriod_RBV" ) * 3 + 1.0
+    previous_fname = caget( HDF + ":FullFileName_RBV", datatype=dbr.DBR_CHAR_STR )
+    log("Acquiring and storing a single image in \'Single\' mode")
+    with PvWaiter() as waiter:
+        waiter.watch( HDF + ":ArrayCounter_RBV" )
+        waiter.watch( HDF + ":FullFileName_RBV", datatype=dbr.DBR_CHAR_STR )
+        caput( CAM + ":Acquire", 1, wait=False )
+        # The file has been saved when the plugin has seen the frame and reports a new file name
+        waiter.wait( lambda values: values.get(HDF + ":ArrayCounter_RBV", 0) >= 1
+                                    and values.get(HDF + ":FullFileName_RBV", previous_fname) != previous_fname,
+                     idle_timeout )
+        fname = waiter.values[HDF + ":FullFileName_RBV"]
+    log("Captured into image file: ", fname)
+
+def wait_capture_started():
+    '''Start capturing and wait for the file saving plugin to report that it has started'''
+    with PvWaiter().watch( HDF + ":Capture_RBV" ) as waiter:
+        caput( HDF + ":Capture", 1, wait=False )
+        waiter.wait( lambda values: values.get(HDF + ":Capture_RBV") == 1 )
+
+def wait_capture_done():
+    '''Wait for the file saving plugin to write the file and stop capturing'''
+    idle_timeout = caget( CAM + ":AcquirePeriod_RBV" ) * 3 + 1.0
+    with PvWaiter().watch( HDF + ":Capture_RBV" ) as waiter:
+        waiter.wait( lambda values: values.get(HDF + ":Capture_RBV") == 0, idle_timeout )
 
 def capture_one_image_capture():
     settings = [
-                ("13SIM1:HDF1:FileWriteMode", "Capture", None),
+                (HDF + ":FileWriteMode", "Capture", None),
                 ]
     load_settings( settings )
-    print "Start capture mode"
-    caput( "13SIM1:HDF1:Capture", 1, wait=False )
-    # Wait for a brief moment to allow the file saving plugin to create the file
-    cothread.Sleep(1.0)
-    print "Acquire a single frame"
-    caput( "13SIM1:cam1:Acquire", 1, wait=False )
+    log("Start capture mode")
+    wait_capture_started()
+    log("Acquire a single frame")
+    caput( CAM + ":Acquire", 1, wait=False )
+    wait_capture_done()
 
 def capture_one_image_stream():
     settings = [
-                ("13SIM1:HDF1:FileWriteMode", "Stream", None),
+                (HDF + ":FileWriteMode", "Stream", None),
                 ]
     load_settings( settings )
-    print "Start capture mode"
-    caput( "13SIM1:HDF1:Capture", 1, wait=False )
-    # Wait for a brief moment to allow the file saving plugin to create the file
-    cothread.Sleep(1.0)
-    print "Acquire a single frame"
-    caput( "13SIM1:cam1:Acquire", 1, wait=False )
+    log("Start capture mode")
+    wait_capture_started()
+    log("Acquire a single frame")
+    caput( CAM + ":Acquire", 1, wait=False )
+    wait_capture_done()
     
 def enable_asyn_trace():
-    hdfport = caget("13SIM1:HDF1:PortName_RBV")
+    hdfport = caget(HDF + ":PortName_RBV")
     settings = [
-                ("13SIM1:cam1:AsynIO.PORT", hdfport, None),
-                ("13SIM1:HDF1:PoolUsedMem.SCAN", "Passive", None),
-                ("13SIM1:cam1:AsynIO.TMSK", 0x31, None),
-                ("13SIM1:cam1:AsynIO.TINM", 0x4, None),
+                (CAM + ":AsynIO.PORT", hdfport, None),
+                (HDF + ":PoolUsedMem.SCAN", "Passive", None),
                 ]
-    load_settings( settings )
+    # The trace masks apply to the port selected above so must be set afterwards
+    trace_settings = [
+                (CAM + ":AsynIO.TMSK", 0x31, None),
+                (CAM + ":AsynIO.TINM", 0x4, None),
+                ]
+    load_settings( settings, trace_settings )
 
-def main():
+def capture_single():
+    load_settings( [(HDF + ":FileWriteMode", "Single", None)] )
+    capture_one_image_single()
+
+# The modes cycled through in soak mode
+SOAK_CYCLES = [('Single', capture_single),
+               ('Capture', capture_one_image_capture),
+               ('Stream', capture_one_image_stream)]
+
+def soak_setup():
+    '''Set up the file writer and make sure it takes its frames from the driver'''
     setup_hdf_writer_plugin()
+    connect( [CAM + ":Acquire", CAM + ":PortName_RBV"] )
+    load_settings( [(HDF + ":NDArrayPort", caget( CAM + ":PortName_RBV" ), dbr.DBR_CHAR_STR)] )
+
+def soak(args):
+    '''Cycle through the Single, Capture and Stream modes unattended, sampling the
+    PoolUsedMem of the driver and the plugin and the IOC\'s RSS after every cycle'''
+    global verbose
+    verbose = False
+    probes = {'driver_pool_mb': (lambda: caget( CAM + ":PoolUsedMem" ), 1.0),
+              'plugin_pool_mb': (lambda: caget( HDF + ":PoolUsedMem" ), 1.0)}
+    if args.ioc_pid:
+        probes['rss_bytes'] = (hdf_soak.ProcRss(args.ioc_pid), 4*1024*1024)
+    elif args.rss_cmd:
+        probes['rss_bytes'] = (hdf_soak.CommandRss(args.rss_cmd), 4*1024*1024)
+    elif cothread.__name__ == 'simioc':
+        # The simulated IOC runs in this process
+        probes['rss_bytes'] = (hdf_soak.ProcRss(os.getpid()), 4*1024*1024)
+    restart = None
+    if args.restart_cmd:
+        restart = hdf_soak.CommandRestart(args.restart_cmd, ready=ioc_ready,
+                                          autosave_wait=args.autosave_wait, sleep=cothread.Sleep)
+    harness = hdf_soak.SoakHarness(SOAK_CYCLES, probes, restart, args.restart_every, setup=soak_setup)
+    report = harness.run(args.soak, report_every=args.report_every)
+    print report.summary()
+    if args.report:
+        report.save_csv(args.report)
+        print "Time series written to", args.report
+    # The regression gate: any failed cycle, or memory growing faster than allowed
+    failed = bool(report.failures)
+    if args.max_leak is not None:
+        # The pools are reported in MB, RSS in bytes: compare in kB per cycle
+        scale = {'driver_pool_mb': 1024., 'plugin_pool_mb': 1024., 'rss_bytes': 1/1024.}
+        for name, (per_cycle, per_hour) in report.leak_rates().iteritems():
+            if per_cycle is not None and per_cycle * scale[name] > args.max_leak:
+                print "LEAK %s grows %.3g kB per cycle (limit %.3g)"%(name, per_cycle * scale[name], args.max_leak)
+                failed = True
+    if args.fail_on_step and report.steps():
+        failed = True
+    if failed:
+        sys.exit(1)
+
+def ioc_ready():
+    '''Whether the IOC is back up after a restart: while it is down caget
+    finds the PV disconnected (ca_nothing) rather than timing out'''
+    try:
+        caget( HDF + ":PortName_RBV", timeout=2.0 )
+    except (ca_nothing, cothread.Timedout):
+        return False
+    return True
+
+def main():
+    global CAM, HDF, FILE_PATH
+    parser = argparse.ArgumentParser(description="Reproduce the HDF5 file writer heap corruption bug, "
+                                     "or soak test the file writer for memory leaks with --soak")
+    parser.add_argument('--cam', dest='cam', action='store', default=CAM,
+                        help='Base PV of the simDetector driver')
+    parser.add_argument('--hdf', dest='hdf', action='store', default=HDF,
+                        help='Base PV of the HDF5 file writer plugin')
+    parser.add_argument('--path', dest='path', action='store', default=FILE_PATH,
+                        help='Directory the file writer writes to')
+    parser.add_argument('--soak', metavar='N', dest='soak', action='store', type=int, default=0,
+                        help='Soak mode: run N capture cycles (Single, Capture, Stream in turn) unattended')
+    parser.add_argument('--restart-cmd', metavar='CMD', dest='restart_cmd', action='store', default=None,
+                        help='Soak mode: shell command restarting the IOC, after failed cycles and every '
+                        '--restart-every cycles (without it a failed cycle ends the run)')
+    parser.add_argument('--restart-every', metavar='K', dest='restart_every', action='store', type=int, default=0,
+                        help='Soak mode: restart the IOC every K cycles')
+    parser.add_argument('--autosave-wait', metavar='T', dest='autosave_wait', action='store', type=float,
+                        default=30.0, help='Seconds to give autosave before restarting the IOC')
+    parser.add_argument('--ioc-pid', metavar='PID', dest='ioc_pid', action='store', type=int, default=None,
+                        help='Soak mode: sample the RSS of the IOC process PID on this host')
+    parser.add_argument('--rss-cmd', metavar='CMD', dest='rss_cmd', action='store', default=None,
+                        help='Soak mode: shell command printing the RSS of the IOC in kB')
+    parser.add_argument('--report', metavar='FILE', dest='report', action='store', default=None,
+                        help='Soak mode: write the time series of every cycle to a CSV file')
+    parser.add_argument('--report-every', metavar='N', dest='report_every', action='store', type=int, default=100,
+                        help='Soak mode: print the memory use every N cycles')
+    parser.add_argument('--max-leak', metavar='KB', dest='max_leak', action='store', type=float, default=None,
+                        help='Soak mode: fail if PoolUsedMem or RSS grows more than KB per cycle')
+    parser.add_argument('--fail-on-step', dest='fail_on_step', action='store_true', default=False,
+                        help='Soak mode: fail on step changes in PoolUsedMem or RSS')
+    args = parser.parse_args()
+    CAM, HDF, FILE_PATH = args.cam, args.hdf, args.path
+
+    if args.soak:
+        soak(args)
+        return
+    with hdf_trace.span("setup_hdf_writer_plugin", "phase"):
+        setup_hdf_writer_plugin()
     stop_ioc()
     #enable_asyn_trace()
-    capture_one_image_single()
+    with hdf_trace.span("capture_one_image_single", "phase"):
+        capture_one_image_single()
     enable_asyn_trace()
-    capture_one_image_capture()
+    with hdf_trace.span("capture_one_image_capture", "phase"):
+        capture_one_image_capture()
     
     #capture_one_image_stream()
 if __name__=="__main__":